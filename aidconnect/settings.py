@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/4.2/ref/settings/
 """
 
+from datetime import timedelta
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -46,6 +47,8 @@ INSTALLED_APPS = [
 AUTH_USER_MODEL = 'core.User'
 
 MIDDLEWARE = [
+    'core.metrics.MetricsMiddleware',
+    'core.profiling.QueryProfilingMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -59,7 +62,7 @@ ROOT_URLCONF = 'aidconnect.urls'
 
 TEMPLATES = [
     {
-        'BACKEND': 'django.template.backends.django.DjangoTemplates',
+        'BACKEND': 'core.profiling.ProfiledDjangoTemplates',
         'DIRS': [BASE_DIR / 'templates']
         ,
         'APP_DIRS': True,
@@ -138,3 +141,65 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 LOGIN_URL = 'login'
 LOGIN_REDIRECT_URL = 'dashboard_redirect'
 LOGOUT_REDIRECT_URL = 'login'
+
+# Directory where background report runs write their generated files
+REPORT_ARTIFACT_ROOT = BASE_DIR / 'report_artifacts'
+
+# Running background runs are touched every quarter of this many seconds;
+# those left untouched longer belong to a report worker that stopped, and
+# are failed
+REPORT_RUN_TIMEOUT = 60 * 60
+
+# Cache of generated report files, served again while their data is unchanged
+REPORT_CACHE_ROOT = BASE_DIR / 'report_cache'
+REPORT_CACHE_MAX_BYTES = 512 * 1024 * 1024
+
+# Tests write report files and data versions to a temporary directory instead
+TEST_RUNNER = 'core.test_runner.TemporaryFilesRunner'
+
+# REST API lists are paged by cursor, PAGE_SIZE rows at a time unless the
+# client asks for up to API_MAX_PAGE_SIZE with ?page_size=
+# JSON goes through orjson when installed, and MessagePack is offered to
+# clients sending `Accept: application/msgpack` when msgpack is installed
+REST_FRAMEWORK = {
+    'DEFAULT_PAGINATION_CLASS': 'core.pagination.KeysetCursorPagination',
+    'PAGE_SIZE': 50,
+    'DEFAULT_RENDERER_CLASSES': [
+        'core.renderers.FastJSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+        'core.renderers.MessagePackRenderer',
+    ],
+    'DEFAULT_PARSER_CLASSES': [
+        'core.renderers.FastJSONParser',
+        'core.renderers.MessagePackParser',
+        'rest_framework.parsers.FormParser',
+        'rest_framework.parsers.MultiPartParser',
+    ],
+    'DEFAULT_CONTENT_NEGOTIATION_CLASS': 'core.renderers.AvailableFormatsNegotiation',
+}
+API_MAX_PAGE_SIZE = 500
+
+# How long deletions are remembered for offline clients; those last synced
+# longer ago than this get everything again
+SYNC_TOMBSTONE_RETENTION = timedelta(days=30)
+
+# Most notes or assessments accepted by one bulk upload to the API
+API_BULK_MAX_ITEMS = 1000
+
+# Share of requests profiled, with their SQL, template and Python time sent
+# in a Server-Timing header; those slower than PROFILING_SLOW_REQUEST_MS, with
+# more than PROFILING_MAX_QUERIES queries or running one query signature
+# PROFILING_REPEATED_QUERIES times or more are logged
+PROFILING_SAMPLE_RATE = 0.05
+PROFILING_SLOW_REQUEST_MS = 1000
+PROFILING_MAX_QUERIES = 50
+PROFILING_REPEATED_QUERIES = 10
+
+# Prometheus metrics served at /metrics to scrapers sending METRICS_TOKEN as
+# `Authorization: Bearer <token>`; without a token /metrics is not served.
+# With METRICS_DIR set, each serving process writes its values to a file
+# there at most every METRICS_FLUSH_INTERVAL seconds, and /metrics adds up
+# those of all processes, such as gunicorn workers
+METRICS_DIR = None
+METRICS_FLUSH_INTERVAL = 1.0
+METRICS_TOKEN = None
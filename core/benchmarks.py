@@ -0,0 +1,885 @@
+"""
+Benchmark scenarios run by the `benchmark` management command.
+
+Every scenario runs against a throwaway test database so that the data it
+generates never touches the configured database.
+"""
+import multiprocessing
+import sys
+import time
+import tracemalloc
+from contextlib import contextmanager
+from datetime import date
+
+try:
+    import resource
+except ImportError:
+    # Not on Windows, where peak RSS is not reported
+    resource = None
+
+from django.db import connection
+from django.test import RequestFactory
+
+from .models import (
+    User, Beneficiary, BeneficiaryCategory, BeneficiaryFundingLedger, Program, ReportTemplate, Case, Assessment
+)
+
+# name -> (function, description)
+BENCHMARKS = {}
+
+SEED_BATCH_SIZE = 5000
+
+
+def benchmark(name, description):
+    """Register a benchmark scenario under `name`"""
+    def decorator(func):
+        BENCHMARKS[name] = (func, description)
+        return func
+    return decorator
+
+
+@contextmanager
+def benchmark_database():
+    """Run the enclosed block against a freshly created test database"""
+    old_name = connection.settings_dict['NAME']
+    connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+    try:
+        yield
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+
+
+@contextmanager
+def measure(trace_memory=True):
+    """
+    Measure wall time and peak traced Python memory of the enclosed block.
+
+    Yields a dict holding the `started` timestamp, filled with `seconds` and,
+    with `trace_memory`, `peak_mb` on exit. Traced memory leaves out what C
+    extensions allocate and is not the process's RSS; see run_in_child.
+    """
+    if trace_memory:
+        tracemalloc.start()
+    started = time.perf_counter()
+    result = {'started': started}
+    try:
+        yield result
+    finally:
+        result['seconds'] = time.perf_counter() - started
+        if trace_memory:
+            result['peak_mb'] = tracemalloc.get_traced_memory()[1] / (1024 * 1024)
+            tracemalloc.stop()
+
+
+def _peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+def _child(func, args, sender):
+    result = func(*args)
+    result['peak_rss_mb'] = _peak_rss_mb()
+    sender.send(result)
+
+
+def run_in_child(func, *args):
+    """
+    Run `func(*args)`, which returns a result dict, in a forked process and
+    add its `peak_rss_mb`, the peak resident set size including C-level
+    allocations such as lxml and zip buffers. The child starts with this
+    process's pages, so compare the figure between paths of one size. A child
+    that dies, such as when it runs out of memory, is reported as failed.
+    Without fork, as on Windows, `func` runs here and no RSS is reported.
+    """
+    if resource is None or 'fork' not in multiprocessing.get_all_start_methods():
+        return func(*args)
+    context = multiprocessing.get_context('fork')
+    receiver, sender = context.Pipe(duplex=False)
+    process = context.Process(target=_child, args=(func, args, sender))
+    process.start()
+    sender.close()
+    try:
+        result = receiver.recv()
+    except EOFError:
+        result = {'failed': 'exit code %s' % process.exitcode}
+    process.join()
+    if 'failed' in result and process.exitcode is not None and process.exitcode < 0:
+        result['failed'] = 'killed by signal %d, likely out of memory' % -process.exitcode
+    return result
+
+
+def get_benchmark_user(role='admin'):
+    user, _ = User.objects.get_or_create(username=f'bench_{role}', defaults={'role': role})
+    return user
+
+
+def seed_beneficiaries(count):
+    """Bulk insert `count` beneficiaries spread over a few categories and programs"""
+    categories = [
+        BeneficiaryCategory.objects.get_or_create(
+            name=f'Bench Category {idx}', defaults={'max_annual_amount': 250000 * idx}
+        )[0]
+        for idx in range(1, 4)
+    ]
+    programs = [
+        Program.objects.get_or_create(
+            name=f'Bench Program {idx}', defaults={'monthly_amount': 10000 * idx}
+        )[0]
+        for idx in range(1, 4)
+    ]
+    existing = Beneficiary.objects.count()
+    batch = []
+    for idx in range(existing, count):
+        batch.append(Beneficiary(
+            name=f'Beneficiary {idx}',
+            dob=date(1950 + idx % 50, 1 + idx % 12, 1 + idx % 28),
+            gender=('male', 'female')[idx % 2],
+            address=f'{idx} Bench Street, Kigali',
+            category=categories[idx % len(categories)],
+            program=programs[idx % len(programs)],
+        ))
+        if len(batch) >= SEED_BATCH_SIZE:
+            Beneficiary.objects.bulk_create(batch)
+            batch = []
+    if batch:
+        Beneficiary.objects.bulk_create(batch)
+
+
+def _inmemory_excel_export(request, fields):
+    """
+    The pre-streaming export path: a fully materialized workbook whose cells
+    are read off model instances, saved in one go once every row is present.
+    """
+    import openpyxl
+    from io import BytesIO
+    from .views import get_report_data
+
+    with measure(trace_memory=False) as inmemory:
+        wb = openpyxl.Workbook()
+        ws = wb.active
+        ws.append(fields)
+        for item in get_report_data(request, 'beneficiary'):
+            row = []
+            for field in fields:
+                value = item
+                for part in field.split('__'):
+                    value = getattr(value, part, None)
+                row.append(value)
+            ws.append(row)
+        output = BytesIO()
+        wb.save(output)
+    return {
+        'path': 'openpyxl in-memory',
+        'ttfb_s': inmemory['seconds'],
+        'total_s': inmemory['seconds'],
+        'bytes': output.tell(),
+    }
+
+
+def _streaming_excel_export(request, template):
+    from .views import get_report_data, generate_excel_report
+
+    with measure(trace_memory=False) as streaming:
+        response = generate_excel_report(request, None, get_report_data(request, 'beneficiary'), template)
+        ttfb = None
+        size_bytes = 0
+        for chunk in response.streaming_content:
+            if ttfb is None:
+                ttfb = time.perf_counter() - streaming['started']
+            size_bytes += len(chunk)
+    return {
+        'path': 'streaming',
+        'ttfb_s': ttfb,
+        'total_s': streaming['seconds'],
+        'bytes': size_bytes,
+    }
+
+
+@benchmark('excel_export', 'Streaming Excel export versus an in-memory openpyxl workbook, with peak RSS of each')
+def excel_export_benchmark(size):
+    seed_beneficiaries(size)
+    user = get_benchmark_user()
+    template = ReportTemplate(
+        name='Beneficiary Export',
+        entity_type='beneficiary',
+        fields='["id", "name", "dob", "gender", "address", "category__name", "program__name"]',
+        created_by=user,
+    )
+    request = RequestFactory().get('/')
+    request.user = user
+    # Each path in a process of its own, so one's peak memory does not hide the other's
+    return [
+        {'path': 'openpyxl in-memory', **run_in_child(_inmemory_excel_export, request, template.get_fields_list())},
+        {'path': 'streaming', **run_in_child(_streaming_excel_export, request, template)},
+    ]
+
+
+def seed_assessments(beneficiary, count, years=5):
+    """Bulk insert `count` assessments for `beneficiary`, spread over `years` years and two cases"""
+    user = get_benchmark_user('case_manager')
+    cases = [
+        Case.objects.create(title=f'Bench Case {idx}', beneficiary=beneficiary, case_manager=user)
+        for idx in range(2)
+    ]
+    batch = []
+    for idx in range(count):
+        batch.append(Assessment(
+            title=f'Assessment {idx}',
+            case=cases[idx % len(cases)],
+            created_by=user,
+            amount_received=idx % 500,
+            income_amount=1000,
+            year=2020 + idx % years,
+        ))
+        if len(batch) >= SEED_BATCH_SIZE:
+            Assessment.objects.bulk_create(batch)
+            batch = []
+    if batch:
+        Assessment.objects.bulk_create(batch)
+
+
+@benchmark('funding_totals', 'Funding totals from the ledger versus aggregating or summing assessments, by assessments per beneficiary')
+def funding_totals_benchmark(size):
+    from django.db.models import Sum
+    from .funding import get_total_received, get_yearly_totals, rebuild_ledger
+
+    seed_beneficiaries(1)
+    beneficiary = Beneficiary.objects.first()
+    seed_assessments(beneficiary, size)
+    # Bulk inserts bypass the signals that maintain the ledger
+    rebuild_ledger()
+    results = []
+
+    # The original implementation: a case id query, then every assessment loaded and summed in Python
+    with measure() as python_sum:
+        case_ids = Case.objects.filter(beneficiary=beneficiary).values_list('id', flat=True)
+        total = sum(assessment.amount_received for assessment in Assessment.objects.filter(case__id__in=case_ids))
+    results.append({'path': 'python sum', 'total_s': python_sum['seconds'], 'peak_mb': python_sum['peak_mb'], 'total': total})
+
+    with measure() as aggregate:
+        total = Assessment.objects.filter(case__beneficiary=beneficiary).aggregate(total=Sum('amount_received'))['total']
+    results.append({'path': 'assessment aggregate', 'total_s': aggregate['seconds'], 'peak_mb': aggregate['peak_mb'], 'total': total})
+
+    with measure() as ledger:
+        total = get_total_received(beneficiary)
+    results.append({'path': 'ledger', 'total_s': ledger['seconds'], 'peak_mb': ledger['peak_mb'], 'total': total})
+
+    with measure() as yearly:
+        totals = get_yearly_totals(beneficiary)
+    results.append({'path': 'ledger by year', 'total_s': yearly['seconds'], 'peak_mb': yearly['peak_mb'], 'years': len(totals)})
+    return results
+
+
+@benchmark('promotions', 'Population-wide category promotion planning, by number of assessed beneficiaries')
+def promotions_benchmark(size):
+    from .promotions import plan_promotions
+
+    seed_beneficiaries(size)
+    assessed = set(BeneficiaryFundingLedger.objects.values_list('beneficiary_id', flat=True))
+    batch = []
+    for idx, pk in enumerate(Beneficiary.objects.order_by('pk').values_list('pk', flat=True).iterator()):
+        if pk in assessed:
+            continue
+        batch.append(BeneficiaryFundingLedger(
+            beneficiary_id=pk, year=2024, total_received=(idx * 7919) % 900000,
+            assessment_count=1, last_income=(idx * 104729) % 900000,
+        ))
+        if len(batch) >= SEED_BATCH_SIZE:
+            BeneficiaryFundingLedger.objects.bulk_create(batch)
+            batch = []
+    if batch:
+        BeneficiaryFundingLedger.objects.bulk_create(batch)
+
+    with measure() as planning:
+        plan = plan_promotions()
+    return [{
+        'path': 'plan',
+        'total_s': planning['seconds'],
+        'peak_mb': planning['peak_mb'],
+        'per_s': plan.evaluated / planning['seconds'],
+        'changes': len(plan.categories),
+    }]
+
+
+CATEGORY_LOOKUPS = 2000
+
+
+@benchmark('category_lookup', f'{CATEGORY_LOOKUPS} promotion category lookups, ORM queries versus the cached threshold index, by number of categories')
+def category_lookup_benchmark(size):
+    import random
+    from .promotions import get_category_index, invalidate_category_index
+
+    existing = BeneficiaryCategory.objects.count()
+    BeneficiaryCategory.objects.bulk_create([
+        BeneficiaryCategory(name=f'Lookup Category {idx}', max_annual_amount=1000 * (idx + 1))
+        for idx in range(existing, size)
+    ])
+    invalidate_category_index()
+    top = 1000 * size
+    rng = random.Random(size)
+    amounts = [rng.randrange(top + 1000) for _ in range(CATEGORY_LOOKUPS)]
+    results = []
+
+    # The original lookup: an exists() query, then first() on the same queryset
+    with measure() as orm:
+        for amount in amounts:
+            categories = BeneficiaryCategory.objects.filter(max_annual_amount__gte=amount).order_by('max_annual_amount')
+            if categories.exists():
+                categories.first()
+    results.append({'path': 'orm', 'total_s': orm['seconds'], 'us_per_lookup': orm['seconds'] * 1e6 / CATEGORY_LOOKUPS})
+
+    with measure() as build:
+        get_category_index()
+    results.append({'path': 'index build', 'total_s': build['seconds'], 'peak_mb': build['peak_mb']})
+
+    with measure() as index:
+        for amount in amounts:
+            get_category_index().smallest_at_least(amount)
+    results.append({'path': 'index', 'total_s': index['seconds'], 'us_per_lookup': index['seconds'] * 1e6 / CATEGORY_LOOKUPS})
+    return results
+
+
+LIST_PAGE_SIZE = 10
+
+
+@benchmark('deep_pagination', 'Fetching the last page of the beneficiary list, page numbers versus keyset cursors, by number of beneficiaries')
+def deep_pagination_benchmark(size):
+    from django.core.paginator import Paginator
+    from django.db.models import F
+    from .pagination import KeysetPaginator
+
+    seed_beneficiaries(size)
+    results = []
+    for sort in ('pk', 'name'):
+        queryset = Beneficiary.objects.order_by(sort)
+        number = Paginator(queryset, LIST_PAGE_SIZE).num_pages
+
+        # Page number: count for the page links, then OFFSET past every earlier row
+        with measure() as offset:
+            page = Paginator(queryset, LIST_PAGE_SIZE).page(number)
+            rows = len(page.object_list)
+        results.append({'path': f'offset by {sort}', 'total_s': offset['seconds'], 'page': number, 'rows': rows})
+
+        # The cursor the previous page's next link would carry
+        paginator = KeysetPaginator(queryset, LIST_PAGE_SIZE)
+        before = queryset.annotate(_keyset_value=F(sort))[(number - 1) * LIST_PAGE_SIZE - 1]
+        cursor = paginator.encode_cursor(before, forward=True)
+        with measure() as keyset:
+            paginator = KeysetPaginator(queryset, LIST_PAGE_SIZE)
+            page = paginator.page(cursor)
+            rows = len(page.object_list)
+            paginator.count
+        results.append({'path': f'keyset by {sort}', 'total_s': keyset['seconds'], 'page': number, 'rows': rows})
+    return results
+
+
+# Listing a whole table in one response holds every row in memory at once,
+# so above this size it is left out of the comparison
+API_UNPAGED_MAX_ROWS = 100000
+
+
+@benchmark('api_list', 'Time and peak memory of one /api/beneficiaries/ request, cursor pages versus the whole table, by number of beneficiaries')
+def api_list_benchmark(size):
+    from django.db.models import F
+    from rest_framework.test import APIRequestFactory, force_authenticate
+    from .pagination import KeysetPaginator
+    from .views import BeneficiaryViewSet
+
+    seed_beneficiaries(size)
+    user = get_benchmark_user()
+    factory = APIRequestFactory(SERVER_NAME='localhost')
+
+    def get(view, params):
+        request = factory.get('/api/beneficiaries/', params)
+        force_authenticate(request, user)
+        with measure() as listing:
+            response = view(request).render()
+        return {'total_s': listing['seconds'], 'peak_mb': listing['peak_mb'], 'bytes': len(response.content)}
+
+    paged = BeneficiaryViewSet.as_view({'get': 'list'})
+    queryset = Beneficiary.objects.order_by('-created_at')
+    middle = queryset.annotate(_keyset_value=F('created_at'))[size // 2]
+    cursor = KeysetPaginator(queryset, 1).encode_cursor(middle, forward=True)
+    results = [
+        {'path': 'first page', **get(paged, {})},
+        {'path': 'middle page', **get(paged, {'cursor': cursor})},
+    ]
+    if size > API_UNPAGED_MAX_ROWS:
+        results.append({'path': 'unpaged', 'skipped': f'size above {API_UNPAGED_MAX_ROWS}'})
+    else:
+        unpaged = BeneficiaryViewSet.as_view({'get': 'list'}, pagination_class=None)
+        results.append({'path': 'unpaged', **get(unpaged, {})})
+    return results
+
+
+SEARCH_QUERIES = 50
+
+
+@benchmark('search', f'{SEARCH_QUERIES} beneficiary list searches, substring scans versus the full-text index, by number of beneficiaries')
+def search_benchmark(size):
+    from .search import SubstringBackend, get_search_backend, get_search_index, rebuild_search_index
+
+    seed_beneficiaries(size)
+    # Seeding bulk inserts, which bypasses the signals that keep the index current
+    with measure() as indexing:
+        rebuild_search_index()
+    results = [{'path': 'index build', 'total_s': indexing['seconds'], 'peak_mb': indexing['peak_mb']}]
+
+    index = get_search_index(Beneficiary)
+    queries = [str(size * idx // SEARCH_QUERIES) for idx in range(SEARCH_QUERIES)]
+    for path, backend in (('substring', SubstringBackend()), ('full-text', get_search_backend())):
+        with measure() as searching:
+            for query in queries:
+                page = list(backend.filter(Beneficiary.objects.all(), index, query).order_by('search_rank', 'name')[:10])
+        results.append({
+            'path': path,
+            'total_s': searching['seconds'],
+            'ms_per_search': searching['seconds'] * 1000 / SEARCH_QUERIES,
+            'last_rows': len(page),
+        })
+    return results
+
+
+FIELD_OFFICERS = 200
+CASE_LIST_REQUESTS = 20
+
+
+@benchmark('field_officer_cases', f'First page and count of a field officer case list, {FIELD_OFFICERS} officers, by number of case notes')
+def field_officer_cases_benchmark(size):
+    from django.db.models import Exists, OuterRef, Q
+    from .contributors import rebuild_contributors
+    from .models import CaseNote
+    from .scopes import RoleScope
+
+    seed_beneficiaries(max(size // 50, 1))
+    manager = get_benchmark_user('case_manager')
+    officers = [
+        User.objects.get_or_create(username=f'bench_officer_{idx}', defaults={'role': 'field_officer'})[0]
+        for idx in range(FIELD_OFFICERS)
+    ]
+    Case.objects.bulk_create([
+        Case(title=f'Bench Case {pk}', beneficiary_id=pk, case_manager=manager)
+        for pk in Beneficiary.objects.values_list('pk', flat=True)
+    ], batch_size=SEED_BATCH_SIZE)
+    case_ids = list(Case.objects.values_list('pk', flat=True))
+    batch = []
+    for idx in range(size):
+        batch.append(CaseNote(
+            case_id=case_ids[(idx * 7919) % len(case_ids)], created_by=officers[idx % FIELD_OFFICERS], content=f'Visit {idx}'
+        ))
+        if len(batch) >= SEED_BATCH_SIZE:
+            CaseNote.objects.bulk_create(batch)
+            batch = []
+    CaseNote.objects.bulk_create(batch)
+
+    # Seeding bulk inserts, which bypasses the signals that maintain contributors
+    with measure() as rebuild:
+        rebuild_contributors()
+    results = [{'path': 'rebuild', 'total_s': rebuild['seconds'], 'peak_mb': rebuild['peak_mb']}]
+
+    officer = officers[0]
+
+    def id_lists():
+        notes = CaseNote.objects.filter(created_by=officer).values_list('case_id', flat=True)
+        assessments = Assessment.objects.filter(created_by=officer).values_list('case_id', flat=True)
+        return Case.objects.filter(Q(id__in=notes) | Q(id__in=assessments)).distinct()
+
+    def exists():
+        notes = CaseNote.objects.filter(case=OuterRef('pk'), created_by=officer)
+        assessments = Assessment.objects.filter(case=OuterRef('pk'), created_by=officer)
+        return Case.objects.filter(Exists(notes) | Exists(assessments))
+
+    def contributors():
+        return RoleScope(officer).queryset(Case)
+
+    for path, build in (('id lists + distinct', id_lists), ('exists', exists), ('contributor join', contributors)):
+        with measure() as listing:
+            for _ in range(CASE_LIST_REQUESTS):
+                queryset = build().order_by('-created_at')
+                count = queryset.count()
+                list(queryset[:10])
+        results.append({'path': path, 'total_s': listing['seconds'], 'ms_per_request': listing['seconds'] * 1000 / CASE_LIST_REQUESTS, 'cases': count})
+    return results
+
+
+PLAN_CASE_MANAGERS = 20
+PLAN_FIELD_OFFICERS = 50
+
+
+def seed_case_records(count):
+    """
+    Bulk insert `count` cases, each with a couple of notes and an assessment
+    and every other one with a referral, action plan and progress record,
+    spread over several staff of each role; alerts and report runs alike.
+    Returns one user of every role.
+    """
+    from .contributors import rebuild_contributors
+    from .models import ActionPlan, Alert, BeneficiaryProgress, CaseNote, Referral, Report, ReportRun
+
+    seed_beneficiaries(count)
+    users = {role: get_benchmark_user(role) for role, _ in User.ROLE_CHOICES}
+    managers = [users['case_manager']] + [
+        User.objects.get_or_create(username=f'bench_manager_{idx}', defaults={'role': 'case_manager'})[0]
+        for idx in range(PLAN_CASE_MANAGERS - 1)
+    ]
+    officers = [users['field_officer']] + [
+        User.objects.get_or_create(username=f'bench_officer_{idx}', defaults={'role': 'field_officer'})[0]
+        for idx in range(PLAN_FIELD_OFFICERS - 1)
+    ]
+    staff = list(users.values())
+    # Larger sizes only add to what earlier sizes seeded
+    existing = Case.objects.count()
+    beneficiary_ids = list(Beneficiary.objects.order_by('pk').values_list('pk', flat=True)[existing:count])
+    Case.objects.bulk_create([
+        Case(
+            title=f'Bench Case {idx}', beneficiary_id=pk, case_manager=managers[idx % len(managers)],
+            status=('open', 'closed', 'pending')[idx % 3],
+        )
+        for idx, pk in enumerate(beneficiary_ids, start=existing)
+    ], batch_size=SEED_BATCH_SIZE)
+    cases = list(Case.objects.order_by('pk').values_list('pk', 'beneficiary_id', 'case_manager_id')[existing:count])
+
+    records = {model: [] for model in (CaseNote, Assessment, Referral, ActionPlan, BeneficiaryProgress, Alert, Report, ReportRun)}
+    for idx, (case_id, beneficiary_id, manager_id) in enumerate(cases, start=existing):
+        officer = officers[idx % len(officers)]
+        records[CaseNote].extend(
+            CaseNote(case_id=case_id, created_by=officers[(idx + n) % len(officers)], content=f'Visit {idx}.{n}')
+            for n in range(2)
+        )
+        records[Assessment].append(Assessment(title=f'Assessment {idx}', case_id=case_id, created_by=officer, year=2020 + idx % 5))
+        records[Alert].append(Alert(title=f'Alert {idx}', message='Bench alert', user=staff[idx % len(staff)], is_read=bool(idx % 4)))
+        if idx % 2:
+            continue
+        records[Referral].append(Referral(
+            beneficiary_id=beneficiary_id, case_id=case_id, referred_by=officer,
+            referred_to_organization='Bench Partner', referred_to_user=users['partner_organisation'] if idx % 4 == 0 else None,
+            reason='Bench referral', status=('pending', 'accepted', 'completed')[idx % 3],
+        ))
+        records[ActionPlan].append(ActionPlan(
+            title=f'Plan {idx}', case_id=case_id, created_by_id=manager_id, description='Bench plan',
+            goals='Bench goals', timeline='Bench timeline', status=('draft', 'active', 'completed')[idx % 3],
+        ))
+        records[BeneficiaryProgress].append(BeneficiaryProgress(
+            beneficiary_id=beneficiary_id, case_id=case_id, recorded_by_id=manager_id,
+            date=date(2020 + idx % 5, 1 + idx % 12, 1 + idx % 28),
+        ))
+        if idx % 20 == 0:
+            report_user = staff[idx % len(staff)]
+            template = ReportTemplate.objects.create(name=f'Template {idx}', entity_type='case', fields='["title"]', created_by=report_user)
+            records[Report].append(Report(name=f'Report {idx}', template=template, created_by=report_user))
+            records[ReportRun].append(ReportRun(
+                name=f'Run {idx}', entity_type='case', fields='["title"]', created_by=report_user,
+                status=('completed', 'failed', 'queued')[idx % 3],
+            ))
+    for model, batch in records.items():
+        model.objects.bulk_create(batch, batch_size=SEED_BATCH_SIZE)
+
+    # Seeding bulk inserts, which bypasses the signals that maintain contributors
+    rebuild_contributors()
+    return users
+
+
+SYNC_CHANGED_SHARE = 0.01
+
+
+@benchmark('sync', f'Bytes sent and server CPU of a full sync pull versus an incremental one after {SYNC_CHANGED_SHARE:.0%} of notes changed, by number of cases')
+def sync_benchmark(size):
+    from datetime import timedelta
+    from django.utils import timezone
+    from rest_framework.test import APIRequestFactory, force_authenticate
+    from .models import CaseNote
+    from .views import SyncView
+
+    users = seed_case_records(size)
+    view = SyncView.as_view()
+    factory = APIRequestFactory(SERVER_NAME='localhost')
+
+    # Everything seeded so far was synced a day ago
+    synced_at = timezone.now() - timedelta(days=1)
+    for model in (Program, BeneficiaryCategory, Beneficiary, Case, CaseNote, Assessment):
+        model.objects.update(updated_at=synced_at - timedelta(hours=1))
+    changed = CaseNote.objects.order_by('?').values_list('pk', flat=True)[:max(int(size * 2 * SYNC_CHANGED_SHARE), 1)]
+    CaseNote.objects.filter(pk__in=list(changed)).update(content='Edited', updated_at=timezone.now())
+
+    def pull(params, encoding):
+        request = factory.get('/api/sync/', params, HTTP_ACCEPT_ENCODING=encoding)
+        force_authenticate(request, users['admin'])
+        return view(request).streaming_content
+
+    results = []
+    for path, params in (('full', {}), ('incremental', {'since': synced_at.isoformat()})):
+        for encoding in ('identity', 'gzip'):
+            # Timed without memory tracing, which slows Python code down several times over
+            started, cpu_started = time.perf_counter(), time.process_time()
+            sent = sum(len(chunk) for chunk in pull(params, encoding))
+            total, cpu = time.perf_counter() - started, time.process_time() - cpu_started
+            with measure() as traced:
+                for _ in pull(params, encoding):
+                    pass
+            results.append({
+                'path': f'{path} {encoding}', 'total_s': total, 'cpu_s': cpu, 'peak_mb': traced['peak_mb'], 'bytes': sent,
+            })
+    return results
+
+
+BULK_UPLOAD_NOTES = 1000
+BULK_UPLOAD_CASES = 50
+
+
+@benchmark('bulk_upload', f'Uploading {BULK_UPLOAD_NOTES} case notes in one bulk request versus one request each, by number of cases')
+def bulk_upload_benchmark(size):
+    from django.db import connection
+    from rest_framework.test import APIRequestFactory, force_authenticate
+    from .views import CaseNoteViewSet
+
+    users = seed_case_records(size)
+    officer = users['field_officer']
+    case_ids = list(Case.objects.order_by('pk').values_list('pk', flat=True)[:BULK_UPLOAD_CASES])
+    items = [
+        {'case': case_ids[idx % len(case_ids)], 'content': f'Uploaded visit {idx}'}
+        for idx in range(BULK_UPLOAD_NOTES)
+    ]
+    factory = APIRequestFactory(SERVER_NAME='localhost')
+
+    def post(view, url, data):
+        request = factory.post(url, data, format='json')
+        force_authenticate(request, officer)
+        response = view(request)
+        assert response.status_code == 201, response.data
+        return response
+
+    single = CaseNoteViewSet.as_view({'post': 'create'})
+    bulk = CaseNoteViewSet.as_view({'post': 'bulk'})
+    uploads = (
+        ('single requests', lambda: [post(single, '/api/case-notes/', {**item, 'created_by': officer.pk}) for item in items]),
+        ('bulk request', lambda: post(bulk, '/api/case-notes/bulk/', items)),
+    )
+    queries = []
+
+    def count_queries(execute, sql, params, many, context):
+        queries.append(sql)
+        return execute(sql, params, many, context)
+
+    results = []
+    for path, upload in uploads:
+        queries.clear()
+        # Timed without memory tracing, which slows Python code down several times over
+        with connection.execute_wrapper(count_queries):
+            started = time.perf_counter()
+            upload()
+            total = time.perf_counter() - started
+        results.append({
+            'path': path, 'total_s': total, 'ms_per_note': total * 1000 / BULK_UPLOAD_NOTES, 'queries': len(queries),
+        })
+    return results
+
+
+POLLS = 200
+POLL_CHANGE_EVERY = 20
+
+
+@benchmark('conditional_polling', f'{POLLS} polls of a case page and its API object, one new note every {POLL_CHANGE_EVERY}, with and without ETags, by notes on the case')
+def conditional_polling_benchmark(size):
+    from django.test import Client
+    from django.urls import reverse
+    from .models import CaseNote
+
+    seed_beneficiaries(1)
+    manager = get_benchmark_user('case_manager')
+    case = Case.objects.create(title='Polled case', beneficiary=Beneficiary.objects.first(), case_manager=manager)
+    CaseNote.objects.bulk_create(
+        [CaseNote(case=case, created_by=manager, content=f'Visit {idx}') for idx in range(size)], batch_size=SEED_BATCH_SIZE
+    )
+    client = Client(HTTP_HOST='localhost')
+    client.force_login(manager)
+
+    results = []
+    for target, url in (('page', reverse('case_detail', args=[case.pk])), ('api', f'/api/cases/{case.pk}/')):
+        for path in ('unconditional', 'conditional'):
+            etag = None
+            sent = not_modified = 0
+            started, cpu_started = time.perf_counter(), time.process_time()
+            for poll in range(POLLS):
+                if poll % POLL_CHANGE_EVERY == POLL_CHANGE_EVERY - 1:
+                    CaseNote.objects.create(case=case, created_by=manager, content=f'Poll {poll}')
+                headers = {'HTTP_IF_NONE_MATCH': etag} if path == 'conditional' and etag else {}
+                response = client.get(url, **headers)
+                sent += len(response.content)
+                not_modified += response.status_code == 304
+                etag = response.get('ETag', etag)
+            total, cpu = time.perf_counter() - started, time.process_time() - cpu_started
+            results.append({
+                'path': f'{target} {path}', 'total_s': total, 'cpu_ms_per_poll': cpu * 1000 / POLLS,
+                'bytes': sent, 'not_modified': not_modified,
+            })
+    return results
+
+
+@benchmark('api_serialization', 'Serializing and encoding every case note and assessment, model serializers versus value rows, with the json module, orjson and MessagePack, by number of cases')
+def api_serialization_benchmark(size):
+    from rest_framework.renderers import JSONRenderer
+    from rest_framework.request import Request
+    from .models import AssessmentQuestion, CaseNote
+    from .renderers import FastJSONRenderer, MessagePackRenderer
+    from .serializers import AssessmentSerializer, CaseNoteSerializer
+
+    users = seed_case_records(size)
+    AssessmentQuestion.objects.bulk_create([
+        AssessmentQuestion(assessment_id=pk, text=f'Question {order}', question_type='text', order=order)
+        for pk in Assessment.objects.values_list('pk', flat=True) for order in range(3)
+    ], batch_size=SEED_BATCH_SIZE)
+    request = RequestFactory(SERVER_NAME='localhost').get('/api/')
+    request.user = users['admin']
+    context = {'request': Request(request)}
+
+    def from_instances(serializer_class):
+        queryset = serializer_class.setup_eager_loading(serializer_class.Meta.model.objects.all())
+        return serializer_class(queryset, many=True, context=context).data
+
+    def from_rows(serializer_class):
+        serializer = serializer_class(context=context)
+        return serializer.represent_rows(list(serializer.values_queryset(serializer_class.Meta.model.objects.all())))
+
+    paths = [
+        ('serializer json', from_instances, JSONRenderer()),
+        ('serializer orjson', from_instances, FastJSONRenderer()),
+        ('values orjson', from_rows, FastJSONRenderer()),
+    ]
+    if MessagePackRenderer.available:
+        paths.append(('values msgpack', from_rows, MessagePackRenderer()))
+
+    results = []
+    for entity, serializer_class in (('case_note', CaseNoteSerializer), ('assessment', AssessmentSerializer)):
+        for path, serialize, renderer in paths:
+            # Timed without memory tracing, which slows Python code down several times over
+            started = time.perf_counter()
+            data = serialize(serializer_class)
+            serialized = time.perf_counter()
+            body = renderer.render(data)
+            total = time.perf_counter() - started
+            with measure() as traced:
+                renderer.render(serialize(serializer_class))
+            results.append({
+                'path': f'{entity} {path}', 'objects': len(data), 'serialize_s': serialized - started,
+                'render_s': total - (serialized - started), 'total_s': total, 'peak_mb': traced['peak_mb'], 'bytes': len(body),
+            })
+    if not MessagePackRenderer.available:
+        results.append({'path': 'values msgpack', 'skipped': 'msgpack is not installed'})
+    return results
+
+
+EXPORT_PAGE_SIZE = 500
+
+
+@benchmark('ndjson_export', f'Downloading every beneficiary, following API cursor pages of {EXPORT_PAGE_SIZE} versus one NDJSON export, by number of beneficiaries')
+def ndjson_export_benchmark(size):
+    from django.test import Client
+
+    seed_beneficiaries(size)
+    client = Client(HTTP_HOST='localhost')
+    client.force_login(get_benchmark_user('partner_organisation'))
+
+    def page_through():
+        received, url = 0, f'/api/beneficiaries/?page_size={EXPORT_PAGE_SIZE}'
+        while url:
+            response = client.get(url)
+            received += len(response.content)
+            url = response.json()['next']
+        return received
+
+    def export():
+        response = client.get('/api/export/beneficiary.ndjson')
+        return sum(len(chunk) for chunk in response.streaming_content)
+
+    results = []
+    for path, download in (('api pages', page_through), ('ndjson export', export)):
+        # Timed without memory tracing, which slows Python code down several times over
+        started = time.perf_counter()
+        received = download()
+        total = time.perf_counter() - started
+        with measure() as traced:
+            download()
+        results.append({'path': path, 'total_s': total, 'peak_mb': traced['peak_mb'], 'bytes': received})
+    return results
+
+
+PROFILED_REQUESTS = 200
+
+
+@benchmark('request_profiling', f'{PROFILED_REQUESTS} case list page and API requests without the profiling middleware and sampling none, 5% and all of them, by number of cases')
+def request_profiling_benchmark(size):
+    from django.conf import settings
+    from django.test import Client, override_settings
+    from django.urls import reverse
+
+    users = seed_case_records(size)
+    without = [name for name in settings.MIDDLEWARE if name != 'core.profiling.QueryProfilingMiddleware']
+    paths = (
+        ('no middleware', {'MIDDLEWARE': without}),
+        ('sampling 0%', {'PROFILING_SAMPLE_RATE': 0}),
+        ('sampling 5%', {'PROFILING_SAMPLE_RATE': 0.05}),
+        ('sampling 100%', {'PROFILING_SAMPLE_RATE': 1}),
+    )
+
+    results = []
+    for target, url in (('page', reverse('case_list')), ('api', '/api/cases/')):
+        for path, overrides in paths:
+            # Slow requests are logged when profiled, which is not what is measured here
+            with override_settings(PROFILING_SLOW_REQUEST_MS=float('inf'), PROFILING_MAX_QUERIES=float('inf'),
+                                   PROFILING_REPEATED_QUERIES=float('inf'), **overrides):
+                client = Client(HTTP_HOST='localhost')
+                client.force_login(users['admin'])
+                client.get(url)
+                started = time.perf_counter()
+                for _ in range(PROFILED_REQUESTS):
+                    client.get(url)
+                total = time.perf_counter() - started
+            results.append({'path': f'{target} {path}', 'total_s': total, 'ms_per_request': total * 1000 / PROFILED_REQUESTS})
+    return results
+
+
+METRICS_REQUESTS = 200
+
+
+@benchmark('metrics', f'{METRICS_REQUESTS} case list requests with and without the metrics middleware, and scraping /metrics, by number of worker processes with metrics files')
+def metrics_benchmark(size):
+    import json
+    import os
+    import shutil
+    import tempfile
+    from django.conf import settings
+    from django.test import Client, override_settings
+    from django.urls import reverse
+    from .metrics import REGISTRY
+
+    users = seed_case_records(1000)
+    url = reverse('case_list')
+    directory = tempfile.mkdtemp()
+    without = [name for name in settings.MIDDLEWARE if name != 'core.metrics.MetricsMiddleware']
+
+    results = []
+    try:
+        with override_settings(METRICS_DIR=directory):
+            for path, middleware in (('no middleware', without), ('metrics middleware', settings.MIDDLEWARE)):
+                with override_settings(MIDDLEWARE=middleware):
+                    client = Client(HTTP_HOST='localhost')
+                    client.force_login(users['admin'])
+                    client.get(url)
+                    started = time.perf_counter()
+                    for _ in range(METRICS_REQUESTS):
+                        client.get(url)
+                    total = time.perf_counter() - started
+                results.append({'path': path, 'total_s': total, 'ms_per_request': total * 1000 / METRICS_REQUESTS})
+
+            # Other workers' files, with the series this process recorded
+            snapshot = REGISTRY.snapshot()
+            for pid in range(1, size + 1):
+                with open(os.path.join(directory, f'{pid}.json'), 'w') as output:
+                    json.dump(snapshot, output)
+            started = time.perf_counter()
+            body = client.get('/metrics').content
+            results.append({'path': 'scrape', 'total_s': time.perf_counter() - started, 'bytes': len(body)})
+    finally:
+        shutil.rmtree(directory)
+    return results
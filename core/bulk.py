@@ -0,0 +1,145 @@
+"""
+Bulk creation of case notes and assessments.
+
+Field officers upload the visits recorded offline in one request. The items
+are validated together, with the cases they refer to loaded in one query,
+and the valid ones are inserted with bulk_create in a single transaction.
+bulk_create sends no signals, so the tables kept up to date from them
+(dashboard counters, case contributors, the funding ledger, search
+documents and report data versions) are brought up to date here once for
+the whole batch. Category and program promotion then runs once per
+assessed beneficiary, from the ledger totals that include the whole batch,
+instead of once per assessment.
+"""
+from collections import Counter
+from dataclasses import dataclass, field
+
+from django.db import transaction
+from rest_framework.exceptions import ValidationError
+
+from .contributors import refresh_contributor
+from .counters import adjust_counter, get_counted_models, get_counter_keys
+from .funding import ZERO, get_totals_by_beneficiary, refresh_ledger
+from .models import Assessment, Beneficiary, Case, Program
+from .promotions import PromotionPlan, apply_promotions, get_category_index
+from .report_cache import bump_data_version, get_cached_models
+from .search import get_indexed_models, get_search_backend, get_search_index
+
+BULK_BATCH_SIZE = 500
+
+
+@dataclass
+class BulkResult:
+    """Created instances and the errors of rejected items, keyed by position in the upload"""
+    created: dict = field(default_factory=dict)
+    errors: dict = field(default_factory=dict)
+    promoted: int = 0
+
+
+def writable_cases(user):
+    """Cases `user` may add notes and assessments to, as the create forms allow"""
+    if user.role == 'case_manager':
+        return Case.objects.filter(case_manager=user)
+    return Case.objects.all()
+
+
+def _referenced_case_ids(items):
+    ids = set()
+    for item in items:
+        if isinstance(item, dict):
+            try:
+                ids.add(int(item.get('case')))
+            except (TypeError, ValueError):
+                pass
+    return ids
+
+
+def validate_items(serializer, items):
+    """[(position, validated data)] of the valid items and {position: errors} of the others"""
+    valid = []
+    errors = {}
+    for position, item in enumerate(items):
+        try:
+            valid.append((position, serializer.run_validation(item)))
+        except ValidationError as exc:
+            errors[position] = exc.detail
+    return valid, errors
+
+
+def update_maintained_tables(model, objects):
+    """Apply what the post_save handlers would have for each of the newly inserted `objects`"""
+    if model in get_counted_models():
+        deltas = Counter()
+        for obj in objects:
+            deltas.update(get_counter_keys(obj))
+        for key, delta in deltas.items():
+            adjust_counter(key, delta)
+
+    for user_id, case_id in {(obj.created_by_id, obj.case_id) for obj in objects}:
+        refresh_contributor(user_id, case_id)
+
+    if model is Assessment:
+        for beneficiary_id, year in {(obj.case.beneficiary_id, obj.year) for obj in objects}:
+            refresh_ledger(beneficiary_id, year)
+
+    if model in get_indexed_models():
+        created = model._default_manager.filter(pk__in=[obj.pk for obj in objects])
+        get_search_backend().update(get_search_index(model), created)
+
+    if model in get_cached_models():
+        bump_data_version(model)
+
+
+def promote_beneficiaries(assessments):
+    """
+    Promote each beneficiary assessed in the batch once, as saving the last
+    of their assessments in the upload would, returning the number changed.
+    """
+    incomes = {assessment.case.beneficiary_id: assessment.income_amount for assessment in assessments}
+    if not incomes:
+        return 0
+    totals = get_totals_by_beneficiary(list(incomes))
+    beneficiaries = list(
+        Beneficiary.objects.filter(pk__in=list(incomes)).values_list('pk', 'category_id', 'program_id')
+    )
+    next_programs = dict(
+        Program.objects.filter(pk__in={program_id for _, _, program_id in beneficiaries}, next_program__isnull=False)
+        .values_list('pk', 'next_program_id')
+    )
+    index = get_category_index()
+
+    plan = PromotionPlan()
+    for pk, category_id, program_id in beneficiaries:
+        plan.evaluated += 1
+        new_category = index.find_promotion(index.by_id.get(category_id), incomes[pk], totals.get(pk, ZERO))
+        if new_category is not None and new_category.pk != category_id:
+            plan.categories[pk] = new_category.pk
+            plan.category_moves[(category_id, new_category.pk)] += 1
+
+        next_program_id = next_programs.get(program_id)
+        if next_program_id is not None:
+            plan.programs[pk] = next_program_id
+            plan.program_moves[(program_id, next_program_id)] += 1
+    return apply_promotions(plan)
+
+
+def bulk_create_records(serializer_class, items, user):
+    """
+    Create a note or assessment, authored by `user`, from each valid one of
+    `items`, in one transaction. Invalid items are reported and skipped.
+    """
+    model = serializer_class.Meta.model
+    cases = writable_cases(user).in_bulk(_referenced_case_ids(items))
+    valid, errors = validate_items(serializer_class(context={'cases': cases}), items)
+
+    result = BulkResult(errors=errors)
+    objects = [model(created_by=user, **data) for _, data in valid]
+    if not objects:
+        return result
+    with transaction.atomic():
+        model._default_manager.bulk_create(objects, batch_size=BULK_BATCH_SIZE)
+        update_maintained_tables(model, objects)
+        if model is Assessment:
+            result.promoted = promote_beneficiaries(objects)
+    result.created = {position: obj for (position, _), obj in zip(valid, objects)}
+    return result
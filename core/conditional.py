@@ -0,0 +1,141 @@
+"""
+Conditional GET for detail pages and API retrieves.
+
+Clients polling a page or an API object get it re-rendered on every
+request, though it rarely changes between polls. Each conditional view
+names the rows it renders besides the object itself as `related`, a dict
+of model -> lookup from that model to the object (None for every row of a
+small table, or a tuple of lookups when the object reaches the model by
+several paths, such as the users it names). The latest `updated_at` and the number of those rows, so
+deletions count too, are read together with the object's own `updated_at`
+in one query of scalar subqueries. They make up the ETag and Last-Modified
+of the response, and a request whose If-None-Match or If-Modified-Since
+still matches gets a 304 before the object is serialized or the template
+rendered.
+
+HTML pages also carry the viewer's CSRF token in their forms and their
+name in the menu, so their ETags include the session, the CSRF secret and
+the viewer's own `updated_at`; a page cached before a login is rendered
+again rather than replayed with a token that no longer validates.
+"""
+import hashlib
+from functools import reduce
+from operator import or_
+
+from django.contrib.messages import get_messages
+from django.core.exceptions import ValidationError
+from django.middleware.csrf import get_token
+from django.db.models import Count, IntegerField, Max, OuterRef, Q, Subquery, Value
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date
+
+
+def _related_aggregates(model, lookup):
+    """Subqueries of the latest updated_at and the number of `model` rows pointing at the outer object"""
+    rows = model._default_manager.order_by()
+    if isinstance(lookup, str):
+        rows = rows.filter(**{lookup: OuterRef('pk')})
+    elif lookup is not None:
+        rows = rows.filter(reduce(or_, (Q(**{path: OuterRef('pk')}) for path in lookup)))
+    # Grouped by a constant, i.e. not at all, so each subquery is a single aggregate row
+    rows = rows.annotate(_all=Value(1)).values('_all')
+    return (
+        Subquery(rows.annotate(value=Max('updated_at')).values('value')),
+        Subquery(rows.annotate(value=Count('pk')).values('value'), output_field=IntegerField()),
+    )
+
+
+def get_validators(queryset, lookup, related, user=None, extra=()):
+    """
+    (ETag, last modified) of the object of `queryset` matching `lookup`
+    and of its `related` rows, or None if there is no such object. The ETag
+    also identifies `user`, whose name and role the page may show, and the
+    `extra` values.
+    """
+    annotations = {}
+    for idx, (model, path) in enumerate(related.items()):
+        annotations[f'_latest_{idx}'], annotations[f'_count_{idx}'] = _related_aggregates(model, path)
+    queryset = queryset.select_related(None).prefetch_related(None).order_by()
+    try:
+        row = queryset.filter(**lookup).annotate(**annotations).values('updated_at', *annotations).first()
+    except (TypeError, ValueError, ValidationError):
+        # A malformed id, left for the view to answer with its usual 404
+        return None
+    if row is None:
+        return None
+
+    parts = [row[name] for name in ['updated_at', *annotations]]
+    if user is not None:
+        parts += [user.pk, getattr(user, 'role', None), getattr(user, 'updated_at', None)]
+    parts += list(extra)
+    etag = 'W/"%s"' % hashlib.md5(repr(parts).encode()).hexdigest()
+    times = [row['updated_at']] + [row[name] for name in annotations if name.startswith('_latest_')]
+    last_modified = max(value for value in times if value is not None)
+    return etag, last_modified
+
+
+def conditional_response(request, validators, respond):
+    """
+    A 304 (or 412) if the request's preconditions show the client's copy
+    is current, otherwise the response of `respond()`. Either carries the
+    validators, and clients are told to revalidate before reusing it.
+    """
+    if validators is None:
+        return respond()
+    etag, last_modified = validators
+    timestamp = int(last_modified.timestamp())
+    response = get_conditional_response(request, etag=etag, last_modified=timestamp)
+    if response is None:
+        response = respond()
+    if response.status_code in (200, 304):
+        response.headers.setdefault('ETag', etag)
+        response.headers.setdefault('Last-Modified', http_date(timestamp))
+        patch_cache_control(response, private=True, no_cache=True)
+    return response
+
+
+def _csrf_secret(request):
+    """The CSRF secret the page's tokens are made from, created now if the client has none yet"""
+    get_token(request)
+    return request.META.get('CSRF_COOKIE')
+
+
+class ConditionalGetMixin:
+    """
+    Answers GET requests for a DetailView with 304 while the object and
+    the `conditional_related` rows are unchanged since the client's copy.
+    """
+    conditional_related = {}
+
+    def get(self, request, *args, **kwargs):
+        # Pending messages are shown on the page, so it is rendered to deliver them
+        if len(get_messages(request)):
+            return super().get(request, *args, **kwargs)
+        validators = get_validators(
+            self.get_queryset(), {'pk': self.kwargs.get(self.pk_url_kwarg)}, self.conditional_related, request.user,
+            # The form tokens the page carries
+            extra=(request.session.session_key, _csrf_secret(request)),
+        )
+
+        def render():
+            return super(ConditionalGetMixin, self).get(request, *args, **kwargs)
+        return conditional_response(request, validators, render)
+
+
+class ConditionalRetrieveMixin:
+    """
+    Answers API retrieves with 304 while the object and the
+    `conditional_related` rows its serializer reads are unchanged.
+    """
+    conditional_related = {}
+
+    def retrieve(self, request, *args, **kwargs):
+        lookup_url_kwarg = self.lookup_url_kwarg or self.lookup_field
+        validators = get_validators(
+            self.filter_queryset(self.get_queryset()), {self.lookup_field: self.kwargs[lookup_url_kwarg]},
+            self.conditional_related,
+        )
+
+        def serialize():
+            return super(ConditionalRetrieveMixin, self).retrieve(request, *args, **kwargs)
+        return conditional_response(request, validators, serialize)
@@ -0,0 +1,113 @@
+"""
+Case contributors.
+
+A field officer sees the cases they have written notes or assessments for.
+Rather than collecting those cases from both tables on every request, each
+(user, case) pair with contributions has a CaseContributor row holding the
+number of notes and assessments and the time of the first and last one, so
+visibility is a single indexed join. Created and deleted records are added
+to and subtracted from their row in place, rows affected by a record moved
+to another case or author are recomputed, all in the transaction that
+changes the record.
+"""
+from django.db import IntegrityError, transaction
+from django.db.models import Count, F, Max, Min, Value
+from django.db.models.functions import Greatest, Least
+
+from .models import Assessment, CaseContributor, CaseNote
+
+CONTRIBUTOR_BATCH_SIZE = 1000
+
+# Contribution model -> CaseContributor field counting it
+COUNT_FIELDS = {CaseNote: 'note_count', Assessment: 'assessment_count'}
+
+
+def add_contribution(record):
+    """Count a newly created note or assessment towards its author's row for the case"""
+    count_field = COUNT_FIELDS[type(record)]
+    at = record.created_at
+    rows = CaseContributor.objects.filter(user_id=record.created_by_id, case_id=record.case_id)
+    changes = {
+        count_field: F(count_field) + 1,
+        'first_contribution': Least('first_contribution', Value(at)),
+        'last_contribution': Greatest('last_contribution', Value(at)),
+    }
+    with transaction.atomic():
+        if rows.update(**changes):
+            return
+        try:
+            with transaction.atomic():
+                CaseContributor.objects.create(
+                    user_id=record.created_by_id, case_id=record.case_id,
+                    first_contribution=at, last_contribution=at, **{count_field: 1},
+                )
+        except IntegrityError:
+            # Another transaction created the row first
+            rows.update(**changes)
+
+
+def _contribution_span(user_id, case_id):
+    """Times of the first and last remaining contribution of a user to a case"""
+    times = []
+    for model in COUNT_FIELDS:
+        span = model.objects.filter(created_by_id=user_id, case_id=case_id).aggregate(
+            first=Min('created_at'), last=Max('created_at')
+        )
+        times.extend(value for value in span.values() if value is not None)
+    return (min(times), max(times)) if times else (None, None)
+
+
+def remove_contribution(record):
+    """Subtract a deleted note or assessment from its author's row for the case"""
+    count_field = COUNT_FIELDS[type(record)]
+    rows = CaseContributor.objects.filter(user_id=record.created_by_id, case_id=record.case_id)
+    with transaction.atomic():
+        # Rows are only updated or deleted here, never created, as the case
+        # itself may be in the middle of being deleted
+        rows.update(**{count_field: Greatest(F(count_field) - 1, Value(0))})
+        rows.filter(note_count=0, assessment_count=0).delete()
+        first, last = _contribution_span(record.created_by_id, record.case_id)
+        if first is not None:
+            rows.update(first_contribution=first, last_contribution=last)
+
+
+def _compute_rows(notes, assessments):
+    """CaseContributor rows of the given notes and assessments, keyed by (user id, case id)"""
+    rows = {}
+    for queryset, count_field in ((notes, 'note_count'), (assessments, 'assessment_count')):
+        grouped = (
+            queryset.order_by()
+            .values('created_by_id', 'case_id')
+            .annotate(count=Count('pk'), first=Min('created_at'), last=Max('created_at'))
+            .values_list('created_by_id', 'case_id', 'count', 'first', 'last')
+        )
+        for user_id, case_id, count, first, last in grouped.iterator(chunk_size=CONTRIBUTOR_BATCH_SIZE):
+            row = rows.get((user_id, case_id))
+            if row is None:
+                row = rows[(user_id, case_id)] = CaseContributor(
+                    user_id=user_id, case_id=case_id, first_contribution=first, last_contribution=last,
+                )
+            setattr(row, count_field, count)
+            row.first_contribution = min(row.first_contribution, first)
+            row.last_contribution = max(row.last_contribution, last)
+    return rows
+
+
+def refresh_contributor(user_id, case_id):
+    """Recompute the row of one user and case from their notes and assessments"""
+    rows = _compute_rows(
+        CaseNote.objects.filter(created_by_id=user_id, case_id=case_id),
+        Assessment.objects.filter(created_by_id=user_id, case_id=case_id),
+    )
+    with transaction.atomic():
+        CaseContributor.objects.filter(user_id=user_id, case_id=case_id).delete()
+        CaseContributor.objects.bulk_create(rows.values())
+
+
+def rebuild_contributors():
+    """Recompute every row from the notes and assessments, returning the number of rows written"""
+    rows = _compute_rows(CaseNote.objects.all(), Assessment.objects.all())
+    with transaction.atomic():
+        CaseContributor.objects.all().delete()
+        CaseContributor.objects.bulk_create(rows.values(), batch_size=CONTRIBUTOR_BATCH_SIZE)
+    return len(rows)
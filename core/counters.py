@@ -0,0 +1,262 @@
+"""
+Materialized dashboard counters.
+
+Counts shown on the dashboards are kept in DashboardCounter rows, one per
+counter and (for per-user counters) per user, so a dashboard reads a handful
+of rows by primary key instead of counting large tables. Rows are adjusted
+incrementally from model signals: before an instance is saved the counters
+its stored version contributes to are recorded, and after the save the
+difference to the counters the new version contributes to is applied.
+
+A counter row is only maintained once it exists. Missing rows are created
+at zero the first time they are read, so changes from then on are applied
+to them, and then computed from the source tables while the rows are
+locked against those changes. The `rebuild_counters` command recomputes
+every row for reconciliation.
+"""
+from collections import defaultdict
+
+from django.db import connection, transaction
+from django.db.models import Case as CaseExpression, Count, F, Q, Value, When
+
+from .models import (
+    User, Beneficiary, Case, CaseNote, Assessment, Program, BeneficiaryCategory, Report,
+    Referral, Alert, ActionPlan, BeneficiaryProgress, DashboardCounter
+)
+
+
+class Counter:
+    """
+    A count of `model` rows matching `condition`.
+
+    `owner` is the path of the user field for per-user counters, such as
+    `created_by` or `case__case_manager`. `matches` evaluates `condition` on a
+    single instance.
+    """
+
+    def __init__(self, name, model, owner=None, condition=None, matches=None):
+        self.name = name
+        self.model = model
+        self.owner = owner
+        self.condition = condition
+        self.matches = matches
+
+    def key(self, user=None):
+        if self.owner is None:
+            return self.name
+        user_id = user if isinstance(user, int) else user.pk
+        return f'{self.name}:{user_id}'
+
+    def get_owner_id(self, instance):
+        """Id of the user `instance` counts towards, looked up through relations if needed"""
+        first, _, rest = self.owner.partition('__')
+        related_id = getattr(instance, f'{first}_id')
+        if not rest or related_id is None:
+            return related_id
+        related_model = self.model._meta.get_field(first).related_model
+        return related_model.objects.filter(pk=related_id).values_list(f'{rest}_id', flat=True).first()
+
+    def keys_for(self, instance):
+        """Counter keys `instance` contributes to"""
+        if self.matches is not None and not self.matches(instance):
+            return set()
+        if self.owner is None:
+            return {self.name}
+        owner_id = self.get_owner_id(instance)
+        return {self.key(owner_id)} if owner_id is not None else set()
+
+    def count_filter(self, user_id=None):
+        """Q selecting the rows counted under the key for `user_id`"""
+        condition = self.condition or Q()
+        if self.owner is not None:
+            condition &= Q(**{self.owner: user_id})
+        return condition
+
+
+COUNTERS = [
+    Counter('users', User),
+    Counter('beneficiaries', Beneficiary),
+    Counter('programs', Program),
+    Counter('categories', BeneficiaryCategory),
+    Counter('cases', Case),
+    Counter('open_cases', Case, condition=Q(status='open'), matches=lambda case: case.status == 'open'),
+    Counter('managed_open_cases', Case, owner='case_manager',
+            condition=Q(status='open'), matches=lambda case: case.status == 'open'),
+    Counter('assessments', Assessment),
+    Counter('created_assessments', Assessment, owner='created_by'),
+    Counter('created_case_notes', CaseNote, owner='created_by'),
+    Counter('action_plans', ActionPlan),
+    Counter('created_action_plans', ActionPlan, owner='created_by'),
+    Counter('progress_records', BeneficiaryProgress),
+    Counter('managed_progress_records', BeneficiaryProgress, owner='case__case_manager'),
+    Counter('referrals_made', Referral, owner='referred_by'),
+    Counter('referrals_received', Referral, owner='referred_to_user'),
+    Counter('created_reports', Report, owner='created_by'),
+    Counter('unread_alerts', Alert, owner='user',
+            condition=Q(is_read=False), matches=lambda alert: not alert.is_read),
+]
+
+COUNTERS_BY_NAME = {counter.name: counter for counter in COUNTERS}
+
+
+def count_all(**counters):
+    """
+    Evaluate named counts in one query.
+
+    Each keyword maps a name to a `(model, condition)` pair, where `condition`
+    is a Q object or None to count every row. Counts on the same table become
+    conditional COUNTs of one aggregate, and the per-table aggregates are
+    cross joined as one-row derived tables.
+    """
+    by_model = defaultdict(dict)
+    for name, (model, condition) in counters.items():
+        by_model[model][name] = Count('pk', filter=condition) if condition is not None else Count('pk')
+
+    tables = []
+    params = []
+    for idx, (model, aggregates) in enumerate(by_model.items()):
+        # Grouping on a constant collapses the table to a single aggregate row
+        queryset = (
+            model._default_manager.order_by()
+            .annotate(_dashboard=Value(1)).values('_dashboard')
+            .annotate(**aggregates).values(*aggregates)
+        )
+        sql, table_params = queryset.query.sql_with_params()
+        tables.append(f'({sql}) counters_{idx}')
+        params.extend(table_params)
+
+    with connection.cursor() as cursor:
+        cursor.execute(f"SELECT * FROM {', '.join(tables)}", params)
+        row = cursor.fetchone()
+        names = [column[0] for column in cursor.description]
+    return dict(zip(names, row))
+
+
+def get_counted_models():
+    return {counter.model for counter in COUNTERS}
+
+
+def counter_key(name, user=None):
+    """Key of counter `name`, for `user` if it is a per-user counter"""
+    return COUNTERS_BY_NAME[name].key(user)
+
+
+def _parse_key(key):
+    name, _, user_id = key.partition(':')
+    return COUNTERS_BY_NAME[name], int(user_id) if user_id else None
+
+
+def get_counter_keys(instance):
+    """Every counter key `instance` contributes to"""
+    keys = set()
+    for counter in COUNTERS:
+        if isinstance(instance, counter.model):
+            keys |= counter.keys_for(instance)
+    return keys
+
+
+def get_stored_counter_keys(instance):
+    """
+    Counter keys the stored version of `instance` contributes to.
+
+    Only counters that depend on field values can change on update, so the
+    stored row is not fetched for models that are counted unconditionally.
+    """
+    if instance._state.adding or instance.pk is None:
+        return set()
+    if not any(
+        isinstance(instance, counter.model) and (counter.owner or counter.matches)
+        for counter in COUNTERS
+    ):
+        return get_counter_keys(instance)
+    stored = type(instance)._default_manager.filter(pk=instance.pk).first()
+    return get_counter_keys(stored) if stored is not None else set()
+
+
+def apply_counter_changes(old_keys, new_keys):
+    """Move one unit from the counters only in `old_keys` to those only in `new_keys`"""
+    removed = old_keys - new_keys
+    added = new_keys - old_keys
+    if removed:
+        DashboardCounter.objects.filter(key__in=removed).update(value=F('value') - 1)
+    if added:
+        DashboardCounter.objects.filter(key__in=added).update(value=F('value') + 1)
+
+
+def adjust_counter(key, delta):
+    """Add `delta` to a maintained counter"""
+    DashboardCounter.objects.filter(key=key).update(value=F('value') + delta)
+
+
+def set_counter(key, value):
+    """Overwrite a maintained counter, e.g. after a bulk update that bypassed signals"""
+    DashboardCounter.objects.filter(key=key).update(value=value)
+
+
+def compute_counters(keys):
+    """Count the source rows of `keys` in a single query"""
+    aliases = {}
+    counters = {}
+    for idx, key in enumerate(keys):
+        counter, user_id = _parse_key(key)
+        alias = f'counter_{idx}'
+        aliases[alias] = key
+        counters[alias] = (counter.model, counter.count_filter(user_id))
+    if not counters:
+        return {}
+    return {aliases[alias]: value for alias, value in count_all(**counters).items()}
+
+
+def read_counters(**keys):
+    """
+    Read counters by key, keyed by the given names.
+
+    Rows that do not exist yet are computed from the source tables and stored,
+    after which they are maintained from signals.
+    """
+    values = dict(DashboardCounter.objects.filter(key__in=keys.values()).values_list('key', 'value'))
+    missing = [key for key in set(keys.values()) if key not in values]
+    if missing:
+        values.update(_initialize_counters(missing))
+    return {name: values[key] for name, key in keys.items()}
+
+
+def _initialize_counters(keys):
+    """
+    Create and compute the rows of `keys`. Created before counting, a change
+    that commits while the rows are computed is applied to them rather than
+    lost, and writing them first locks them, so a change waits for the count
+    instead of being counted twice.
+    """
+    DashboardCounter.objects.bulk_create([DashboardCounter(key=key, value=0) for key in keys], ignore_conflicts=True)
+    with transaction.atomic():
+        # An update rather than select_for_update(), which SQLite ignores
+        DashboardCounter.objects.filter(key__in=keys).update(value=0)
+        computed = compute_counters(keys)
+        DashboardCounter.objects.filter(key__in=keys).update(value=CaseExpression(
+            *[When(key=key, then=Value(value)) for key, value in computed.items()], default=Value(0),
+        ))
+    return computed
+
+
+def rebuild_counters():
+    """Recompute every counter from the source tables, returning the number of rows written"""
+    rows = []
+    for counter in COUNTERS:
+        queryset = counter.model._default_manager.order_by()
+        if counter.owner is None:
+            rows.append(DashboardCounter(key=counter.name, value=queryset.filter(counter.count_filter()).count()))
+            continue
+        grouped = (
+            queryset.filter(counter.condition or Q())
+            .exclude(**{counter.owner: None})
+            .values(counter.owner)
+            .annotate(total=Count('pk'))
+            .values_list(counter.owner, 'total')
+        )
+        rows.extend(DashboardCounter(key=counter.key(user_id), value=total) for user_id, total in grouped)
+
+    with transaction.atomic():
+        DashboardCounter.objects.all().delete()
+        DashboardCounter.objects.bulk_create(rows, batch_size=1000)
+    return len(rows)
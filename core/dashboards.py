@@ -0,0 +1,144 @@
+"""
+Data layer for the role dashboards.
+
+Dashboard card counters are read from the materialized counters in
+core/counters.py, a single lookup of a few rows by key however large the
+underlying tables are. Recent item lists select the related rows their
+templates display.
+"""
+import functools
+import logging
+
+from django.db import connection
+from django.db.models import Count
+
+from .counters import counter_key, read_counters
+from .models import (
+    Case, CaseNote, Assessment, Program, BeneficiaryCategory, Report,
+    Referral, Alert, ActionPlan, BeneficiaryProgress
+)
+
+logger = logging.getLogger(__name__)
+
+RECENT_LIMIT = 10
+
+
+def track_queries(view):
+    """Log how many queries a dashboard view issues and expose it as a header"""
+    @functools.wraps(view)
+    def wrapper(request, *args, **kwargs):
+        queries = []
+
+        def counter(execute, sql, params, many, context):
+            queries.append(sql)
+            return execute(sql, params, many, context)
+
+        with connection.execute_wrapper(counter):
+            response = view(request, *args, **kwargs)
+        logger.debug('%s issued %d queries', view.__name__, len(queries))
+        response['X-Query-Count'] = str(len(queries))
+        return response
+    return wrapper
+
+
+def get_admin_dashboard(user):
+    context = read_counters(
+        user_count=counter_key('users'),
+        beneficiary_count=counter_key('beneficiaries'),
+        active_case_count=counter_key('open_cases'),
+        assessment_count=counter_key('assessments'),
+        program_count=counter_key('programs'),
+        category_count=counter_key('categories'),
+    )
+    context.update({
+        'recent_cases': Case.objects.select_related('beneficiary', 'case_manager').order_by('-created_at')[:RECENT_LIMIT],
+        'recent_programs': Program.objects.all().order_by('-id')[:5],
+        'recent_categories': BeneficiaryCategory.objects.all().order_by('-id')[:5],
+    })
+    return context
+
+
+def get_case_manager_dashboard(user):
+    context = read_counters(
+        active_case_count=counter_key('managed_open_cases', user),
+        beneficiary_count=counter_key('beneficiaries'),
+        assessment_count=counter_key('created_assessments', user),
+        program_count=counter_key('programs'),
+        category_count=counter_key('categories'),
+        action_plan_count=counter_key('created_action_plans', user),
+        progress_count=counter_key('managed_progress_records', user),
+    )
+    context.update({
+        'my_cases': Case.objects.filter(case_manager=user).select_related('beneficiary').order_by('-created_at')[:RECENT_LIMIT],
+        'recent_notes': CaseNote.objects.filter(created_by=user).select_related('case').order_by('-created_at')[:RECENT_LIMIT],
+        'recent_action_plans': ActionPlan.objects.filter(created_by=user).select_related('case__beneficiary').order_by('-created_at')[:RECENT_LIMIT],
+        'recent_progress': BeneficiaryProgress.objects.filter(case__case_manager=user).select_related('beneficiary', 'case').order_by('-date')[:RECENT_LIMIT],
+        'recent_programs': Program.objects.all().order_by('-id')[:5],
+        'recent_categories': BeneficiaryCategory.objects.all().order_by('-id')[:5],
+    })
+    return context
+
+
+def get_field_officer_dashboard(user):
+    context = read_counters(
+        assessment_count=counter_key('created_assessments', user),
+        case_note_count=counter_key('created_case_notes', user),
+        beneficiary_count=counter_key('beneficiaries'),
+        referral_count=counter_key('referrals_made', user),
+    )
+    context.update({
+        'recent_assessments': Assessment.objects.filter(created_by=user).select_related('case__beneficiary').order_by('-created_at')[:RECENT_LIMIT],
+        'recent_notes': CaseNote.objects.filter(created_by=user).select_related('case__beneficiary').order_by('-created_at')[:RECENT_LIMIT],
+        'recent_referrals': Referral.objects.filter(referred_by=user).select_related('beneficiary').order_by('-created_at')[:RECENT_LIMIT],
+    })
+    return context
+
+
+def get_partner_organisation_dashboard(user):
+    context = read_counters(
+        referral_count=counter_key('referrals_made', user),
+        received_referral_count=counter_key('referrals_received', user),
+        report_count=counter_key('created_reports', user),
+        beneficiary_count=counter_key('beneficiaries'),
+    )
+    context.update({
+        'recent_referrals': Referral.objects.filter(referred_by=user).select_related('beneficiary').order_by('-created_at')[:RECENT_LIMIT],
+        'recent_received_referrals': Referral.objects.filter(referred_to_user=user).select_related('beneficiary', 'referred_by').order_by('-created_at')[:RECENT_LIMIT],
+        'recent_reports': Report.objects.filter(created_by=user).select_related('template').order_by('-created_at')[:RECENT_LIMIT],
+    })
+    return context
+
+
+def get_monitoring_and_evaluation_dashboard(user):
+    context = read_counters(
+        beneficiary_count=counter_key('beneficiaries'),
+        case_count=counter_key('cases'),
+        assessment_count=counter_key('assessments'),
+        report_count=counter_key('created_reports', user),
+        action_plan_count=counter_key('action_plans'),
+        progress_count=counter_key('progress_records'),
+    )
+    context.update({
+        'recent_cases': Case.objects.select_related('beneficiary', 'case_manager').order_by('-created_at')[:RECENT_LIMIT],
+        'recent_assessments': Assessment.objects.select_related('case__beneficiary', 'created_by').order_by('-created_at')[:RECENT_LIMIT],
+        'recent_reports': Report.objects.filter(created_by=user).select_related('template').order_by('-created_at')[:RECENT_LIMIT],
+        'recent_action_plans': ActionPlan.objects.select_related('case__beneficiary').order_by('-created_at')[:RECENT_LIMIT],
+        'recent_progress': BeneficiaryProgress.objects.select_related('beneficiary', 'case').order_by('-date')[:RECENT_LIMIT],
+    })
+    return context
+
+
+def get_program_director_dashboard(user):
+    context = read_counters(
+        beneficiary_count=counter_key('beneficiaries'),
+        program_count=counter_key('programs'),
+        case_count=counter_key('cases'),
+        report_count=counter_key('created_reports', user),
+        alert_count=counter_key('unread_alerts', user),
+    )
+    context.update({
+        'recent_programs': Program.objects.annotate(beneficiary_count=Count('beneficiaries')).order_by('-id')[:RECENT_LIMIT],
+        'recent_reports': Report.objects.filter(created_by=user).select_related('template').order_by('-created_at')[:RECENT_LIMIT],
+        'unread_alerts': Alert.objects.filter(user=user, is_read=False).order_by('-created_at')[:RECENT_LIMIT],
+    })
+    return context
@@ -0,0 +1,178 @@
+"""
+Beneficiary funding ledger.
+
+What beneficiaries received through their assessments is rolled up into
+BeneficiaryFundingLedger rows, one per beneficiary and assessment year
+holding the total received, the number of assessments and the income of the
+latest one. Created and deleted assessments are added to and subtracted
+from their (beneficiary, year) row in place, and rows touched by an edited
+assessment are recomputed from the assessments, all in the transaction that
+changes the assessment. Totals are then read from a handful of rollup rows
+instead of scanning assessments.
+
+Ledger rows are written with update() and bulk_create(), which send no
+model signals, so every write bumps the ledger's report data version itself.
+"""
+from decimal import Decimal
+
+from django.db import IntegrityError, transaction
+from django.db.models import Count, DecimalField, F, OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from .models import Assessment, BeneficiaryFundingLedger
+from .report_cache import bump_data_version
+
+ZERO = Decimal('0.00')
+
+LEDGER_BATCH_SIZE = 1000
+
+
+def _money_sum(field):
+    return Coalesce(Sum(field), Value(ZERO), output_field=DecimalField(max_digits=12, decimal_places=2))
+
+
+def _money(value):
+    # SQLite sums decimals as floats, so round back to cents
+    return Decimal(value).quantize(ZERO)
+
+
+def _beneficiary_ledger(beneficiary, year=None):
+    beneficiary_id = getattr(beneficiary, 'pk', beneficiary)
+    ledger = BeneficiaryFundingLedger.objects.filter(beneficiary_id=beneficiary_id).order_by()
+    if year is not None:
+        ledger = ledger.filter(year=year)
+    return ledger
+
+
+def get_total_received(beneficiary, year=None):
+    """Total amount received by `beneficiary` (an instance or id), in `year` if given"""
+    return _money(_beneficiary_ledger(beneficiary, year).aggregate(total=_money_sum('total_received'))['total'])
+
+
+def get_yearly_totals(beneficiary):
+    """Amount received by `beneficiary` per assessment year, oldest first"""
+    rows = _beneficiary_ledger(beneficiary).order_by('year').values_list('year', 'total_received')
+    return {year: _money(total) for year, total in rows}
+
+
+def get_totals_by_beneficiary(beneficiary_ids=None, year=None):
+    """Total amount received per beneficiary id, in one grouped query"""
+    ledger = BeneficiaryFundingLedger.objects.order_by()
+    if beneficiary_ids is not None:
+        ledger = ledger.filter(beneficiary_id__in=beneficiary_ids)
+    if year is not None:
+        ledger = ledger.filter(year=year)
+    rows = (
+        ledger.values('beneficiary_id')
+        .annotate(total=_money_sum('total_received'))
+        .values_list('beneficiary_id', 'total')
+    )
+    return {beneficiary_id: _money(total) for beneficiary_id, total in rows}
+
+
+def get_category_totals(category, year):
+    """Amount received in `year` per beneficiary id of `category`, for beneficiaries with assessments that year"""
+    rows = BeneficiaryFundingLedger.objects.filter(
+        beneficiary__category=category, year=year
+    ).values_list('beneficiary_id', 'total_received')
+    return {beneficiary_id: _money(total) for beneficiary_id, total in rows}
+
+
+def _latest_income(beneficiary_ref, year_ref):
+    """Income of the latest assessment of a beneficiary in a year, as a subquery"""
+    return Subquery(
+        Assessment.objects.filter(case__beneficiary_id=beneficiary_ref, year=year_ref)
+        .order_by('-created_at', '-pk')
+        .values('income_amount')[:1]
+    )
+
+
+def _compute_ledger_rows(assessments):
+    """Ledger rows of `assessments`, aggregated per beneficiary and year in one query"""
+    latest_income = _latest_income(OuterRef('case__beneficiary_id'), OuterRef('year'))
+    grouped = (
+        assessments.order_by()
+        .values('case__beneficiary_id', 'year')
+        .annotate(
+            total=_money_sum('amount_received'),
+            count=Count('pk'),
+            last_income=latest_income,
+        )
+        .values_list('case__beneficiary_id', 'year', 'total', 'count', 'last_income')
+    )
+    for beneficiary_id, year, total, count, last_income in grouped.iterator(chunk_size=LEDGER_BATCH_SIZE):
+        yield BeneficiaryFundingLedger(
+            beneficiary_id=beneficiary_id, year=year, total_received=_money(total),
+            assessment_count=count, last_income=last_income or ZERO,
+        )
+
+
+def add_to_ledger(beneficiary_id, assessment):
+    """Add a newly created assessment to its ledger row"""
+    amount = Decimal(str(assessment.amount_received))
+    ledger = BeneficiaryFundingLedger.objects.filter(beneficiary_id=beneficiary_id, year=assessment.year)
+    changes = {
+        'total_received': F('total_received') + amount,
+        'assessment_count': F('assessment_count') + 1,
+        'last_income': assessment.income_amount,
+        'updated_at': timezone.now(),
+    }
+    with transaction.atomic():
+        bump_data_version(BeneficiaryFundingLedger)
+        if ledger.update(**changes):
+            return
+        try:
+            with transaction.atomic():
+                BeneficiaryFundingLedger.objects.create(
+                    beneficiary_id=beneficiary_id, year=assessment.year, total_received=amount,
+                    assessment_count=1, last_income=assessment.income_amount,
+                )
+        except IntegrityError:
+            # Another transaction created the row first
+            ledger.update(**changes)
+
+
+def remove_from_ledger(beneficiary_id, assessment):
+    """Subtract a deleted assessment from its ledger row"""
+    ledger = BeneficiaryFundingLedger.objects.filter(beneficiary_id=beneficiary_id, year=assessment.year)
+    with transaction.atomic():
+        bump_data_version(BeneficiaryFundingLedger)
+        ledger.update(
+            total_received=F('total_received') - Decimal(str(assessment.amount_received)),
+            assessment_count=F('assessment_count') - 1,
+            last_income=Coalesce(_latest_income(beneficiary_id, assessment.year), Value(ZERO)),
+            updated_at=timezone.now(),
+        )
+        ledger.filter(assessment_count__lte=0).delete()
+
+
+def refresh_ledger(beneficiary_id, year=None):
+    """Recompute the ledger rows of one beneficiary, or only its row for `year`"""
+    assessments = Assessment.objects.filter(case__beneficiary_id=beneficiary_id)
+    ledger = BeneficiaryFundingLedger.objects.filter(beneficiary_id=beneficiary_id)
+    if year is not None:
+        assessments = assessments.filter(year=year)
+        ledger = ledger.filter(year=year)
+    with transaction.atomic():
+        bump_data_version(BeneficiaryFundingLedger)
+        ledger.delete()
+        BeneficiaryFundingLedger.objects.bulk_create(_compute_ledger_rows(assessments))
+
+
+def rebuild_ledger():
+    """Recompute the whole ledger from the assessments, returning the number of rows written"""
+    written = 0
+    with transaction.atomic():
+        bump_data_version(BeneficiaryFundingLedger)
+        BeneficiaryFundingLedger.objects.all().delete()
+        batch = []
+        for row in _compute_ledger_rows(Assessment.objects.all()):
+            batch.append(row)
+            if len(batch) >= LEDGER_BATCH_SIZE:
+                BeneficiaryFundingLedger.objects.bulk_create(batch)
+                written += len(batch)
+                batch = []
+        BeneficiaryFundingLedger.objects.bulk_create(batch)
+        written += len(batch)
+    return written
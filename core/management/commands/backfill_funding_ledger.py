@@ -0,0 +1,15 @@
+import time
+
+from django.core.management.base import BaseCommand
+from core.funding import rebuild_ledger
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds the per-beneficiary yearly funding ledger from the assessments'
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        written = rebuild_ledger()
+        self.stdout.write(self.style.SUCCESS(
+            f'Wrote {written} funding ledger rows in {time.perf_counter() - started:.2f}s.'
+        ))
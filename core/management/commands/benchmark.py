@@ -0,0 +1,44 @@
+from django.core.management.base import BaseCommand, CommandError
+from core.benchmarks import BENCHMARKS, benchmark_database
+
+
+class Command(BaseCommand):
+    help = 'Runs a performance benchmark scenario against a throwaway test database'
+
+    def add_arguments(self, parser):
+        parser.add_argument('scenario', nargs='?', help='Name of the scenario to run (omit to list scenarios)')
+        parser.add_argument(
+            '--sizes', nargs='+', type=int, default=[10000, 100000, 1000000],
+            help='Data sizes to run the scenario at, smallest first'
+        )
+
+    def handle(self, *args, **options):
+        scenario = options['scenario']
+        if not scenario:
+            for name, (_, description) in sorted(BENCHMARKS.items()):
+                self.stdout.write(f'{name:<24} {description}')
+            return
+
+        if scenario not in BENCHMARKS:
+            raise CommandError(f"Unknown scenario '{scenario}'. Available: {', '.join(sorted(BENCHMARKS))}")
+
+        func, description = BENCHMARKS[scenario]
+        self.stdout.write(f'{scenario}: {description}')
+
+        # Sizes share one database so data is only ever added, never rebuilt
+        with benchmark_database():
+            for size in sorted(options['sizes']):
+                self.stdout.write(self.style.MIGRATE_HEADING(f'\nsize={size}'))
+                for result in func(size):
+                    self.stdout.write('  ' + '  '.join(
+                        f'{key}={self._format(value)}' for key, value in result.items()
+                    ))
+
+        self.stdout.write(self.style.SUCCESS('\nBenchmark complete.'))
+
+    def _format(self, value):
+        if isinstance(value, float):
+            return f'{value:.4f}'
+        if value is None:
+            return '-'
+        return str(value)
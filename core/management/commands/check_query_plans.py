@@ -0,0 +1,41 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from core.benchmarks import benchmark_database, seed_case_records
+from core.query_plans import check_query_plans, explain, hot_queries
+
+
+class Command(BaseCommand):
+    help = 'Fails if a list view, dashboard or worker query reads a whole table, checked against a throwaway test database'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--size', type=int, default=20000, help='Number of cases to seed before explaining the queries')
+        parser.add_argument('--verbose-plans', action='store_true', help='Print the plan of every query, not only failing ones')
+
+    def handle(self, *args, **options):
+        if connection.vendor != 'sqlite':
+            raise CommandError('Query plans can only be checked on SQLite.')
+
+        started = time.perf_counter()
+        with benchmark_database():
+            users = list(seed_case_records(options['size']).values())
+            with connection.cursor() as cursor:
+                cursor.execute('ANALYZE')
+            self.stdout.write(f"Seeded {options['size']} cases in {time.perf_counter() - started:.2f}s.")
+
+            if options['verbose_plans']:
+                for label, queryset in hot_queries(users):
+                    self.stdout.write(self.style.MIGRATE_HEADING(label))
+                    for line in explain(queryset):
+                        self.stdout.write(f'  {line}')
+
+            problems = check_query_plans(users)
+
+        for label, scans, plan in problems:
+            self.stdout.write(self.style.ERROR(f'{label}: {"; ".join(scans)}'))
+            for line in plan:
+                self.stdout.write(f'  {line}')
+        if problems:
+            raise CommandError(f'{len(problems)} queries read a whole table.')
+        self.stdout.write(self.style.SUCCESS('No full table scans in the hot queries.'))
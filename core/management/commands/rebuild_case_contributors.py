@@ -0,0 +1,15 @@
+import time
+
+from django.core.management.base import BaseCommand
+from core.contributors import rebuild_contributors
+
+
+class Command(BaseCommand):
+    help = 'Recomputes which users contributed notes or assessments to which cases'
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        written = rebuild_contributors()
+        self.stdout.write(self.style.SUCCESS(
+            f'Wrote {written} case contributor rows in {time.perf_counter() - started:.2f}s.'
+        ))
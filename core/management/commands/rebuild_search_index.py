@@ -0,0 +1,19 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from core.search import rebuild_search_index
+
+
+class Command(BaseCommand):
+    help = 'Recreates the full-text search documents of beneficiaries, cases, case notes, referrals and action plans'
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        with transaction.atomic():
+            written = rebuild_search_index()
+        for name, count in written.items():
+            self.stdout.write(f'{name}: {count} documents')
+        self.stdout.write(self.style.SUCCESS(
+            f'Rebuilt the search index in {time.perf_counter() - started:.2f}s.'
+        ))
@@ -0,0 +1,51 @@
+import time
+
+from django.core.management.base import BaseCommand
+from core.models import BeneficiaryCategory, Program
+from core.promotions import PROMOTION_CHUNK_SIZE, apply_promotions, plan_promotions
+
+
+class Command(BaseCommand):
+    help = 'Re-evaluates category (and optionally program) promotions for every assessed beneficiary'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help='Report the changes without saving them')
+        parser.add_argument(
+            '--programs', action='store_true',
+            help='Also move beneficiaries on to the next program of their current one'
+        )
+        parser.add_argument(
+            '--chunk-size', type=int, default=PROMOTION_CHUNK_SIZE,
+            help='Rows read and updated per database round trip'
+        )
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        plan = plan_promotions(include_programs=options['programs'], chunk_size=options['chunk_size'])
+        evaluated_in = time.perf_counter() - started
+
+        category_names = dict(BeneficiaryCategory.objects.values_list('pk', 'name'))
+        program_names = dict(Program.objects.values_list('pk', 'name'))
+        self._write_moves('Category changes', plan.category_moves, category_names)
+        if options['programs']:
+            self._write_moves('Program changes', plan.program_moves, program_names)
+
+        rate = plan.evaluated / evaluated_in if evaluated_in else 0
+        self.stdout.write(
+            f'Evaluated {plan.evaluated} beneficiaries in {evaluated_in:.2f}s ({rate:,.0f} beneficiaries/s).'
+        )
+
+        if options['dry_run']:
+            self.stdout.write(self.style.WARNING('Dry run: no changes saved.'))
+            return
+
+        changed = apply_promotions(plan, chunk_size=options['chunk_size'])
+        total = time.perf_counter() - started
+        self.stdout.write(self.style.SUCCESS(
+            f'Updated {changed} beneficiaries in {total:.2f}s ({plan.evaluated / total if total else 0:,.0f} beneficiaries/s overall).'
+        ))
+
+    def _write_moves(self, heading, moves, names):
+        self.stdout.write(f'{heading}: {sum(moves.values())}')
+        for (old, new), count in sorted(moves.items(), key=lambda item: -item[1]):
+            self.stdout.write(f'  {names.get(old, "None")} -> {names.get(new, "None")}: {count}')
@@ -0,0 +1,102 @@
+import time
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+
+import django
+from django.core.management.base import BaseCommand
+from django.db import connections
+from core.models import ReportRun
+from core.reports import (
+    claim_report_run, execute_report_run, fail_report_run, fail_stale_report_runs, release_report_run,
+)
+
+
+def _init_worker():
+    """Make sure a pool process never reuses the parent's database connections"""
+    django.setup()
+    for conn in connections.all():
+        conn.close()
+
+
+class Command(BaseCommand):
+    help = 'Generates queued background report runs using a local pool of worker processes'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=2, help='Number of reports generated in parallel')
+        parser.add_argument('--poll-interval', type=float, default=2.0, help='Seconds between checks for new runs')
+        parser.add_argument('--once', action='store_true', help='Exit once the queue is empty')
+
+    def handle(self, *args, **options):
+        workers = max(1, options['workers'])
+        poll_interval = options['poll_interval']
+
+        # Forked workers must not inherit open connections
+        connections.close_all()
+
+        self.stdout.write(f'Report worker started with {workers} process(es).')
+        in_flight = {}
+        pool = ProcessPoolExecutor(max_workers=workers, initializer=_init_worker)
+        try:
+            while True:
+                stale = fail_stale_report_runs(exclude=in_flight.values())
+                if stale:
+                    self.stdout.write(self.style.WARNING(f'Failed {stale} report run(s) left by a stopped worker'))
+
+                free = workers - len(in_flight)
+                if free:
+                    queued = ReportRun.objects.filter(status='queued').order_by('created_at')
+                    for run_id in queued.values_list('id', flat=True)[:free]:
+                        if not claim_report_run(run_id):
+                            continue
+                        try:
+                            in_flight[pool.submit(execute_report_run, run_id)] = run_id
+                        except BrokenProcessPool:
+                            release_report_run(run_id)
+                            pool = self.restart_pool(pool, workers)
+                            break
+                        self.stdout.write(f'Started report run {run_id}')
+
+                if not in_flight:
+                    if options['once']:
+                        break
+                    time.sleep(poll_interval)
+                    continue
+
+                done, _ = wait(in_flight, timeout=poll_interval, return_when=FIRST_COMPLETED)
+                broken = False
+                for future in done:
+                    broken |= self.finish(in_flight.pop(future), future)
+                if broken:
+                    # Every run still in the pool ends with it
+                    for future in wait(in_flight).done:
+                        self.finish(in_flight.pop(future), future)
+                    pool = self.restart_pool(pool, workers)
+        except KeyboardInterrupt:
+            self.stdout.write('Stopping report worker...')
+        finally:
+            pool.shutdown()
+
+        self.stdout.write(self.style.SUCCESS('Report worker stopped.'))
+
+    def finish(self, run_id, future):
+        """Report how a run ended, failing it if its process raised or died. Returns whether the pool broke"""
+        error = future.exception()
+        if error is not None:
+            fail_report_run(run_id, error)
+            self.stdout.write(self.style.ERROR(f'Report run {run_id} failed: {error}'))
+            return isinstance(error, BrokenProcessPool)
+        run = ReportRun.objects.get(pk=run_id)
+        if run.status == 'completed':
+            self.stdout.write(self.style.SUCCESS(
+                f'Finished report run {run_id}: {run.row_count} rows in {run.duration}'
+            ))
+        else:
+            self.stdout.write(self.style.ERROR(f'Report run {run_id} failed: {run.error}'))
+        return False
+
+    def restart_pool(self, pool, workers):
+        """A new pool in place of one whose process died"""
+        self.stdout.write(self.style.WARNING('A report worker process died, starting new ones'))
+        pool.shutdown(wait=False)
+        connections.close_all()
+        return ProcessPoolExecutor(max_workers=workers, initializer=_init_worker)
@@ -0,0 +1,452 @@
+"""
+Prometheus metrics.
+
+Request latency and query counts by URL name, report generation times and
+promotions are recorded in an in-process registry and served in the
+Prometheus text format at /metrics, to scrapers sending METRICS_TOKEN.
+
+Every process records its own values. With METRICS_DIR set, the processes
+that serve, gunicorn workers and the report worker's pool processes, also
+write their values to a file of their own there, at most every
+METRICS_FLUSH_INTERVAL seconds while serving requests, after each
+background report, and on exit. Management commands, the test suite and
+other processes that never flushed write nothing. /metrics adds up the
+files of all processes. Gauges count only live processes; the counters and
+histograms of processes that have exited keep counting, and the first
+flush of a process folds their files into retired.json, so that a new
+process given the same id does not overwrite their totals.
+"""
+import atexit
+import json
+import logging
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+from django.conf import settings
+
+try:
+    # Processes share METRICS_DIR through POSIX file locks; elsewhere, such as
+    # on Windows, every process serves only its own values
+    import fcntl
+except ImportError:
+    fcntl = None
+from django.db import connection
+from django.db.models import Count
+
+logger = logging.getLogger(__name__)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+REPORT_BUCKETS = (0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 1800)
+
+_lock = threading.Lock()
+
+_warned = False
+
+# Totals of processes that have exited, in METRICS_DIR
+RETIRED_FILE = 'retired.json'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(pairs):
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, _escape(value)) for name, value in pairs)
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(value)
+
+
+@contextmanager
+def _directory_lock(directory, operation):
+    """Hold a lock on METRICS_DIR, exclusive to fold files and shared to read them"""
+    with open(os.path.join(directory, '.lock'), 'a') as handle:
+        fcntl.flock(handle, operation)
+        try:
+            yield
+        finally:
+            fcntl.flock(handle, fcntl.LOCK_UN)
+
+
+def _read_snapshot(path):
+    try:
+        with open(path) as source:
+            return json.load(source)
+    except (OSError, ValueError):
+        return None
+
+
+def _write_snapshot(path, snapshot):
+    partial = f'{path}.{threading.get_ident()}.part'
+    with open(partial, 'w') as output:
+        json.dump(snapshot, output)
+    # Replaced in one step, so readers never see a half-written file
+    os.replace(partial, path)
+
+
+def _shared_directory():
+    """METRICS_DIR, where this platform can share it between processes, else None"""
+    global _warned
+    directory = settings.METRICS_DIR
+    if directory and fcntl is None:
+        if not _warned:
+            logger.warning('METRICS_DIR is not supported on this platform and is ignored')
+            _warned = True
+        return None
+    return directory
+
+
+def _is_alive(pid):
+    # Signal 0 only probes on POSIX; on Windows os.kill would end the
+    # process, which is why METRICS_DIR is ignored there
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class Metric:
+    """A named family of values, one per combination of label values"""
+    type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        REGISTRY.register(self)
+
+    def _key(self, labels):
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def merge(self, total, value):
+        """Combine the values of one series from two processes"""
+        return total + value
+
+    def samples(self, key, value):
+        """(name, label pairs, value) lines of one series"""
+        yield self.name, list(zip(self.labelnames, key)), value
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with _lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """
+    A value that goes up and down. Given `collect`, a function returning
+    {label values: value}, it is read when scraped instead, such as from
+    the database.
+    """
+    type = 'gauge'
+
+    def __init__(self, name, documentation, labelnames=(), collect=None):
+        super().__init__(name, documentation, labelnames)
+        self.collect = collect
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with _lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with _lock:
+            self.values[key] = value
+
+
+class Histogram(Metric):
+    """Observations counted into `buckets` by upper bound, with their sum"""
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(float(bound) for bound in buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with _lock:
+            # A count per bucket, then one for observations above them all, then the sum
+            counts = self.values.get(key)
+            if counts is None:
+                counts = self.values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[bisect_left(self.buckets, value)] += 1
+            counts[-1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def merge(self, total, value):
+        if len(total) != len(value):
+            # Written by a process with other buckets, before a deploy
+            return total
+        return [a + b for a, b in zip(total, value)]
+
+    def samples(self, key, value):
+        labels = list(zip(self.labelnames, key))
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), value):
+            cumulative += count
+            yield f'{self.name}_bucket', labels + [('le', _format_value(bound))], cumulative
+        yield f'{self.name}_sum', labels, value[-1]
+        yield f'{self.name}_count', labels, cumulative
+
+
+class Registry:
+    """The metrics of this process, and their totals over all processes sharing METRICS_DIR"""
+
+    def __init__(self):
+        self.metrics = []
+        self.flushed_at = 0.0
+        # Whether this process has folded in the files of exited ones
+        self.retired = False
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def snapshot(self):
+        """{metric name: [[label values, value]]} of this process"""
+        with _lock:
+            return {
+                metric.name: [[list(key), value[:] if isinstance(value, list) else value] for key, value in metric.values.items()]
+                for metric in self.metrics if getattr(metric, 'collect', None) is None
+            }
+
+    def reset(self):
+        with _lock:
+            for metric in self.metrics:
+                metric.values = {}
+        self.flushed_at = 0.0
+        self.retired = False
+
+    def flush(self):
+        """Write this process's values to its file in METRICS_DIR, first folding in those of exited processes"""
+        directory = _shared_directory()
+        if not directory:
+            return
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, f'{os.getpid()}.json')
+        if not self.retired:
+            with _directory_lock(directory, fcntl.LOCK_EX):
+                self.retire(directory)
+                _write_snapshot(path, self.snapshot())
+            self.retired = True
+        else:
+            _write_snapshot(path, self.snapshot())
+        self.flushed_at = time.monotonic()
+
+    def retire(self, directory):
+        """
+        Add the files of exited processes to retired.json and remove them. A
+        file under this process's id was left by an earlier process with it.
+        """
+        retired_path = os.path.join(directory, RETIRED_FILE)
+        retired = _read_snapshot(retired_path) or {}
+        paths = [
+            os.path.join(directory, filename) for pid, filename in self._process_files(directory)
+            if pid == os.getpid() or not _is_alive(pid)
+        ]
+        if not paths:
+            return
+        for path in paths:
+            retired = self.merge(retired, _read_snapshot(path) or {}, live=False)
+        _write_snapshot(retired_path, retired)
+        for path in paths:
+            os.remove(path)
+
+    def maybe_flush(self, force=False):
+        """Flush if METRICS_FLUSH_INTERVAL has passed since the last time, or `force`, logging failures"""
+        if not force and time.monotonic() - self.flushed_at < settings.METRICS_FLUSH_INTERVAL:
+            return
+        try:
+            self.flush()
+        except OSError:
+            # Tried again after the interval rather than failing the caller
+            self.flushed_at = time.monotonic()
+            logger.exception('Could not write metrics to %s', settings.METRICS_DIR)
+
+    def merge(self, total, snapshot, live=True):
+        """`snapshot` added to `total`, both {metric name: [[label values, value]]}, leaving out gauges unless `live`"""
+        total = dict(total)
+        for metric in self.metrics:
+            if metric.type == 'gauge' and not live or metric.name not in snapshot:
+                continue
+            series = {tuple(key): value for key, value in total.get(metric.name, [])}
+            for key, value in snapshot[metric.name]:
+                key = tuple(key)
+                series[key] = metric.merge(series[key], value) if key in series else value
+            total[metric.name] = [[list(key), value] for key, value in series.items()]
+        return total
+
+    @staticmethod
+    def _process_files(directory):
+        """(pid, filename) of the process files in `directory`"""
+        for filename in os.listdir(directory):
+            pid, extension = os.path.splitext(filename)
+            if extension == '.json' and pid.isdigit():
+                yield int(pid), filename
+
+    def _processes(self):
+        """(live, snapshot) of this process, of every process file in METRICS_DIR and of the retired ones"""
+        yield True, self.snapshot()
+        directory = _shared_directory()
+        if not directory or not os.path.isdir(directory):
+            return
+        with _directory_lock(directory, fcntl.LOCK_SH):
+            snapshots = [
+                (_is_alive(pid), _read_snapshot(os.path.join(directory, filename)))
+                for pid, filename in self._process_files(directory) if pid != os.getpid()
+            ]
+            snapshots.append((False, _read_snapshot(os.path.join(directory, RETIRED_FILE))))
+        for live, snapshot in snapshots:
+            if snapshot is not None:
+                yield live, snapshot
+
+    def collect(self):
+        """{metric name: {label values: value}} over all processes"""
+        total = {}
+        for live, snapshot in self._processes():
+            total = self.merge(total, snapshot, live)
+        totals = {
+            metric.name: {tuple(key): value for key, value in total.get(metric.name, [])} for metric in self.metrics
+        }
+        for metric in self.metrics:
+            if getattr(metric, 'collect', None) is not None:
+                totals[metric.name] = {
+                    key if isinstance(key, tuple) else (key,): value for key, value in metric.collect().items()
+                }
+        return totals
+
+    def render(self):
+        """All metrics in the Prometheus text exposition format"""
+        totals = self.collect()
+        lines = []
+        for metric in self.metrics:
+            lines.append(f'# HELP {metric.name} {metric.documentation}')
+            lines.append(f'# TYPE {metric.name} {metric.type}')
+            for key, value in sorted(totals[metric.name].items()):
+                for name, labels, sample in metric.samples(key, value):
+                    lines.append(f'{name}{_format_labels(labels)} {_format_value(sample)}')
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+# Values recorded before a fork belong to the parent
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=REGISTRY.reset)
+
+
+@atexit.register
+def _flush_on_exit():
+    # Only processes that have served write their values
+    if not REGISTRY.flushed_at:
+        return
+    try:
+        REGISTRY.flush()
+    except OSError:
+        pass
+
+
+def _report_run_counts():
+    from .models import ReportRun
+    return dict(ReportRun.objects.order_by().values('status').annotate(count=Count('pk')).values_list('status', 'count'))
+
+
+REQUEST_SECONDS = Histogram(
+    'aidconnect_request_duration_seconds', 'Time to respond to a request, by URL name', ['view', 'method'],
+)
+REQUESTS = Counter('aidconnect_requests_total', 'Requests answered, by URL name and status', ['view', 'method', 'status'])
+REQUEST_QUERIES = Histogram(
+    'aidconnect_request_queries', 'Database queries run by a request, by URL name', ['view'], QUERY_BUCKETS,
+)
+REQUESTS_IN_PROGRESS = Gauge('aidconnect_requests_in_progress', 'Requests being handled')
+REPORT_SECONDS = Histogram(
+    'aidconnect_report_generation_seconds', 'Time to generate a report file, downloaded or run in the background',
+    ['format', 'entity', 'mode'], REPORT_BUCKETS,
+)
+REPORTS = Counter(
+    'aidconnect_reports_generated_total', 'Report files generated, by outcome', ['format', 'mode', 'status'],
+)
+PROMOTIONS = Counter('aidconnect_promotions_total', 'Beneficiaries moved to another category or program', ['kind'])
+REPORT_RUNS = Gauge(
+    'aidconnect_report_runs', 'Background report runs by status', ['status'], collect=_report_run_counts,
+)
+
+
+def record_report(format, entity, mode, seconds, completed=True):
+    REPORT_SECONDS.observe(seconds, format=format, entity=entity, mode=mode)
+    REPORTS.inc(format=format, mode=mode, status='completed' if completed else 'failed')
+
+
+def record_report_stream(chunks, format, entity, mode):
+    """Pass the chunks of a streamed report through, recording it once the last one is sent"""
+    started = time.perf_counter()
+    completed = False
+    try:
+        yield from chunks
+        completed = True
+    finally:
+        record_report(format, entity, mode, time.perf_counter() - started, completed)
+
+
+class MetricsMiddleware:
+    """
+    Records every request's latency, status and query count by URL name.
+    The body of a streaming response is sent after the request is recorded.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        queries = 0
+
+        def count(execute, sql, params, many, context):
+            nonlocal queries
+            queries += 1
+            return execute(sql, params, many, context)
+
+        REQUESTS_IN_PROGRESS.inc()
+        started = time.perf_counter()
+        try:
+            with connection.execute_wrapper(count):
+                response = self.get_response(request)
+        finally:
+            REQUESTS_IN_PROGRESS.dec()
+
+        match = request.resolver_match
+        view = match.view_name if match else 'unmatched'
+        REQUEST_SECONDS.observe(time.perf_counter() - started, view=view, method=request.method)
+        REQUESTS.inc(view=view, method=request.method, status=response.status_code)
+        REQUEST_QUERIES.observe(queries, view=view)
+        REGISTRY.maybe_flush()
+        return response
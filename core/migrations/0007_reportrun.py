@@ -0,0 +1,40 @@
+# Generated by Django 4.2.23 on 2026-10-18 06:15
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0006_actionplan_beneficiaryprogress'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ReportRun',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=100)),
+                ('entity_type', models.CharField(choices=[('beneficiary', 'Beneficiaries'), ('case', 'Cases'), ('assessment', 'Assessments'), ('case_note', 'Case Notes'), ('program', 'Programs'), ('category', 'Categories')], max_length=20)),
+                ('fields', models.TextField(help_text='JSON array of field names to include in the report')),
+                ('filters', models.TextField(blank=True, help_text='JSON object of filters to apply')),
+                ('format', models.CharField(choices=[('excel', 'Excel'), ('pdf', 'PDF')], default='excel', max_length=10)),
+                ('status', models.CharField(choices=[('queued', 'Queued'), ('running', 'Running'), ('completed', 'Completed'), ('failed', 'Failed')], default='queued', max_length=10)),
+                ('progress', models.PositiveIntegerField(default=0, help_text='Percentage of rows written (0-100)')),
+                ('row_count', models.PositiveIntegerField(blank=True, null=True)),
+                ('artifact', models.CharField(blank=True, help_text='Generated file, relative to REPORT_ARTIFACT_ROOT', max_length=255)),
+                ('error', models.TextField(blank=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('started_at', models.DateTimeField(blank=True, null=True)),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('created_by', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='report_runs', to=settings.AUTH_USER_MODEL)),
+                ('report', models.ForeignKey(blank=True, help_text='Saved report this run was started from, if any', null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='runs', to='core.report')),
+            ],
+            options={
+                'ordering': ['-created_at'],
+            },
+        ),
+    ]
@@ -0,0 +1,64 @@
+# Generated by Django 4.2.23 on 2026-10-18 06:27
+
+from django.db import migrations, models
+import django.db.models.deletion
+from django.db.models import Count, OuterRef, Subquery, Sum
+
+
+def backfill_ledger(apps, schema_editor):
+    Assessment = apps.get_model('core', 'Assessment')
+    BeneficiaryFundingLedger = apps.get_model('core', 'BeneficiaryFundingLedger')
+    latest_income = (
+        Assessment.objects.filter(case__beneficiary_id=OuterRef('case__beneficiary_id'), year=OuterRef('year'))
+        .order_by('-created_at', '-pk')
+        .values('income_amount')[:1]
+    )
+    rows = (
+        Assessment.objects.order_by()
+        .values('case__beneficiary_id', 'year')
+        .annotate(total=Sum('amount_received'), count=Count('pk'), last_income=Subquery(latest_income))
+    )
+    BeneficiaryFundingLedger.objects.bulk_create([
+        BeneficiaryFundingLedger(
+            beneficiary_id=row['case__beneficiary_id'], year=row['year'], total_received=row['total'] or 0,
+            assessment_count=row['count'], last_income=row['last_income'] or 0,
+        )
+        for row in rows
+    ], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0008_dashboardcounter'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='reportrun',
+            name='entity_type',
+            field=models.CharField(choices=[('beneficiary', 'Beneficiaries'), ('case', 'Cases'), ('assessment', 'Assessments'), ('case_note', 'Case Notes'), ('program', 'Programs'), ('category', 'Categories'), ('funding', 'Funding Ledger')], max_length=20),
+        ),
+        migrations.AlterField(
+            model_name='reporttemplate',
+            name='entity_type',
+            field=models.CharField(choices=[('beneficiary', 'Beneficiaries'), ('case', 'Cases'), ('assessment', 'Assessments'), ('case_note', 'Case Notes'), ('program', 'Programs'), ('category', 'Categories'), ('funding', 'Funding Ledger')], max_length=20),
+        ),
+        migrations.CreateModel(
+            name='BeneficiaryFundingLedger',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('year', models.PositiveIntegerField()),
+                ('total_received', models.DecimalField(decimal_places=2, default=0.0, help_text='Total amount received in assessments of this year', max_digits=12)),
+                ('assessment_count', models.PositiveIntegerField(default=0)),
+                ('last_income', models.DecimalField(decimal_places=2, default=0.0, help_text='Income amount of the latest assessment of this year', max_digits=10)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('beneficiary', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='funding_ledger', to='core.beneficiary')),
+            ],
+            options={
+                'ordering': ['beneficiary', 'year'],
+                'unique_together': {('beneficiary', 'year')},
+            },
+        ),
+        migrations.RunPython(backfill_ledger, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,70 @@
+from django.db import migrations
+
+# Search table -> (columns, SELECT of rowid and column values)
+SEARCH_TABLES = {
+    'core_search_beneficiary': (
+        ['name', 'address'],
+        'SELECT b.id, b.name, b.address FROM core_beneficiary b',
+    ),
+    'core_search_case': (
+        ['title', 'description', 'beneficiary__name'],
+        'SELECT c.id, c.title, c.description, b.name FROM core_case c '
+        'JOIN core_beneficiary b ON b.id = c.beneficiary_id',
+    ),
+    'core_search_case_note': (
+        ['content', 'case__title', 'case__beneficiary__name'],
+        'SELECT n.id, n.content, c.title, b.name FROM core_casenote n '
+        'JOIN core_case c ON c.id = n.case_id JOIN core_beneficiary b ON b.id = c.beneficiary_id',
+    ),
+    'core_search_referral': (
+        ['beneficiary__name', 'referred_to_organization', 'reason'],
+        'SELECT r.id, b.name, r.referred_to_organization, r.reason FROM core_referral r '
+        'JOIN core_beneficiary b ON b.id = r.beneficiary_id',
+    ),
+    'core_search_action_plan': (
+        ['title', 'description', 'goals', 'case__title', 'case__beneficiary__name'],
+        'SELECT a.id, a.title, a.description, a.goals, c.title, b.name FROM core_actionplan a '
+        'JOIN core_case c ON c.id = a.case_id JOIN core_beneficiary b ON b.id = c.beneficiary_id',
+    ),
+}
+
+
+def has_fts5(schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return False
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute("SELECT sqlite_compileoption_used('ENABLE_FTS5')")
+        return bool(cursor.fetchone()[0])
+
+
+def create_search_tables(apps, schema_editor):
+    # Other databases search the source columns directly
+    if not has_fts5(schema_editor):
+        return
+    with schema_editor.connection.cursor() as cursor:
+        for table, (columns, select) in SEARCH_TABLES.items():
+            quoted = ', '.join(f'"{column}"' for column in columns)
+            cursor.execute(
+                f'CREATE VIRTUAL TABLE IF NOT EXISTS {table} USING fts5('
+                f"{quoted}, tokenize='unicode61 remove_diacritics 2', prefix='2 3')"
+            )
+            cursor.execute(f'INSERT INTO {table} (rowid, {quoted}) {select}')
+
+
+def drop_search_tables(apps, schema_editor):
+    if not has_fts5(schema_editor):
+        return
+    with schema_editor.connection.cursor() as cursor:
+        for table in SEARCH_TABLES:
+            cursor.execute(f'DROP TABLE IF EXISTS {table}')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0009_beneficiaryfundingledger'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_tables, drop_search_tables),
+    ]
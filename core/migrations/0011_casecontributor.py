@@ -0,0 +1,55 @@
+# Generated by Django 4.2.23 on 2026-10-18 07:09
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+from django.db.models import Count, Max, Min
+
+
+def backfill_contributors(apps, schema_editor):
+    CaseNote = apps.get_model('core', 'CaseNote')
+    Assessment = apps.get_model('core', 'Assessment')
+    CaseContributor = apps.get_model('core', 'CaseContributor')
+    rows = {}
+    for model, count_field in ((CaseNote, 'note_count'), (Assessment, 'assessment_count')):
+        grouped = (
+            model.objects.order_by()
+            .values('created_by_id', 'case_id')
+            .annotate(count=Count('pk'), first=Min('created_at'), last=Max('created_at'))
+        )
+        for group in grouped:
+            key = (group['created_by_id'], group['case_id'])
+            row = rows.setdefault(key, CaseContributor(
+                user_id=key[0], case_id=key[1], first_contribution=group['first'], last_contribution=group['last'],
+            ))
+            setattr(row, count_field, group['count'])
+            row.first_contribution = min(row.first_contribution, group['first'])
+            row.last_contribution = max(row.last_contribution, group['last'])
+    CaseContributor.objects.bulk_create(rows.values(), batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0010_search_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CaseContributor',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('first_contribution', models.DateTimeField()),
+                ('last_contribution', models.DateTimeField()),
+                ('note_count', models.PositiveIntegerField(default=0)),
+                ('assessment_count', models.PositiveIntegerField(default=0)),
+                ('case', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='contributors', to='core.case')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='contributed_cases', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'ordering': ['user', '-last_contribution'],
+                'unique_together': {('user', 'case')},
+            },
+        ),
+        migrations.RunPython(backfill_contributors, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,113 @@
+# Generated by Django 4.2.23 on 2026-10-18 07:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0011_casecontributor'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='actionplan',
+            index=models.Index(fields=['created_by', 'created_at'], name='actionplan_author_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='actionplan',
+            index=models.Index(fields=['created_at'], name='actionplan_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='alert',
+            index=models.Index(fields=['user', 'is_read', 'created_at'], name='alert_user_read_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='alert',
+            index=models.Index(fields=['user', 'created_at'], name='alert_user_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='assessment',
+            index=models.Index(fields=['case', 'year'], name='assessment_case_year_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='assessment',
+            index=models.Index(fields=['created_by', 'created_at'], name='assessment_author_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='assessment',
+            index=models.Index(fields=['case', 'created_at'], name='assessment_case_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='assessment',
+            index=models.Index(fields=['created_at'], name='assessment_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='beneficiary',
+            index=models.Index(fields=['name'], name='beneficiary_name_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='beneficiaryprogress',
+            index=models.Index(fields=['case', 'date'], name='progress_case_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='beneficiaryprogress',
+            index=models.Index(fields=['date'], name='progress_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='case',
+            index=models.Index(fields=['case_manager', 'status', 'created_at'], name='case_manager_status_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='case',
+            index=models.Index(fields=['case_manager', 'created_at'], name='case_manager_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='case',
+            index=models.Index(fields=['status', 'created_at'], name='case_status_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='case',
+            index=models.Index(fields=['created_at'], name='case_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='casenote',
+            index=models.Index(fields=['created_by', 'created_at'], name='casenote_author_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='casenote',
+            index=models.Index(fields=['case', 'created_at'], name='casenote_case_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='casenote',
+            index=models.Index(fields=['created_at'], name='casenote_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='referral',
+            index=models.Index(fields=['referred_by', 'created_at'], name='referral_by_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='referral',
+            index=models.Index(fields=['referred_to_user', 'created_at'], name='referral_to_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='referral',
+            index=models.Index(fields=['status', 'created_at'], name='referral_status_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='referral',
+            index=models.Index(fields=['created_at'], name='referral_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='report',
+            index=models.Index(fields=['created_by', 'created_at'], name='report_author_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='reportrun',
+            index=models.Index(fields=['status', 'created_at'], name='reportrun_status_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='reportrun',
+            index=models.Index(fields=['created_by', 'created_at'], name='reportrun_author_created_idx'),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 4.2.23 on 2026-10-18 07:43
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0012_hot_path_indexes'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='beneficiary',
+            index=models.Index(fields=['created_at'], name='beneficiary_created_idx'),
+        ),
+    ]
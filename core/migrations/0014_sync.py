@@ -0,0 +1,55 @@
+# Generated by Django 4.2.23 on 2026-10-18 07:48
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0013_beneficiary_created_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SyncTombstone',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('entity', models.CharField(help_text='Sync entity the row belonged to, e.g. case', max_length=20)),
+                ('object_id', models.BigIntegerField()),
+                ('deleted_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'ordering': ['deleted_at'],
+            },
+        ),
+        migrations.AddField(
+            model_name='beneficiarycategory',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True),
+        ),
+        migrations.AddField(
+            model_name='program',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True),
+        ),
+        migrations.AddIndex(
+            model_name='assessment',
+            index=models.Index(fields=['updated_at'], name='assessment_updated_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='beneficiary',
+            index=models.Index(fields=['updated_at'], name='beneficiary_updated_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='case',
+            index=models.Index(fields=['updated_at'], name='case_updated_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='casenote',
+            index=models.Index(fields=['updated_at'], name='casenote_updated_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='synctombstone',
+            index=models.Index(fields=['entity', 'deleted_at'], name='tombstone_entity_deleted_idx'),
+        ),
+    ]
@@ -1,7 +1,9 @@
-from django.db import models
+from django.conf import settings
+from django.db import models, transaction
 from django.contrib.auth.models import AbstractUser
 from django.utils import timezone
 import json
+from pathlib import Path
 
 class User(AbstractUser):
     """Custom user model with role field"""
@@ -14,6 +16,8 @@ class User(AbstractUser):
         ('program_director', 'Program Director'),
     )
     role = models.CharField(max_length=30, choices=ROLE_CHOICES, default='field_officer')
+    # Pages naming a user are revalidated when their details change, see core/conditional.py
+    updated_at = models.DateTimeField(auto_now=True)
 
     def __str__(self):
         return f"{self.username} ({self.get_role_display()})"
@@ -22,6 +26,7 @@ class Program(models.Model):
     description = models.TextField(blank=True)
     monthly_amount = models.DecimalField(max_digits=10, decimal_places=2, help_text="Amount a beneficiary receives per month")
     next_program = models.ForeignKey('self', on_delete=models.SET_NULL, null=True, blank=True, help_text="Optional: Promote to this program after conditions are met")
+    updated_at = models.DateTimeField(auto_now=True)
 
     def __str__(self):
         return self.name
@@ -29,6 +34,7 @@ class BeneficiaryCategory(models.Model):
     name = models.CharField(max_length=100, unique=True)
     description = models.TextField(blank=True)
     max_annual_amount = models.DecimalField(max_digits=10, decimal_places=2, help_text="Maximum yearly amount a beneficiary in this category can receive")
+    updated_at = models.DateTimeField(auto_now=True)
 
     def __str__(self):
         return self.name
@@ -49,6 +55,11 @@ class Beneficiary(models.Model):
 
     class Meta:
         verbose_name_plural = "Beneficiaries"
+        indexes = [
+            models.Index(fields=['name'], name='beneficiary_name_idx'),
+            models.Index(fields=['created_at'], name='beneficiary_created_idx'),
+            models.Index(fields=['updated_at'], name='beneficiary_updated_idx'),
+        ]
 
 class Case(models.Model):
     """Case model linked to a beneficiary and case manager"""
@@ -70,6 +81,15 @@ class Case(models.Model):
     def __str__(self):
         return f"{self.title} - {self.beneficiary.name}"
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['case_manager', 'status', 'created_at'], name='case_manager_status_idx'),
+            models.Index(fields=['case_manager', 'created_at'], name='case_manager_created_idx'),
+            models.Index(fields=['status', 'created_at'], name='case_status_created_idx'),
+            models.Index(fields=['created_at'], name='case_created_idx'),
+            models.Index(fields=['updated_at'], name='case_updated_idx'),
+        ]
+
 class CaseNote(models.Model):
     """Case note linked to a case and created by a user"""
     case = models.ForeignKey(Case, on_delete=models.CASCADE, related_name='notes')
@@ -81,6 +101,14 @@ class CaseNote(models.Model):
     def __str__(self):
         return f"Note for {self.case.title} by {self.created_by.username}"
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['created_by', 'created_at'], name='casenote_author_created_idx'),
+            models.Index(fields=['case', 'created_at'], name='casenote_case_created_idx'),
+            models.Index(fields=['created_at'], name='casenote_created_idx'),
+            models.Index(fields=['updated_at'], name='casenote_updated_idx'),
+        ]
+
 class Assessment(models.Model):
     """Assessment model for evaluating beneficiaries"""
     title = models.CharField(max_length=200)
@@ -96,54 +124,50 @@ class Assessment(models.Model):
     def __str__(self):
         return self.title
 
-    def get_total_amount_received(self):
+    def save(self, *args, **kwargs):
+        # The funding ledger is refreshed from post_save, inside the same transaction
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+
+    def get_total_amount_received(self, year=None):
         """
-        Calculate the total amount received by the beneficiary across all assessments.
+        Calculate the total amount received by the beneficiary across all assessments,
+        or only those of `year` if given.
         Returns the total amount as a decimal.
         """
-        beneficiary = self.case.beneficiary
-        # Get all cases for this beneficiary
-        case_ids = Case.objects.filter(beneficiary=beneficiary).values_list('id', flat=True)
-        # Get all assessments for these cases
-        assessments = Assessment.objects.filter(case__id__in=case_ids)
-        # Sum the amount_received field
-        total_amount = sum(assessment.amount_received for assessment in assessments)
-        return total_amount
-
-    def check_category_promotion(self):
+        from .funding import get_total_received
+        return get_total_received(self.case.beneficiary_id, year=year)
+
+    def check_category_promotion(self, total_amount_received=None):
         """
         Check if the beneficiary can be promoted to another category based on their income
-        and total amount received.
+        and total amount received. Pass `total_amount_received` if it is already known
+        to avoid computing it again.
         Returns a tuple (can_promote, new_category) where:
         - can_promote is a boolean indicating if the beneficiary can be promoted
         - new_category is the new category the beneficiary can be promoted to, or None if they can't be promoted
         """
-        beneficiary = self.case.beneficiary
-        current_category = beneficiary.category
+        from .promotions import get_category_index
 
-        # Calculate total amount received by the beneficiary
-        total_amount_received = self.get_total_amount_received()
+        beneficiary = self.case.beneficiary
+        # Categories are looked up in the cached threshold index rather than queried
+        index = get_category_index()
+        current_category = index.by_id.get(beneficiary.category_id)
 
         if not current_category:
             # If the beneficiary doesn't have a category, find an appropriate one based on income
-            categories = BeneficiaryCategory.objects.filter(max_annual_amount__gte=self.income_amount).order_by('max_annual_amount')
-            if categories.exists():
-                return True, categories.first()
-            return False, None
-
-        # Check if the beneficiary's income is below the max annual amount for their current category
-        # and if the total amount received is below the max annual amount
-        if self.income_amount <= current_category.max_annual_amount and total_amount_received <= current_category.max_annual_amount:
-            return False, None
+            new_category = index.smallest_at_least(self.income_amount)
+            return (True, new_category) if new_category else (False, None)
 
-        # Find categories with higher max annual amounts that can accommodate both income and total amount received
-        higher_categories = BeneficiaryCategory.objects.filter(
-            max_annual_amount__gt=current_category.max_annual_amount,
-            max_annual_amount__gte=max(self.income_amount, total_amount_received)
-        ).order_by('max_annual_amount')
+        # Calculate total amount received by the beneficiary
+        if total_amount_received is None:
+            total_amount_received = self.get_total_amount_received()
 
-        if higher_categories.exists():
-            return True, higher_categories.first()
+        # Find the smallest higher category that can accommodate both income and total amount received,
+        # unless both are still within the current category's max annual amount
+        new_category = index.find_promotion(current_category, self.income_amount, total_amount_received)
+        if new_category:
+            return True, new_category
 
         return False, None
 
@@ -167,6 +191,15 @@ class Assessment(models.Model):
 
         return False, None
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['case', 'year'], name='assessment_case_year_idx'),
+            models.Index(fields=['created_by', 'created_at'], name='assessment_author_created_idx'),
+            models.Index(fields=['case', 'created_at'], name='assessment_case_created_idx'),
+            models.Index(fields=['created_at'], name='assessment_created_idx'),
+            models.Index(fields=['updated_at'], name='assessment_updated_idx'),
+        ]
+
 
 class AssessmentQuestion(models.Model):
     """Question for assessments"""
@@ -182,6 +215,7 @@ class AssessmentQuestion(models.Model):
     choices = models.TextField(blank=True, help_text="Comma-separated choices for multiple choice questions")
     required = models.BooleanField(default=True)
     order = models.PositiveIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
 
     def __str__(self):
         return self.text
@@ -210,6 +244,7 @@ class ReportTemplate(models.Model):
         ('case_note', 'Case Notes'),
         ('program', 'Programs'),
         ('category', 'Categories'),
+        ('funding', 'Funding Ledger'),
     )
 
     name = models.CharField(max_length=100)
@@ -256,6 +291,77 @@ class Report(models.Model):
         except:
             return {}
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['created_by', 'created_at'], name='report_author_created_idx'),
+        ]
+
+
+class ReportRun(models.Model):
+    """Background execution of a report that produces a downloadable file"""
+    STATUS_CHOICES = (
+        ('queued', 'Queued'),
+        ('running', 'Running'),
+        ('completed', 'Completed'),
+        ('failed', 'Failed'),
+    )
+
+    name = models.CharField(max_length=100)
+    report = models.ForeignKey(Report, on_delete=models.SET_NULL, null=True, blank=True, related_name='runs', help_text="Saved report this run was started from, if any")
+    entity_type = models.CharField(max_length=20, choices=ReportTemplate.ENTITY_CHOICES)
+    fields = models.TextField(help_text="JSON array of field names to include in the report")
+    filters = models.TextField(blank=True, help_text="JSON object of filters to apply")
+    format = models.CharField(max_length=10, choices=Report.FORMAT_CHOICES, default='excel')
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='queued')
+    progress = models.PositiveIntegerField(default=0, help_text="Percentage of rows written (0-100)")
+    row_count = models.PositiveIntegerField(null=True, blank=True)
+    artifact = models.CharField(max_length=255, blank=True, help_text="Generated file, relative to REPORT_ARTIFACT_ROOT")
+    error = models.TextField(blank=True)
+    created_by = models.ForeignKey(User, on_delete=models.CASCADE, related_name='report_runs')
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.name} ({self.get_status_display()})"
+
+    def get_fields_list(self):
+        """Returns the list of fields from the JSON string"""
+        try:
+            return json.loads(self.fields)
+        except:
+            return []
+
+    def get_filters_dict(self):
+        """Returns the filters as a dictionary from the JSON string"""
+        try:
+            return json.loads(self.filters)
+        except:
+            return {}
+
+    @property
+    def artifact_path(self):
+        """Absolute path of the generated file, or None if there is none yet"""
+        if not self.artifact:
+            return None
+        return Path(settings.REPORT_ARTIFACT_ROOT) / self.artifact
+
+    @property
+    def duration(self):
+        """Time spent generating the report"""
+        if self.started_at and self.finished_at:
+            return self.finished_at - self.started_at
+        return None
+
+    class Meta:
+        ordering = ['-created_at']
+        indexes = [
+            # The worker takes the oldest queued run
+            models.Index(fields=['status', 'created_at'], name='reportrun_status_created_idx'),
+            models.Index(fields=['created_by', 'created_at'], name='reportrun_author_created_idx'),
+        ]
+
 
 class Referral(models.Model):
     """Referral model for tracking referrals between organizations"""
@@ -280,6 +386,14 @@ class Referral(models.Model):
     def __str__(self):
         return f"Referral for {self.beneficiary.name} to {self.referred_to_organization}"
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['referred_by', 'created_at'], name='referral_by_created_idx'),
+            models.Index(fields=['referred_to_user', 'created_at'], name='referral_to_created_idx'),
+            models.Index(fields=['status', 'created_at'], name='referral_status_created_idx'),
+            models.Index(fields=['created_at'], name='referral_created_idx'),
+        ]
+
 
 class Alert(models.Model):
     """Alert model for system notifications and alerts"""
@@ -304,6 +418,10 @@ class Alert(models.Model):
 
     class Meta:
         ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['user', 'is_read', 'created_at'], name='alert_user_read_created_idx'),
+            models.Index(fields=['user', 'created_at'], name='alert_user_created_idx'),
+        ]
 
 
 class ActionPlan(models.Model):
@@ -328,6 +446,10 @@ class ActionPlan(models.Model):
 
     class Meta:
         ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['created_by', 'created_at'], name='actionplan_author_created_idx'),
+            models.Index(fields=['created_at'], name='actionplan_created_idx'),
+        ]
 
 
 class BeneficiaryProgress(models.Model):
@@ -355,3 +477,66 @@ class BeneficiaryProgress(models.Model):
     class Meta:
         ordering = ['-date']
         verbose_name_plural = "Beneficiary Progress Records"
+        indexes = [
+            models.Index(fields=['case', 'date'], name='progress_case_date_idx'),
+            models.Index(fields=['date'], name='progress_date_idx'),
+        ]
+
+
+class DashboardCounter(models.Model):
+    """Materialized dashboard count, kept up to date from model signals (see core/counters.py)"""
+    key = models.CharField(max_length=100, unique=True, help_text="Counter name, followed by ':<user id>' for per-user counters")
+    value = models.BigIntegerField(default=0)
+
+    def __str__(self):
+        return f"{self.key} = {self.value}"
+
+
+class BeneficiaryFundingLedger(models.Model):
+    """Yearly rollup of a beneficiary's assessments, refreshed whenever one of them changes (see core/funding.py)"""
+    beneficiary = models.ForeignKey(Beneficiary, on_delete=models.CASCADE, related_name='funding_ledger')
+    year = models.PositiveIntegerField()
+    total_received = models.DecimalField(max_digits=12, decimal_places=2, default=0.00, help_text="Total amount received in assessments of this year")
+    assessment_count = models.PositiveIntegerField(default=0)
+    last_income = models.DecimalField(max_digits=10, decimal_places=2, default=0.00, help_text="Income amount of the latest assessment of this year")
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.beneficiary.name} - {self.year}: {self.total_received}"
+
+    class Meta:
+        ordering = ['beneficiary', 'year']
+        unique_together = ('beneficiary', 'year')
+
+
+class CaseContributor(models.Model):
+    """A user who has written notes or assessments for a case, maintained from those records (see core/contributors.py)"""
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='contributed_cases')
+    case = models.ForeignKey(Case, on_delete=models.CASCADE, related_name='contributors')
+    first_contribution = models.DateTimeField()
+    last_contribution = models.DateTimeField()
+    note_count = models.PositiveIntegerField(default=0)
+    assessment_count = models.PositiveIntegerField(default=0)
+
+    def __str__(self):
+        return f"{self.user.username} - {self.case.title}"
+
+    class Meta:
+        ordering = ['user', '-last_contribution']
+        unique_together = ('user', 'case')
+
+
+class SyncTombstone(models.Model):
+    """Record of a deleted row, so offline clients syncing changes learn to delete their copy"""
+    entity = models.CharField(max_length=20, help_text="Sync entity the row belonged to, e.g. case")
+    object_id = models.BigIntegerField()
+    deleted_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"{self.entity} {self.object_id} deleted {self.deleted_at:%Y-%m-%d %H:%M}"
+
+    class Meta:
+        ordering = ['deleted_at']
+        indexes = [
+            models.Index(fields=['entity', 'deleted_at'], name='tombstone_entity_deleted_idx'),
+        ]
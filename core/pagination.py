@@ -0,0 +1,290 @@
+"""
+Keyset (seek) pagination for list views.
+
+Offset pagination reads and discards every row before the requested page
+and counts the whole result for the page links, so deep pages get slower
+the further in they are. Keyset pagination instead continues from the sort
+value and id of the last row shown, passed along as an opaque cursor, which
+the database answers from an index in the same time on every page. The
+total is counted only up to a cap.
+
+The REST API pages every list this way, without counting at all.
+"""
+import base64
+import binascii
+import json
+
+from django.conf import settings
+from django.core.exceptions import FieldDoesNotExist, ImproperlyConfigured, ValidationError
+from django.db.models import F, Q
+from django.http import Http404
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import CursorPagination
+from rest_framework.utils.urls import replace_query_param
+
+# Results are counted up to this many rows in keyset mode
+KEYSET_COUNT_CAP = 10000
+
+
+class InvalidCursor(ValueError):
+    """Raised for a cursor that cannot be decoded"""
+
+
+def _resolve_field(model, path):
+    """
+    Column at the end of a `__` separated path through foreign keys and
+    whether it can be NULL, or (None, False) if it cannot be followed.
+    """
+    field = None
+    nullable = False
+    for part in path.split('__'):
+        if model is None:
+            return None, False
+        try:
+            field = model._meta.get_field(part)
+        except FieldDoesNotExist:
+            return None, False
+        if field.is_relation and not field.many_to_one:
+            return None, False
+        nullable = nullable or field.null
+        model = field.related_model if field.is_relation else None
+    # Ordering by a foreign key itself follows the related model's ordering
+    if field is None or field.is_relation:
+        return None, False
+    return field, nullable
+
+
+class KeysetPage:
+    """One page of a keyset paginated result"""
+    is_keyset = True
+
+    def __init__(self, object_list, paginator, has_next, has_previous):
+        self.object_list = object_list
+        self.paginator = paginator
+        self._has_next = has_next
+        self._has_previous = has_previous
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def has_next(self):
+        return self._has_next
+
+    def has_previous(self):
+        return self._has_previous
+
+    def has_other_pages(self):
+        return self._has_next or self._has_previous
+
+    @property
+    def next_cursor(self):
+        return self.paginator.encode_cursor(self.object_list[-1], forward=True) if self._has_next else None
+
+    @property
+    def previous_cursor(self):
+        return self.paginator.encode_cursor(self.object_list[0], forward=False) if self._has_previous else None
+
+
+class KeysetPaginator:
+    """
+    Paginate `queryset` by its first ordering column with the primary key as tie breaker.
+
+    NULL sort values are treated as smaller than any other value. Use
+    `supports()` first: ordering by an expression, a reverse relation or
+    randomly cannot be paginated by keyset.
+    """
+
+    def __init__(self, queryset, per_page, count_cap=KEYSET_COUNT_CAP):
+        self.per_page = int(per_page)
+        self.count_cap = count_cap
+        self.model = queryset.model
+        ordering = queryset.query.order_by or queryset.model._meta.ordering or ['pk']
+        first = ordering[0]
+        self.sort_path = first.lstrip('-') if isinstance(first, str) else None
+        self.descending = isinstance(first, str) and first.startswith('-')
+        if self.sort_path == 'pk':
+            self.sort_path = self.model._meta.pk.name
+        self.sort_field, self.nullable = _resolve_field(self.model, self.sort_path) if self.sort_path else (None, False)
+        self.queryset = queryset
+
+    @classmethod
+    def supports(cls, queryset):
+        return cls(queryset, 1).sort_field is not None
+
+    @property
+    def count(self):
+        """Number of results, counting no further than `count_cap` rows"""
+        if not hasattr(self, '_count'):
+            queryset = self.queryset.order_by()
+            if self.count_cap:
+                queryset = queryset[:self.count_cap + 1]
+            self._count = queryset.count()
+        return min(self._count, self.count_cap) if self.count_cap else self._count
+
+    @property
+    def count_capped(self):
+        """Whether there are more results than `count`"""
+        return bool(self.count_cap) and self.count == self.count_cap and self._count > self.count_cap
+
+    def encode_cursor(self, obj, forward):
+        # Rows of a .values() queryset are dicts
+        if isinstance(obj, dict):
+            value, pk = obj['_keyset_value'], obj[self.model._meta.pk.attname]
+        else:
+            value, pk = obj._keyset_value, obj.pk
+        payload = [value, pk, 'n' if forward else 'p']
+        encoded = json.dumps(payload, default=str, separators=(',', ':')).encode('utf-8')
+        return base64.urlsafe_b64encode(encoded).decode('ascii').rstrip('=')
+
+    def decode_cursor(self, cursor):
+        try:
+            padded = cursor + '=' * (-len(cursor) % 4)
+            value, pk, direction = json.loads(base64.urlsafe_b64decode(padded.encode('ascii')))
+            if direction not in ('n', 'p'):
+                raise InvalidCursor(cursor)
+            if value is not None:
+                value = self.sort_field.to_python(value)
+            pk = self.model._meta.pk.to_python(pk)
+        except (ValueError, TypeError, binascii.Error, ValidationError) as exc:
+            raise InvalidCursor(cursor) from exc
+        return value, pk, direction == 'n'
+
+    def _seek(self, value, pk, ascending):
+        """Rows after (value, pk) when walking the ordering up (`ascending`) or down"""
+        sort = self.sort_path
+        if self.sort_path == self.model._meta.pk.name:
+            return Q(pk__gt=pk) if ascending else Q(pk__lt=pk)
+        if value is None:
+            if ascending:
+                return Q(**{f'{sort}__isnull': True, 'pk__gt': pk}) | Q(**{f'{sort}__isnull': False})
+            return Q(**{f'{sort}__isnull': True, 'pk__lt': pk})
+        # The redundant bound on the sort column lets the database seek its index
+        if ascending:
+            return Q(**{f'{sort}__gte': value}) & (Q(**{f'{sort}__gt': value}) | Q(pk__gt=pk))
+        seek = Q(**{f'{sort}__lte': value}) & (Q(**{f'{sort}__lt': value}) | Q(pk__lt=pk))
+        if self.nullable:
+            seek |= Q(**{f'{sort}__isnull': True})
+        return seek
+
+    def _ordering(self, ascending):
+        tie_breaker = 'pk' if ascending else '-pk'
+        if self.sort_path == self.model._meta.pk.name:
+            return [tie_breaker]
+        sort = F(self.sort_path)
+        # Placing NULLs explicitly keeps the database from walking an index on the column
+        if not self.nullable:
+            return [sort.asc() if ascending else sort.desc(), tie_breaker]
+        return [sort.asc(nulls_first=True) if ascending else sort.desc(nulls_last=True), tie_breaker]
+
+    def page(self, cursor=None):
+        """The first page, or the page before or after the row a cursor was made from"""
+        forward = True
+        queryset = self.queryset.annotate(_keyset_value=F(self.sort_path))
+        if cursor:
+            value, pk, forward = self.decode_cursor(cursor)
+        # Walking forward through a descending sort, or backward through an ascending one, goes down
+        ascending = forward != self.descending
+        if cursor:
+            queryset = queryset.filter(self._seek(value, pk, ascending))
+        queryset = queryset.order_by(*self._ordering(ascending))
+
+        rows = list(queryset[:self.per_page + 1])
+        more = len(rows) > self.per_page
+        rows = rows[:self.per_page]
+        if forward:
+            return KeysetPage(rows, self, has_next=more, has_previous=bool(cursor))
+        rows.reverse()
+        return KeysetPage(rows, self, has_next=True, has_previous=more)
+
+
+class KeysetPaginationMixin:
+    """
+    Adds a keyset pagination mode to a paginated ListView.
+
+    The mode is selected with `?paginate=keyset` (kept in the page links) or
+    whenever a `cursor` is given, for sort orders it supports; otherwise the
+    view paginates by page number as usual. `pagination_query` in the
+    context holds the current query string without the page or cursor.
+    """
+    keyset_count_cap = KEYSET_COUNT_CAP
+
+    def use_keyset_pagination(self, queryset):
+        params = self.request.GET
+        wanted = params.get('paginate') == 'keyset' or 'cursor' in params
+        return wanted and KeysetPaginator.supports(queryset)
+
+    def paginate_queryset(self, queryset, page_size):
+        if not self.use_keyset_pagination(queryset):
+            return super().paginate_queryset(queryset, page_size)
+        paginator = KeysetPaginator(queryset, page_size, count_cap=self.keyset_count_cap)
+        try:
+            page = paginator.page(self.request.GET.get('cursor'))
+        except InvalidCursor:
+            raise Http404("Invalid page cursor.")
+        return paginator, page, page.object_list, page.has_other_pages()
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        query = self.request.GET.copy()
+        query.pop('page', None)
+        query.pop('cursor', None)
+        context['pagination_query'] = query.urlencode()
+        return context
+
+
+class KeysetCursorPagination(CursorPagination):
+    """
+    Cursor pagination of the REST API lists by keyset.
+
+    Lists follow the ordering of the viewset's queryset or its model, and
+    otherwise list the newest rows first by `created_at`, or by id for
+    models without it. `?page_size=` picks a page size of up to the
+    API_MAX_PAGE_SIZE setting. Responses hold the `next` and `previous`
+    page links and the `results`.
+    """
+    page_size_query_param = 'page_size'
+
+    @property
+    def max_page_size(self):
+        return settings.API_MAX_PAGE_SIZE
+
+    def get_page_size(self, request):
+        # The cap applies to the default page size too
+        page_size = super().get_page_size(request)
+        return min(page_size, self.max_page_size) if page_size else page_size
+
+    def order_queryset(self, queryset):
+        if queryset.ordered:
+            return queryset
+        try:
+            queryset.model._meta.get_field('created_at')
+        except FieldDoesNotExist:
+            return queryset.order_by('-pk')
+        return queryset.order_by('-created_at')
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.page_size = self.get_page_size(request)
+        if not self.page_size:
+            return None
+        self.base_url = request.build_absolute_uri()
+        paginator = KeysetPaginator(self.order_queryset(queryset), self.page_size, count_cap=None)
+        if paginator.sort_field is None:
+            raise ImproperlyConfigured(f'{queryset.model.__name__} lists are not ordered by a column.')
+        try:
+            self.page = paginator.page(request.query_params.get(self.cursor_query_param))
+        except InvalidCursor:
+            raise NotFound(self.invalid_cursor_message)
+        return list(self.page)
+
+    def get_next_link(self):
+        if not self.page.has_next():
+            return None
+        return replace_query_param(self.base_url, self.cursor_query_param, self.page.next_cursor)
+
+    def get_previous_link(self):
+        if not self.page.has_previous():
+            return None
+        return replace_query_param(self.base_url, self.cursor_query_param, self.page.previous_cursor)
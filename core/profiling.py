@@ -0,0 +1,163 @@
+"""
+Request profiling.
+
+QueryProfilingMiddleware profiles a sample of requests, PROFILING_SAMPLE_RATE
+of them, and breaks their time down into SQL, template rendering and the
+rest, the view's own Python code. The breakdown goes out in a Server-Timing
+header, which browser developer tools show next to the request. Queries are
+also grouped by signature, their SQL with the values left out and IN lists
+collapsed, so a query repeated for every row of a page (an N+1) stands out.
+Requests that exceed PROFILING_SLOW_REQUEST_MS, PROFILING_MAX_QUERIES or
+PROFILING_REPEATED_QUERIES are logged with their worst signatures.
+
+Template time is measured by ProfiledDjangoTemplates, the template backend,
+and excludes the queries run while rendering, which count as SQL. The body
+of a streaming response is produced after the middleware returns and is not
+covered.
+"""
+import logging
+import random
+import re
+import time
+from collections import Counter
+from contextlib import ExitStack
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.db import connections
+from django.template.backends.django import DjangoTemplates, Template
+
+logger = logging.getLogger(__name__)
+
+# Signatures logged per request that crosses a threshold
+LOGGED_SIGNATURES = 3
+
+_IN_LIST = re.compile(r'IN \((?:%s, )*%s\)')
+
+# The profile of the request being handled, if it was sampled
+_current = ContextVar('profile', default=None)
+
+
+def query_signature(sql):
+    """`sql` with IN lists of any length written alike, so the same lookup for different rows matches"""
+    return _IN_LIST.sub('IN (...)', sql)
+
+
+class RequestProfile:
+    """Time spent in SQL and templates during one request, and its queries by signature"""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.total_s = 0.0
+        self.sql_s = 0.0
+        self.template_s = 0.0
+        self.queries = 0
+        self.signatures = Counter()
+        self._rendering = 0
+
+    def execute(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.sql_s += time.perf_counter() - started
+            self.queries += 1
+            self.signatures[sql] += 1
+
+    def render(self, render):
+        """Time `render()` as template rendering, less the queries it runs"""
+        if self._rendering:
+            return render()
+        self._rendering += 1
+        started, sql_started = time.perf_counter(), self.sql_s
+        try:
+            return render()
+        finally:
+            self._rendering -= 1
+            self.template_s += time.perf_counter() - started - (self.sql_s - sql_started)
+
+    def finish(self):
+        self.total_s = time.perf_counter() - self.started
+
+    @property
+    def python_s(self):
+        return max(self.total_s - self.sql_s - self.template_s, 0.0)
+
+    def repeated(self):
+        """[(signature, count)] of the queries run more than once, most repeated first"""
+        by_signature = Counter()
+        for sql, count in self.signatures.items():
+            by_signature[query_signature(sql)] += count
+        return [(signature, count) for signature, count in by_signature.most_common() if count > 1]
+
+    def server_timing(self):
+        return ', '.join([
+            'sql;dur=%.1f;desc="%d queries"' % (self.sql_s * 1000, self.queries),
+            'tpl;dur=%.1f' % (self.template_s * 1000),
+            'app;dur=%.1f' % (self.python_s * 1000),
+            'total;dur=%.1f' % (self.total_s * 1000),
+        ])
+
+
+class ProfiledTemplate(Template):
+    def render(self, context=None, request=None):
+        profile = _current.get()
+        if profile is None:
+            return super().render(context, request)
+        return profile.render(lambda: super(ProfiledTemplate, self).render(context, request))
+
+
+class ProfiledDjangoTemplates(DjangoTemplates):
+    """Django template backend whose rendering is timed for profiled requests"""
+
+    def from_string(self, template_code):
+        return ProfiledTemplate(self.engine.from_string(template_code), self)
+
+    def get_template(self, template_name):
+        template = super().get_template(template_name)
+        return ProfiledTemplate(template.template, self)
+
+
+class QueryProfilingMiddleware:
+    """Profile a sample of requests, reporting in Server-Timing and logging the expensive ones"""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if random.random() >= settings.PROFILING_SAMPLE_RATE:
+            return self.get_response(request)
+
+        profile = RequestProfile()
+        token = _current.set(profile)
+        try:
+            with ExitStack() as stack:
+                for connection in connections.all():
+                    stack.enter_context(connection.execute_wrapper(profile.execute))
+                response = self.get_response(request)
+        finally:
+            _current.reset(token)
+        profile.finish()
+
+        response['Server-Timing'] = profile.server_timing()
+        self.log(request, profile)
+        return response
+
+    def log(self, request, profile):
+        repeated = [(signature, count) for signature, count in profile.repeated() if count >= settings.PROFILING_REPEATED_QUERIES]
+        if (
+            profile.total_s * 1000 < settings.PROFILING_SLOW_REQUEST_MS
+            and profile.queries <= settings.PROFILING_MAX_QUERIES
+            and not repeated
+        ):
+            return
+        match = request.resolver_match
+        logger.warning(
+            '%s %s (%s) took %.0fms: %d queries in %.0fms, templates %.0fms, python %.0fms%s',
+            request.method, request.path, match.view_name if match else '-', profile.total_s * 1000,
+            profile.queries, profile.sql_s * 1000, profile.template_s * 1000, profile.python_s * 1000,
+            ''.join(
+                '\n  %dx %s' % (count, signature[:300])
+                for signature, count in (repeated or profile.repeated())[:LOGGED_SIGNATURES]
+            ),
+        )
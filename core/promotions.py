@@ -0,0 +1,165 @@
+"""
+Population-wide category and program promotion.
+
+The per-assessment checks on Assessment decide promotions one beneficiary
+at a time. This module applies the same rules to every beneficiary at once:
+categories are loaded once into a sorted threshold index, each
+beneficiary's funding is read from the funding ledger in the same streamed
+query as the beneficiary itself, and changes are written with bulk updates.
+"""
+import bisect
+from collections import Counter
+from dataclasses import dataclass, field
+
+from django.db import connection, transaction
+from django.db.models import DecimalField, Exists, OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from .funding import ZERO
+from .metrics import PROMOTIONS
+from .models import Beneficiary, BeneficiaryCategory, BeneficiaryFundingLedger, Program
+from .report_cache import bump_data_version, get_data_version
+
+PROMOTION_CHUNK_SIZE = 2000
+
+# Process-local (data version, CategoryIndex) of the current categories
+_category_index = None
+
+
+class CategoryIndex:
+    """Categories sorted by max_annual_amount, searched by bisection"""
+
+    def __init__(self, categories):
+        self.categories = sorted(categories, key=lambda category: (category.max_annual_amount, category.pk))
+        self.thresholds = [category.max_annual_amount for category in self.categories]
+        self.by_id = {category.pk: category for category in self.categories}
+
+    @classmethod
+    def load(cls):
+        return cls(BeneficiaryCategory.objects.all())
+
+    def smallest_at_least(self, amount, above=None):
+        """Smallest category whose threshold is at least `amount` and, if given, greater than `above`"""
+        idx = bisect.bisect_left(self.thresholds, amount)
+        if above is not None:
+            idx = max(idx, bisect.bisect_right(self.thresholds, above))
+        return self.categories[idx] if idx < len(self.categories) else None
+
+    def find_promotion(self, current, income, total_received):
+        """
+        The category a beneficiary in `current` (which may be None) should move
+        to, or None if they stay. Mirrors Assessment.check_category_promotion.
+        """
+        if current is None:
+            return self.smallest_at_least(income)
+        if income <= current.max_annual_amount and total_received <= current.max_annual_amount:
+            return None
+        return self.smallest_at_least(max(income, total_received), above=current.max_annual_amount)
+
+
+def get_category_index():
+    """
+    The category index of this process, rebuilt when categories change.
+
+    Category saves and deletes clear it directly in the process that made
+    them; other processes notice the new data version of the category model.
+    An index built inside a transaction may include changes that are rolled
+    back later, so it is used for that transaction only and not kept.
+    """
+    global _category_index
+    version = get_data_version(BeneficiaryCategory)
+    if _category_index is not None and _category_index[0] == version:
+        return _category_index[1]
+    index = CategoryIndex.load()
+    if not connection.in_atomic_block:
+        _category_index = (version, index)
+    return index
+
+
+def invalidate_category_index():
+    global _category_index
+    _category_index = None
+
+
+@dataclass
+class PromotionPlan:
+    """Changes decided for the population, keyed by beneficiary id"""
+    evaluated: int = 0
+    categories: dict = field(default_factory=dict)
+    programs: dict = field(default_factory=dict)
+    category_moves: Counter = field(default_factory=Counter)
+    program_moves: Counter = field(default_factory=Counter)
+
+
+def _funding_queryset():
+    """Every beneficiary with assessments, with its total received and latest income"""
+    ledger = BeneficiaryFundingLedger.objects.filter(beneficiary_id=OuterRef('pk')).order_by()
+    total_received = ledger.values('beneficiary_id').annotate(total=Sum('total_received')).values('total')
+    latest_income = ledger.order_by('-year').values('last_income')[:1]
+    money = DecimalField(max_digits=12, decimal_places=2)
+    return (
+        Beneficiary.objects.filter(Exists(ledger)).order_by('pk')
+        .annotate(
+            total_received=Coalesce(Subquery(total_received, output_field=money), Value(ZERO), output_field=money),
+            latest_income=Subquery(latest_income, output_field=money),
+        )
+        .values_list('pk', 'category_id', 'program_id', 'total_received', 'latest_income')
+    )
+
+
+def plan_promotions(include_programs=False, chunk_size=PROMOTION_CHUNK_SIZE):
+    """
+    Decide promotions for every beneficiary that has been assessed.
+
+    Income is taken from the beneficiary's latest assessment. Program
+    promotions move beneficiaries on to the next program of their current
+    one, as saving an assessment does, and are only planned on request.
+    """
+    index = get_category_index()
+    next_programs = dict(
+        Program.objects.filter(next_program__isnull=False).values_list('pk', 'next_program_id')
+    ) if include_programs else {}
+
+    plan = PromotionPlan()
+    for pk, category_id, program_id, total_received, income in _funding_queryset().iterator(chunk_size=chunk_size):
+        plan.evaluated += 1
+        current = index.by_id.get(category_id)
+        new_category = index.find_promotion(current, income, total_received)
+        if new_category is not None and new_category.pk != category_id:
+            plan.categories[pk] = new_category.pk
+            plan.category_moves[(category_id, new_category.pk)] += 1
+
+        next_program_id = next_programs.get(program_id)
+        if next_program_id is not None:
+            plan.programs[pk] = next_program_id
+            plan.program_moves[(program_id, next_program_id)] += 1
+    return plan
+
+
+def apply_promotions(plan, chunk_size=PROMOTION_CHUNK_SIZE):
+    """Write a plan's changes with bulk updates, returning the number of beneficiaries changed"""
+    now = timezone.now()
+    changed = []
+    for pk in sorted(set(plan.categories) | set(plan.programs)):
+        beneficiary = Beneficiary(pk=pk, updated_at=now)
+        fields = ['updated_at']
+        if pk in plan.categories:
+            beneficiary.category_id = plan.categories[pk]
+            fields.append('category')
+        if pk in plan.programs:
+            beneficiary.program_id = plan.programs[pk]
+            fields.append('program')
+        changed.append((tuple(fields), beneficiary))
+
+    with transaction.atomic():
+        for fields in {fields for fields, _ in changed}:
+            Beneficiary.objects.bulk_update(
+                [beneficiary for group, beneficiary in changed if group == fields], fields, batch_size=chunk_size
+            )
+    if changed:
+        # Bulk updates bypass the signals that invalidate cached reports
+        bump_data_version(Beneficiary)
+        PROMOTIONS.inc(len(plan.categories), kind='category')
+        PROMOTIONS.inc(len(plan.programs), kind='program')
+    return len(changed)
@@ -0,0 +1,122 @@
+"""
+Query plan checks for the hot read paths.
+
+The list views, dashboards and report worker filter and sort tables that
+grow without bound by a handful of columns, each of which has an index in
+core/models.py. `hot_queries` builds those querysets the way each role
+issues them and `full_scans` picks the tables SQLite's EXPLAIN QUERY PLAN
+reads from start to end without an index, which the `check_query_plans`
+command and the tests fail on. The planner only chooses the same plans as
+production on a database of realistic size that has been ANALYZEd.
+"""
+import re
+
+from django.db import connection
+from django.db.models.query import QuerySet
+from django.test import RequestFactory
+
+from .models import BeneficiaryCategory, Program, ReportRun
+from .search import SQLiteFTSBackend, get_search_backend
+
+# A table read without an index; index walks are reported as "SCAN t USING [COVERING] INDEX i"
+# and full-text matches as "SCAN t VIRTUAL TABLE INDEX n"
+FULL_SCAN = re.compile(r'^SCAN (?!CONSTANT ROW)(?!.*\bUSING\b)(?!.*\bVIRTUAL TABLE\b)')
+
+# Reference data of a few rows each, cheaper to read whole than through an index
+SMALL_TABLES = {Program._meta.db_table, BeneficiaryCategory._meta.db_table}
+
+PLAN_PAGE_SIZE = 10
+
+
+def explain(queryset):
+    """Detail lines of the SQLite query plan of `queryset`"""
+    sql, params = queryset.query.sql_with_params()
+    with connection.cursor() as cursor:
+        cursor.execute(f'EXPLAIN QUERY PLAN {sql}', params)
+        return [row[-1] for row in cursor.fetchall()]
+
+
+def full_scans(plan):
+    """Lines of `plan` that read a whole table other than the small reference tables"""
+    return [
+        line for line in plan
+        if FULL_SCAN.match(line) and line.split()[1] not in SMALL_TABLES
+    ]
+
+
+def _list_views():
+    """(list view, query strings it is requested with)"""
+    from . import views
+
+    filtered = [{}, {'status': 'open'}]
+    return [
+        (views.BeneficiaryListView, [{}]),
+        (views.CaseListView, filtered + [{'search': 'bench'}]),
+        (views.CaseNoteListView, [{}, {'search': 'visit'}]),
+        (views.AssessmentListView, [{}]),
+        (views.ReferralListView, [{}, {'status': 'pending'}]),
+        (views.ActionPlanListView, [{}, {'status': 'active'}]),
+        (views.BeneficiaryProgressListView, [{}]),
+        (views.AlertListView, [{}]),
+        (views.ReportListView, [{}]),
+        (views.ReportRunListView, [{}]),
+    ]
+
+
+def _dashboards():
+    from . import dashboards
+
+    return {
+        'admin': dashboards.get_admin_dashboard,
+        'case_manager': dashboards.get_case_manager_dashboard,
+        'field_officer': dashboards.get_field_officer_dashboard,
+        'partner_organisation': dashboards.get_partner_organisation_dashboard,
+        'monitoring_and_evaluation': dashboards.get_monitoring_and_evaluation_dashboard,
+        'program_director': dashboards.get_program_director_dashboard,
+    }
+
+
+def hot_queries(users):
+    """
+    (label, queryset) for the first page of every list view and each
+    recent item list of the dashboards, as issued by each of `users`, and
+    for the report worker's queue.
+    """
+    factory = RequestFactory()
+    full_text = isinstance(get_search_backend(), SQLiteFTSBackend)
+    for view_class, query_strings in _list_views():
+        for user in users:
+            allowed = getattr(view_class, 'allowed_roles', None)
+            if allowed is not None and user.role not in allowed:
+                continue
+            for params in query_strings:
+                # Substring search reads every row by design
+                if 'search' in params and not full_text:
+                    continue
+                request = factory.get('/', params)
+                request.user = user
+                view = view_class()
+                view.setup(request)
+                label = f'{view_class.__name__} as {user.role}'
+                if params:
+                    label += ' ?' + request.GET.urlencode()
+                yield label, view.get_queryset()[:PLAN_PAGE_SIZE]
+
+    dashboards = _dashboards()
+    for user in users:
+        for name, value in dashboards[user.role](user).items():
+            if isinstance(value, QuerySet):
+                yield f'{user.role} dashboard {name}', value
+
+    yield 'report worker queue', ReportRun.objects.filter(status='queued').order_by('created_at').values_list('id', flat=True)[:1]
+
+
+def check_query_plans(users):
+    """(label, full scan lines, plan) of every hot query that reads a whole table"""
+    problems = []
+    for label, queryset in hot_queries(users):
+        plan = explain(queryset)
+        scans = full_scans(plan)
+        if scans:
+            problems.append((label, scans, plan))
+    return problems
@@ -0,0 +1,113 @@
+"""
+Renderers and parsers for the REST API.
+
+DRF encodes and decodes JSON with the standard library's json module,
+which is a large share of the time spent serving the sync clients' list
+requests. FastJSONRenderer and FastJSONParser use orjson when it is
+installed and fall back to DRF's JSONRenderer and JSONParser otherwise,
+and for indented output, producing the same documents either way.
+MessagePack (`Accept: application/msgpack`) gives mobile clients smaller
+bodies when the msgpack package is installed; without it the format is
+not offered.
+"""
+from rest_framework.exceptions import ParseError
+from rest_framework.negotiation import DefaultContentNegotiation
+from rest_framework.parsers import BaseParser, JSONParser
+from rest_framework.renderers import BaseRenderer, JSONRenderer
+from rest_framework.utils.encoders import JSONEncoder
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# Encodes what neither library handles natively (decimals, lazy strings, and
+# datetimes, which DRF formats to the millisecond) the way DRF's encoder does
+_encoder = JSONEncoder()
+
+
+class FastJSONRenderer(JSONRenderer):
+    """JSONRenderer encoding with orjson where available"""
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if (
+            orjson is None or data is None or self.ensure_ascii or not self.compact
+            or self.get_indent(accepted_media_type, renderer_context or {}) is not None
+        ):
+            return super().render(data, accepted_media_type, renderer_context)
+        try:
+            ret = orjson.dumps(
+                data, default=_encoder.default, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
+            )
+        except orjson.JSONEncodeError:
+            # Such as integers beyond 64 bits, which the json module can write
+            return super().render(data, accepted_media_type, renderer_context)
+        # Escaped like DRF does, to keep the output a strict JavaScript subset
+        return ret.replace('\u2028'.encode(), b'\\u2028').replace('\u2029'.encode(), b'\\u2029')
+
+
+class FastJSONParser(JSONParser):
+    """JSONParser decoding with orjson where available"""
+    renderer_class = FastJSONRenderer
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        encoding = (parser_context or {}).get('encoding', 'utf-8')
+        if orjson is None or encoding.lower().replace('-', '') != 'utf8':
+            return super().parse(stream, media_type, parser_context)
+        try:
+            return orjson.loads(stream.read())
+        except orjson.JSONDecodeError as exc:
+            raise ParseError('JSON parse error - %s' % str(exc))
+
+
+class NDJSONRenderer(FastJSONRenderer):
+    """Newline-delimited JSON, one document per line, for streamed exports"""
+    media_type = 'application/x-ndjson'
+    format = 'ndjson'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        # A single document, such as an error, is a one line stream
+        if data is None:
+            return b''
+        return super().render(data, None, renderer_context) + b'\n'
+
+
+class MessagePackRenderer(BaseRenderer):
+    media_type = 'application/msgpack'
+    format = 'msgpack'
+    charset = None
+    render_style = 'binary'
+    available = msgpack is not None
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        return msgpack.packb(data, default=_encoder.default, use_bin_type=True)
+
+
+class MessagePackParser(BaseParser):
+    media_type = 'application/msgpack'
+    renderer_class = MessagePackRenderer
+    available = msgpack is not None
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        try:
+            return msgpack.unpackb(stream.read(), raw=False)
+        except ValueError as exc:
+            raise ParseError('MessagePack parse error - %s' % str(exc))
+
+
+class AvailableFormatsNegotiation(DefaultContentNegotiation):
+    """Content negotiation that leaves out formats whose library is not installed"""
+
+    def select_parser(self, request, parsers):
+        return super().select_parser(request, [parser for parser in parsers if getattr(parser, 'available', True)])
+
+    def select_renderer(self, request, renderers, format_suffix=None):
+        available = [renderer for renderer in renderers if getattr(renderer, 'available', True)]
+        return super().select_renderer(request, available, format_suffix)
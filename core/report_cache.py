@@ -0,0 +1,203 @@
+"""
+Content-addressed cache of generated report files.
+
+A cache key is a hash of everything that determines a report's content: the
+entity type and fields, the user's filters, the role-based restrictions
+applied on top of them, the output format, the title and description the
+file is headed with, the user a PDF names and the data version of every
+model the report reads from. Data versions are tokens kept as small files
+next to the cache and replaced whenever a change to a model's rows is
+committed, so an unchanged report can be served straight from disk without
+querying its data, by any worker process.
+"""
+import hashlib
+import json
+import os
+import uuid
+
+from django.conf import settings
+from django.core.exceptions import FieldDoesNotExist
+from django.db import transaction
+
+from .reports import ENTITY_MODELS, get_field_options
+from .scopes import RoleScope, get_scope_models
+
+# Bump to invalidate every cached report after a change to report rendering
+CACHE_FORMAT_VERSION = 1
+
+EXTENSIONS = {'excel': 'xlsx', 'pdf': 'pdf'}
+
+
+def get_report_models(entity_type, fields):
+    """Models whose data a report with these fields reads"""
+    base = ENTITY_MODELS.get(entity_type)
+    if base is None:
+        return set()
+    models = {base}
+    for field in fields:
+        model = base
+        for part in field.split('__')[:-1]:
+            try:
+                model = model._meta.get_field(part).related_model
+            except FieldDoesNotExist:
+                break
+            if model is None:
+                break
+            models.add(model)
+    return models
+
+
+def get_cached_models():
+    """Every model that some report field can read from"""
+    models = set()
+    for entity_type, fields in get_field_options().items():
+        models |= get_report_models(entity_type, fields)
+    return models
+
+
+def _version_path(model):
+    return os.path.join(settings.REPORT_CACHE_ROOT, 'versions', model._meta.label_lower)
+
+
+def get_data_version(model):
+    """Current data version token of `model`"""
+    try:
+        with open(_version_path(model)) as version_file:
+            return version_file.read()
+    except FileNotFoundError:
+        return '0'
+
+
+def bump_data_version(model):
+    """
+    Give `model` a new data version once the current transaction commits,
+    invalidating every report that reads it. Bumped any earlier, a report
+    read meanwhile, without the uncommitted changes, would be cached under
+    the new version.
+    """
+    transaction.on_commit(lambda: _write_data_version(model))
+
+
+def _write_data_version(model):
+    path = _version_path(model)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f'{path}.{uuid.uuid4().hex}'
+    with open(tmp_path, 'w') as version_file:
+        version_file.write(uuid.uuid4().hex)
+    os.replace(tmp_path, path)
+
+
+def report_cache_key(user, entity_type, fields, filters, format_type, title='', description=''):
+    """
+    Hash identifying the content of a report generated for `user`, headed
+    with `title` and `description`. PDF files also name the user who
+    generated them, so they are cached per user.
+    """
+    # Filters may traverse relations too, so they count towards the data read
+    models = get_report_models(entity_type, list(fields) + list(filters))
+    # So do the rows the role restriction looks at
+    models |= get_scope_models(ENTITY_MODELS.get(entity_type))
+    models = sorted(models, key=lambda model: model._meta.label_lower)
+    payload = {
+        'cache_format': CACHE_FORMAT_VERSION,
+        'entity_type': entity_type,
+        'fields': list(fields),
+        'filters': filters,
+        'role_scope': RoleScope(user).describe(ENTITY_MODELS.get(entity_type)),
+        'format': format_type,
+        'title': title,
+        'description': description,
+        'generated_by': user.pk if format_type == 'pdf' else None,
+        'data_versions': {model._meta.label_lower: get_data_version(model) for model in models},
+    }
+    encoded = json.dumps(payload, sort_keys=True, default=str).encode('utf-8')
+    return hashlib.sha256(encoded).hexdigest()
+
+
+class ReportCache:
+    """
+    Report files stored on local disk under their cache key.
+
+    Entries are evicted least recently used first once the cache grows past
+    `max_bytes`; a hit refreshes the entry's modification time.
+    """
+
+    def __init__(self, root=None, max_bytes=None):
+        self._root = root
+        self._max_bytes = max_bytes
+
+    @property
+    def root(self):
+        return os.path.join(self._root or settings.REPORT_CACHE_ROOT, 'reports')
+
+    @property
+    def max_bytes(self):
+        return self._max_bytes if self._max_bytes is not None else settings.REPORT_CACHE_MAX_BYTES
+
+    def path(self, key, format_type):
+        return os.path.join(self.root, key[:2], f'{key}.{EXTENSIONS[format_type]}')
+
+    def get(self, key, format_type):
+        """Path of the cached file for `key`, or None on a miss"""
+        path = self.path(key, format_type)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return path
+
+    def store(self, key, format_type, content):
+        """Cache a fully rendered report"""
+        for _ in self.store_stream(key, format_type, [content]):
+            pass
+
+    def store_stream(self, key, format_type, chunks):
+        """
+        Pass `chunks` through while writing them to the cache.
+
+        The entry only becomes visible once every chunk has been written, so
+        an interrupted download never leaves a truncated report behind.
+        """
+        path = self.path(key, format_type)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f'{path}.{uuid.uuid4().hex}.part'
+        completed = False
+        try:
+            with open(tmp_path, 'wb') as output:
+                for chunk in chunks:
+                    output.write(chunk)
+                    yield chunk
+            os.replace(tmp_path, path)
+            completed = True
+        finally:
+            if not completed and os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        self.evict()
+
+    def evict(self):
+        """Remove least recently used entries until the cache fits in max_bytes"""
+        entries = []
+        total = 0
+        for dirpath, _, filenames in os.walk(self.root):
+            for filename in filenames:
+                if filename.endswith('.part'):
+                    continue
+                path = os.path.join(dirpath, filename)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+                total += stat.st_size
+
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+
+report_cache = ReportCache()
@@ -0,0 +1,308 @@
+"""
+Report query compilation.
+
+A report template is a list of (possibly related) field paths such as
+`case__beneficiary__name`. Rather than walking those paths attribute by
+attribute on every model instance, which fires a lazy foreign-key query per
+row per relation, the paths are validated against the fields a report may
+expose and compiled into a single projected `values_list()` query.
+"""
+import os
+import threading
+import time
+from contextlib import contextmanager
+from datetime import timedelta
+from io import BytesIO
+
+from django.conf import settings
+from django.db import connection
+from django.template.loader import get_template
+from django.utils import timezone
+from django.utils.text import slugify
+from xhtml2pdf import pisa
+
+from .models import (
+    Beneficiary, Case, Assessment, CaseNote, Program, BeneficiaryCategory, BeneficiaryFundingLedger, ReportRun
+)
+from .metrics import REGISTRY, record_report
+from .scopes import RoleScope
+from .xlsx import XlsxStreamWriter
+
+# Number of rows fetched from the database per round trip during exports
+EXPORT_CHUNK_SIZE = 2000
+
+# How often (in rows) a background run records its progress
+PROGRESS_INTERVAL = 5000
+
+# Model backing each of ReportTemplate.ENTITY_CHOICES
+ENTITY_MODELS = {
+    'beneficiary': Beneficiary,
+    'case': Case,
+    'assessment': Assessment,
+    'case_note': CaseNote,
+    'program': Program,
+    'category': BeneficiaryCategory,
+    'funding': BeneficiaryFundingLedger,
+}
+
+
+class ReportFieldError(ValueError):
+    """Raised when a report asks for an entity type or field it may not use"""
+
+
+def get_field_options():
+    """Get available fields for each entity type"""
+    return {
+        'beneficiary': [
+            'id', 'name', 'dob', 'gender', 'address', 'category__name',
+            'program__name', 'created_at', 'updated_at'
+        ],
+        'case': [
+            'id', 'title', 'beneficiary__name', 'case_manager__username',
+            'status', 'description', 'opened_date', 'closed_date',
+            'created_at', 'updated_at'
+        ],
+        'assessment': [
+            'id', 'title', 'case__title', 'case__beneficiary__name',
+            'created_by__username', 'amount_received', 'year',
+            'created_at', 'updated_at'
+        ],
+        'case_note': [
+            'id', 'case__title', 'case__beneficiary__name',
+            'created_by__username', 'content', 'created_at', 'updated_at'
+        ],
+        'program': [
+            'id', 'name', 'description', 'monthly_amount',
+            'next_program__name'
+        ],
+        'category': [
+            'id', 'name', 'description', 'max_annual_amount'
+        ],
+        'funding': [
+            'beneficiary__name', 'beneficiary__category__name', 'year',
+            'total_received', 'assessment_count', 'last_income', 'updated_at'
+        ]
+    }
+
+
+def get_field_label(field):
+    """Human readable column header for a field path"""
+    return field.replace('__', ' ').replace('_', ' ').title()
+
+
+class ReportQuery:
+    """
+    A validated projection of report fields for one entity type.
+
+    All related fields are resolved by joins in the same statement, so a
+    report costs one query no matter how many rows or relations it has.
+    """
+
+    def __init__(self, entity_type, fields):
+        options = get_field_options()
+        if entity_type not in options:
+            raise ReportFieldError(f"Unknown report entity type '{entity_type}'")
+
+        if not fields:
+            raise ReportFieldError("The report does not select any fields")
+
+        invalid = [field for field in fields if field not in options[entity_type]]
+        if invalid:
+            raise ReportFieldError(f"Fields not available for {entity_type} reports: {', '.join(invalid)}")
+
+        self.entity_type = entity_type
+        self.model = ENTITY_MODELS[entity_type]
+        self.fields = list(fields)
+
+    @classmethod
+    def for_template(cls, template):
+        return cls(template.entity_type, template.get_fields_list())
+
+    @property
+    def headers(self):
+        return [get_field_label(field) for field in self.fields]
+
+    def project(self, queryset):
+        """Project `queryset` onto the report fields as value tuples"""
+        return queryset.values_list(*self.fields)
+
+    def iter_rows(self, queryset, chunk_size=2000):
+        """Stream the projected rows, reading `chunk_size` rows per round trip"""
+        return self.project(queryset).iterator(chunk_size=chunk_size)
+
+
+def build_report_queryset(user, entity_type, filters=None):
+    """Get the data for a report based on the entity type, filters and the user's role"""
+    if entity_type not in ENTITY_MODELS:
+        return []
+
+    # Apply role-based restrictions
+    queryset = RoleScope(user).queryset(ENTITY_MODELS[entity_type])
+
+    # Apply filters
+    for key, value in (filters or {}).items():
+        if value:  # Only apply non-empty filters
+            queryset = queryset.filter(**{key: value})
+
+    return queryset
+
+
+def stream_excel_report(title, query, rows):
+    """Yield an Excel workbook of `rows` as byte chunks"""
+    writer = XlsxStreamWriter(title, query.headers)
+    return writer.stream(rows, footer=lambda count: ['Summary', f"Total Records: {count}"])
+
+
+def render_pdf_report(title, description, query, rows, generated_by):
+    """Render `rows` as a PDF document, returning its bytes or None on failure"""
+    rows = list(rows)
+
+    # Prepare context for the template
+    context = {
+        'title': title,
+        'description': description,
+        'headers': query.headers,
+        'rows': rows,
+        'total_records': len(rows),
+        'generated_by': generated_by,
+        'generated_at': timezone.now(),
+    }
+
+    # Render the template
+    html_string = get_template('reports/pdf_report_template.html').render(context)
+
+    # Create PDF
+    result = BytesIO()
+    pdf = pisa.pisaDocument(BytesIO(html_string.encode("UTF-8")), result)
+    if pdf.err:
+        return None
+    return result.getvalue()
+
+
+def _track_progress(rows, total, run_id):
+    """Pass rows through while periodically recording the run's progress"""
+    for written, row in enumerate(rows, 1):
+        if written % PROGRESS_INTERVAL == 0 and total:
+            ReportRun.objects.filter(pk=run_id).update(progress=min(99, written * 100 // total))
+        yield row
+
+
+@contextmanager
+def _heartbeat(run_id, interval=None):
+    """
+    Touch the run's `updated_at` every `interval` seconds while the block
+    runs, from a thread, so that a run rendering for long without recording
+    progress, such as a large PDF, is not taken for one left by a stopped
+    worker (see fail_stale_report_runs)
+    """
+    interval = interval or settings.REPORT_RUN_TIMEOUT / 4
+    stopped = threading.Event()
+
+    def beat():
+        try:
+            while not stopped.wait(interval):
+                ReportRun.objects.filter(pk=run_id, status='running').update(updated_at=timezone.now())
+        finally:
+            # The thread's own connection
+            connection.close()
+
+    thread = threading.Thread(target=beat, name=f'report-run-{run_id}-heartbeat', daemon=True)
+    thread.start()
+    try:
+        yield
+    finally:
+        stopped.set()
+        thread.join()
+
+
+def execute_report_run(run_id):
+    """
+    Generate the file for a queued report run.
+
+    Runs inside a report worker process. The data is scoped to the role of
+    the user who requested the run, and the file is written to a temporary
+    name first so a half-written artifact is never served.
+    """
+    with _heartbeat(run_id):
+        _generate_report_run(run_id)
+    # Pool processes exit without running exit handlers, so write the metrics now
+    REGISTRY.maybe_flush(force=True)
+    return run_id
+
+
+def _generate_report_run(run_id):
+    run = ReportRun.objects.select_related('created_by').get(pk=run_id)
+    path = None
+    started = time.perf_counter()
+    completed = False
+    try:
+        query = ReportQuery(run.entity_type, run.get_fields_list())
+        queryset = build_report_queryset(run.created_by, run.entity_type, run.get_filters_dict())
+        total = queryset.count()
+        rows = _track_progress(query.iter_rows(queryset, chunk_size=EXPORT_CHUNK_SIZE), total, run.pk)
+
+        extension = 'xlsx' if run.format == 'excel' else 'pdf'
+        artifact = f"{run.pk}/{slugify(run.name) or 'report'}.{extension}"
+        path = os.path.join(settings.REPORT_ARTIFACT_ROOT, artifact)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        with open(path + '.part', 'wb') as output:
+            if run.format == 'excel':
+                for chunk in stream_excel_report(run.name, query, rows):
+                    output.write(chunk)
+            else:
+                content = render_pdf_report(run.name, '', query, rows, run.created_by.username)
+                if content is None:
+                    raise RuntimeError('Error generating PDF')
+                output.write(content)
+        os.replace(path + '.part', path)
+
+        ReportRun.objects.filter(pk=run.pk).update(
+            status='completed', progress=100, row_count=total, artifact=artifact,
+            finished_at=timezone.now(), updated_at=timezone.now(),
+        )
+        completed = True
+    except Exception as e:
+        if path and os.path.exists(path + '.part'):
+            os.remove(path + '.part')
+        ReportRun.objects.filter(pk=run.pk).update(
+            status='failed', error=str(e), finished_at=timezone.now(), updated_at=timezone.now(),
+        )
+    record_report(run.format, run.entity_type, 'background', time.perf_counter() - started, completed)
+
+
+def claim_report_run(run_id):
+    """Atomically move a queued run to running, returning whether this caller got it"""
+    now = timezone.now()
+    return ReportRun.objects.filter(pk=run_id, status='queued').update(
+        status='running', started_at=now, updated_at=now,
+    ) == 1
+
+
+def release_report_run(run_id):
+    """Put a claimed run back in the queue, when it could not be started"""
+    ReportRun.objects.filter(pk=run_id, status='running').update(
+        status='queued', started_at=None, updated_at=timezone.now(),
+    )
+
+
+def fail_report_run(run_id, error):
+    """Fail a running run whose process raised or died before recording how it ended"""
+    now = timezone.now()
+    ReportRun.objects.filter(pk=run_id, status='running').update(
+        status='failed', error=str(error) or type(error).__name__, finished_at=now, updated_at=now,
+    )
+
+
+def fail_stale_report_runs(exclude=()):
+    """
+    Fail the runs left running by a report worker that stopped, found by
+    their heartbeat not having touched them for REPORT_RUN_TIMEOUT seconds.
+    Returns how many there were.
+    """
+    now = timezone.now()
+    return ReportRun.objects.filter(
+        status='running', updated_at__lt=now - timedelta(seconds=settings.REPORT_RUN_TIMEOUT),
+    ).exclude(pk__in=list(exclude)).update(
+        status='failed', error='The report worker stopped before the run finished.', finished_at=now, updated_at=now,
+    )
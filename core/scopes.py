@@ -0,0 +1,143 @@
+"""
+Role-based visibility of records.
+
+RoleScope holds the rules for which rows of each model a user's role may
+see, so list and detail views, the API and reports all restrict querysets
+the same way. Rules are expressed as filters on the queryset itself: a
+foreign key comparison or a join where the rule follows a relation, such
+as the CaseContributor rows of the cases a field officer has written notes
+or assessments for, or a subquery where a join could match several rows.
+Each rule joins at most one row per record, so no ids are read into Python
+and no DISTINCT is needed to undo duplicates.
+"""
+from django.db.models import Q
+
+from .models import (
+    Case, CaseNote, Assessment, Referral, Alert, ActionPlan, BeneficiaryProgress, BeneficiaryFundingLedger, ReportRun
+)
+
+# Returned by a rule when the role may see no rows of the model at all
+NOTHING = object()
+
+
+def _case_rule(user):
+    if user.role == 'case_manager':
+        return Q(case_manager=user)
+    if user.role == 'field_officer':
+        # Cases they have written notes or assessments for, one contributor row each
+        return Q(contributors__user=user)
+    return None
+
+
+def _case_record_rule(user):
+    """Notes and assessments: those of managed cases, or a field officer's own"""
+    if user.role == 'case_manager':
+        return Q(case__case_manager=user)
+    if user.role == 'field_officer':
+        return Q(created_by=user)
+    return None
+
+
+def _referral_rule(user):
+    if user.role in ('field_officer', 'case_manager', 'partner_organisation'):
+        return Q(referred_by=user) | Q(referred_to_user=user)
+    return None
+
+
+def _action_plan_rule(user):
+    if user.role == 'case_manager':
+        return Q(created_by=user)
+    if user.role == 'admin':
+        return None
+    return NOTHING
+
+
+def _progress_rule(user):
+    if user.role == 'case_manager':
+        return Q(case__case_manager=user)
+    if user.role in ('admin', 'monitoring_and_evaluation'):
+        return None
+    return NOTHING
+
+
+def _funding_rule(user):
+    """
+    Yearly totals span every case of a beneficiary: case managers see those
+    of the beneficiaries they manage a case for, field officers none
+    """
+    if user.role == 'case_manager':
+        # A subquery, as a manager may have several cases of the same beneficiary
+        return Q(beneficiary__in=Case.objects.filter(case_manager=user).values('beneficiary_id'))
+    if user.role == 'field_officer':
+        return NOTHING
+    return None
+
+
+def _own_rule(user):
+    return Q(user=user)
+
+
+def _requested_rule(user):
+    return Q(created_by=user)
+
+
+# model -> rule(user) returning a Q, None for every row, or NOTHING
+SCOPE_RULES = {
+    Case: _case_rule,
+    CaseNote: _case_record_rule,
+    Assessment: _case_record_rule,
+    Referral: _referral_rule,
+    ActionPlan: _action_plan_rule,
+    BeneficiaryProgress: _progress_rule,
+    BeneficiaryFundingLedger: _funding_rule,
+    Alert: _own_rule,
+    ReportRun: _requested_rule,
+}
+
+
+# model -> other models its rule reads, whose changes can change what is visible
+SCOPE_DEPENDENCIES = {
+    # CaseContributor rows change together with these
+    Case: {CaseNote, Assessment},
+    CaseNote: {Case},
+    Assessment: {Case},
+    BeneficiaryProgress: {Case},
+    BeneficiaryFundingLedger: {Case},
+}
+
+
+def get_scope_models(model):
+    return SCOPE_DEPENDENCIES.get(model, set())
+
+
+class RoleScope:
+    """The rows of each model `user` may see, given their role"""
+
+    def __init__(self, user):
+        self.user = user
+
+    def condition(self, model):
+        """Q restricting `model` for the user, None if unrestricted, or NOTHING"""
+        rule = SCOPE_RULES.get(model)
+        return rule(self.user) if rule is not None else None
+
+    def filter(self, queryset):
+        """`queryset` restricted to the rows the user may see"""
+        condition = self.condition(queryset.model)
+        if condition is NOTHING:
+            return queryset.none()
+        if condition is None:
+            return queryset
+        return queryset.filter(condition)
+
+    def queryset(self, model):
+        return self.filter(model._default_manager.all())
+
+    def describe(self, model):
+        """JSON-serializable identity of the restriction on `model`, equal for users who see the same rows"""
+        condition = self.condition(model)
+        if condition is NOTHING:
+            return {'nothing': True}
+        if condition is None:
+            return {}
+        return {'role': self.user.role, 'user': self.user.pk}
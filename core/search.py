@@ -0,0 +1,266 @@
+"""
+Full-text search for the list views.
+
+Each searchable model has a SearchIndex naming the text it is found by,
+including text of related rows such as the beneficiary's name on a case.
+A search backend keeps a document per row and turns a search string into a
+filtered queryset annotated with a `search_rank`, lower ranking first.
+
+The SQLite backend stores documents in FTS5 tables and matches every word
+of the search as a prefix, ranked by BM25. Documents are rewritten from
+model signals, including when a related row whose text they copy changes,
+and `rebuild_search_index` recreates them from scratch. Databases without
+FTS5 fall back to substring matching on the source columns.
+"""
+import re
+from functools import reduce
+from operator import or_
+
+from django.conf import settings
+from django.db import connection
+from django.db.models import Expression, F, FloatField, Q, Value
+from django.db.models.expressions import RawSQL
+from django.utils.module_loading import import_string
+
+from .models import ActionPlan, Beneficiary, Case, CaseNote, Referral
+
+SEARCH_BATCH_SIZE = 1000
+
+_search_backend = None
+
+
+class SearchIndex:
+    """The text columns `model` is searched by, as paths that may follow foreign keys"""
+
+    def __init__(self, name, model, fields):
+        self.name = name
+        self.model = model
+        self.fields = fields
+
+    def documents(self, queryset):
+        """(pk, texts) for every row of `queryset`, one text per field"""
+        rows = queryset.order_by().values_list('pk', *self.fields)
+        for pk, *texts in rows.iterator(chunk_size=SEARCH_BATCH_SIZE):
+            yield pk, ['' if text is None else str(text) for text in texts]
+
+    def dependencies(self):
+        """
+        (related model, path to it, attribute) for every attribute of a
+        related row that the documents copy text from or through.
+        """
+        for path in self.fields:
+            parts = path.split('__')
+            model = self.model
+            for idx, part in enumerate(parts[:-1]):
+                model = model._meta.get_field(part).related_model
+                attname = model._meta.get_field(parts[idx + 1]).attname
+                yield model, '__'.join(parts[:idx + 1]), attname
+
+
+SEARCH_INDEXES = [
+    SearchIndex('beneficiary', Beneficiary, ['name', 'address']),
+    SearchIndex('case', Case, ['title', 'description', 'beneficiary__name']),
+    SearchIndex('case_note', CaseNote, ['content', 'case__title', 'case__beneficiary__name']),
+    SearchIndex('referral', Referral, ['beneficiary__name', 'referred_to_organization', 'reason']),
+    SearchIndex('action_plan', ActionPlan, ['title', 'description', 'goals', 'case__title', 'case__beneficiary__name']),
+]
+
+INDEXES_BY_MODEL = {index.model: index for index in SEARCH_INDEXES}
+
+
+def get_search_index(model):
+    return INDEXES_BY_MODEL[model]
+
+
+def get_indexed_models():
+    return set(INDEXES_BY_MODEL)
+
+
+def get_watched_models():
+    """Models whose changes can alter documents of another model"""
+    return {model for index in SEARCH_INDEXES for model, _, _ in index.dependencies()}
+
+
+def get_watched_attnames(model):
+    return {attname for index in SEARCH_INDEXES for related, _, attname in index.dependencies() if related is model}
+
+
+def get_stale_documents(instance, changed):
+    """(index, queryset) of the documents that copy the `changed` attributes of `instance`"""
+    for index in SEARCH_INDEXES:
+        paths = {
+            path for related, path, attname in index.dependencies()
+            if isinstance(instance, related) and attname in changed
+        }
+        if paths:
+            condition = reduce(or_, (Q(**{path: instance.pk}) for path in paths))
+            yield index, index.model._default_manager.filter(condition)
+
+
+def match_expression(query):
+    """FTS5 query matching every word of `query` as a prefix, or None if it has no words"""
+    words = re.findall(r'\w+', query)
+    if not words:
+        return None
+    return ' '.join(f'"{word}"*' for word in words)
+
+
+class SearchBackend:
+    """Keeps search documents and finds rows by them"""
+
+    def update(self, index, queryset):
+        """Write the documents of the rows of `queryset`"""
+
+    def remove(self, index, pks):
+        """Delete the documents of rows that no longer exist"""
+
+    def rebuild(self, index):
+        """Recreate every document of `index`, returning the number written"""
+        return 0
+
+    def filter(self, queryset, index, query):
+        raise NotImplementedError
+
+
+class SubstringBackend(SearchBackend):
+    """Substring matching of the whole search on the source columns, unranked"""
+
+    def filter(self, queryset, index, query):
+        condition = reduce(or_, (Q(**{f'{field}__icontains': query}) for field in index.fields))
+        return queryset.filter(condition).annotate(search_rank=Value(0.0))
+
+
+class MatchRank(Expression):
+    """
+    BM25 rank of the row in an FTS5 table's matches for an expression, read
+    by the row's primary key, so it stays valid however the queryset is
+    aliased or nested
+    """
+    output_field = FloatField()
+
+    def __init__(self, table, expression, pk=None):
+        super().__init__()
+        self.table = table
+        self.expression = expression
+        self.pk = pk
+
+    def get_source_expressions(self):
+        return [self.pk] if self.pk is not None else []
+
+    def set_source_expressions(self, exprs):
+        if exprs:
+            self.pk, = exprs
+
+    def resolve_expression(self, query=None, allow_joins=True, reuse=None, summarize=False, for_save=False):
+        clone = self.copy()
+        clone.pk = F('pk').resolve_expression(query, allow_joins, reuse, summarize, for_save)
+        return clone
+
+    def as_sql(self, compiler, connection):
+        pk_sql, pk_params = compiler.compile(self.pk)
+        # An FTS5 query bounded by rowid looks up the one row in the full-text index
+        return (
+            f'(SELECT rank FROM "{self.table}" WHERE "{self.table}" MATCH %s AND rowid = {pk_sql})',
+            [self.expression, *pk_params],
+        )
+
+
+class SQLiteFTSBackend(SearchBackend):
+    """FTS5 tables named `core_search_<index>`, with the row's primary key as rowid"""
+
+    @staticmethod
+    def is_available():
+        if connection.vendor != 'sqlite':
+            return False
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT sqlite_compileoption_used('ENABLE_FTS5')")
+            return bool(cursor.fetchone()[0])
+
+    def table(self, index):
+        return f'core_search_{index.name}'
+
+    def _columns(self, index):
+        return ', '.join(f'"{field}"' for field in index.fields)
+
+    def create(self, index):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'CREATE VIRTUAL TABLE IF NOT EXISTS {self.table(index)} USING fts5('
+                f"{self._columns(index)}, tokenize='unicode61 remove_diacritics 2', prefix='2 3')"
+            )
+
+    def _insert(self, cursor, index, documents):
+        placeholders = ', '.join(['%s'] * (len(index.fields) + 1))
+        cursor.executemany(
+            f'INSERT INTO {self.table(index)} (rowid, {self._columns(index)}) VALUES ({placeholders})',
+            [(pk, *texts) for pk, texts in documents],
+        )
+
+    def _delete(self, cursor, index, pks):
+        for start in range(0, len(pks), SEARCH_BATCH_SIZE):
+            batch = pks[start:start + SEARCH_BATCH_SIZE]
+            cursor.execute(
+                f'DELETE FROM {self.table(index)} WHERE rowid IN ({", ".join(["%s"] * len(batch))})', batch
+            )
+
+    def update(self, index, queryset):
+        documents = list(index.documents(queryset))
+        with connection.cursor() as cursor:
+            self._delete(cursor, index, [pk for pk, _ in documents])
+            self._insert(cursor, index, documents)
+
+    def remove(self, index, pks):
+        with connection.cursor() as cursor:
+            self._delete(cursor, index, list(pks))
+
+    def rebuild(self, index):
+        with connection.cursor() as cursor:
+            cursor.execute(f'DROP TABLE IF EXISTS {self.table(index)}')
+        self.create(index)
+        written = 0
+        batch = []
+        with connection.cursor() as cursor:
+            for document in index.documents(index.model._default_manager.all()):
+                batch.append(document)
+                if len(batch) >= SEARCH_BATCH_SIZE:
+                    self._insert(cursor, index, batch)
+                    written += len(batch)
+                    batch = []
+            self._insert(cursor, index, batch)
+            written += len(batch)
+        return written
+
+    def filter(self, queryset, index, query):
+        expression = match_expression(query)
+        if expression is None:
+            return queryset.none()
+        table = self.table(index)
+        # Plain expressions rather than a join, so the result composes with
+        # later .values(), .annotate() and use as a subquery
+        matches = RawSQL(f'SELECT rowid FROM "{table}" WHERE "{table}" MATCH %s', [expression])
+        return queryset.filter(pk__in=matches).annotate(search_rank=MatchRank(table, expression))
+
+
+def get_search_backend():
+    """The backend named by the SEARCH_BACKEND setting, or FTS5 where the database has it"""
+    global _search_backend
+    if _search_backend is None:
+        path = getattr(settings, 'SEARCH_BACKEND', None)
+        if path:
+            _search_backend = import_string(path)()
+        elif SQLiteFTSBackend.is_available():
+            _search_backend = SQLiteFTSBackend()
+        else:
+            _search_backend = SubstringBackend()
+    return _search_backend
+
+
+def search(queryset, query):
+    """Rows of `queryset` matching `query`, annotated with their `search_rank`"""
+    return get_search_backend().filter(queryset, get_search_index(queryset.model), query)
+
+
+def rebuild_search_index():
+    """Recreate every search document, returning the number written per index"""
+    backend = get_search_backend()
+    return {index.name: backend.rebuild(index) for index in SEARCH_INDEXES}
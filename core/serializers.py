@@ -1,7 +1,194 @@
+from django.db.models import Prefetch
 from rest_framework import serializers
+from rest_framework.permissions import SAFE_METHODS
 from .models import User, Beneficiary, Case, CaseNote, Assessment, AssessmentQuestion, AssessmentAnswer, Program, BeneficiaryCategory, Referral, Alert, ActionPlan, BeneficiaryProgress
 
-class UserSerializer(serializers.ModelSerializer):
+class FieldSelection:
+    """
+    The fields an API client asked for with `?fields=` and `?expand=`.
+
+    `only` holds the top-level field names to return, or None for all of
+    them. `expand` is a tree of the nested serializers to embed, with
+    `a.b` embedding b inside a, or None to embed every one.
+    """
+
+    def __init__(self, only=None, expand=None):
+        self.only = only
+        self.expand = expand
+
+    @classmethod
+    def from_request(cls, request):
+        """The selection of a read request, None if it selects nothing or writes"""
+        if request is None or request.method not in SAFE_METHODS:
+            return None
+        params = request.query_params
+        if 'fields' not in params and 'expand' not in params:
+            return None
+        only = None
+        if 'fields' in params:
+            only = {name.strip() for name in params['fields'].split(',') if name.strip()}
+        expand = None
+        if 'expand' in params:
+            expand = {}
+            for path in params['expand'].split(','):
+                tree = expand
+                for name in path.strip().split('.'):
+                    if name:
+                        tree = tree.setdefault(name, {})
+        return cls(only, expand)
+
+    def includes(self, name, nested=False):
+        if nested and self.expand is not None and name not in self.expand:
+            return False
+        return self.only is None or name in self.only or (nested and self.expand is not None)
+
+    def nested(self, name):
+        """Selection inside the nested serializer `name`: all of its fields, expanded as asked"""
+        return FieldSelection(expand=None if self.expand is None else self.expand[name])
+
+
+class DynamicFieldsMixin:
+    """
+    Returns only the fields selected with `?fields=` and embeds only the
+    nested serializers named by `?expand=`, when given on a read request.
+    Fields left out are never evaluated.
+    """
+
+    def get_fields(self):
+        fields = super().get_fields()
+        selection = self._get_selection()
+        if selection is None:
+            return fields
+        for name, field in list(fields.items()):
+            nested = isinstance(field, serializers.BaseSerializer)
+            if not selection.includes(name, nested):
+                del fields[name]
+            elif nested:
+                child = getattr(field, 'child', field)
+                if isinstance(child, DynamicFieldsMixin):
+                    child._selection = selection.nested(name)
+        return fields
+
+    def _get_selection(self):
+        # Nested serializers are handed their part by the parent
+        if hasattr(self, '_selection'):
+            return self._selection
+        if self.root is not self and getattr(self.root, 'child', None) is not self:
+            return None
+        return FieldSelection.from_request(self.context.get('request'))
+
+
+class EagerLoadingMixin:
+    """
+    Declares the related rows a serializer reads, so a viewset fetches them
+    together with its queryset instead of once per object.
+
+    `select_related_fields` are foreign key paths read by the serializer's
+    fields, and `prefetch_fields` the nested many=True fields, prefetched
+    with the plan of the nested serializer unless `selection` leaves them out.
+    """
+    select_related_fields = []
+    prefetch_fields = []
+
+    @classmethod
+    def setup_eager_loading(cls, queryset, selection=None):
+        if cls.select_related_fields:
+            queryset = queryset.select_related(*cls.select_related_fields)
+        for name in cls.prefetch_fields:
+            if selection is not None and not selection.includes(name, nested=True):
+                continue
+            field = cls._declared_fields[name]
+            child = field.child
+            related = child.Meta.model._default_manager.all()
+            if isinstance(child, EagerLoadingMixin):
+                related = child.setup_eager_loading(related, selection.nested(name) if selection else None)
+            queryset = queryset.prefetch_related(Prefetch(field.source or name, queryset=related))
+        return queryset
+
+
+# Fields whose representation of a column value is the value itself
+PASSTHROUGH_FIELDS = (
+    serializers.CharField, serializers.IntegerField, serializers.BooleanField, serializers.ChoiceField,
+    serializers.ReadOnlyField, serializers.PrimaryKeyRelatedField,
+)
+
+
+class ValuesSerializerMixin:
+    """
+    Serializes read-only lists straight from `.values()` rows, without
+    building model instances or walking attributes.
+
+    Applies when every selected field reads a column, a column of a
+    related row (`created_by.username`) or a foreign key id, and nested
+    many=True serializers are themselves values serializers over a reverse
+    foreign key; `get_values_plan()` is None otherwise. Values are passed
+    through each field's `to_representation`, so the output is the same
+    as the regular serializer's.
+    """
+
+    def get_values_plan(self):
+        """
+        [(name, lookup, convert)] in field order, where nested serializers
+        appear as (name, child serializer, foreign key attname on the child)
+        instead, or None if some field cannot be read from the row.
+        """
+        if not hasattr(self, '_values_plan'):
+            self._values_plan = self._build_values_plan()
+        return self._values_plan
+
+    def _build_values_plan(self):
+        plan = []
+        for name, field in self.fields.items():
+            if isinstance(field, serializers.ListSerializer):
+                relation = self.Meta.model._meta.get_field(field.source)
+                child = field.child
+                if not (relation.one_to_many and isinstance(child, ValuesSerializerMixin) and child.get_values_plan()):
+                    return None
+                plan.append((name, child, relation.field.attname))
+            elif (
+                isinstance(field, (serializers.BaseSerializer, serializers.ManyRelatedField, serializers.SerializerMethodField))
+                or field.source == '*'
+                or (isinstance(field, serializers.RelatedField) and not isinstance(field, serializers.PrimaryKeyRelatedField))
+            ):
+                return None
+            else:
+                convert = None if isinstance(field, PASSTHROUGH_FIELDS) else field.to_representation
+                plan.append((name, '__'.join(field.source_attrs), convert))
+        return plan
+
+    def values_queryset(self, queryset, *extra):
+        """`queryset` as rows of the primary key, the columns the plan reads and `extra` lookups"""
+        lookups = {queryset.model._meta.pk.attname, *extra}
+        lookups.update(lookup for _, lookup, _ in self.get_values_plan() if isinstance(lookup, str))
+        return queryset.select_related(None).prefetch_related(None).values(*lookups)
+
+    def represent_rows(self, rows):
+        """Representations of `values_queryset` rows, as the serializer would give for their objects"""
+        plan = self.get_values_plan()
+        pk_attname = self.Meta.model._meta.pk.attname
+        data = []
+        for row in rows:
+            item = {}
+            for name, lookup, convert in plan:
+                if isinstance(lookup, str):
+                    value = row[lookup]
+                    item[name] = value if convert is None or value is None else convert(value)
+                else:
+                    item[name] = []
+            data.append(item)
+
+        for name, child, fk_attname in plan:
+            if isinstance(child, str):
+                continue
+            by_parent = {row[pk_attname]: item[name] for row, item in zip(rows, data)}
+            related = child.Meta.model._default_manager.filter(**{f'{fk_attname}__in': list(by_parent)})
+            related = list(child.values_queryset(related, fk_attname))
+            for row, nested in zip(related, child.represent_rows(related)):
+                by_parent[row[fk_attname]].append(nested)
+        return data
+
+
+class UserSerializer(DynamicFieldsMixin, serializers.ModelSerializer):
     class Meta:
         model = User
         fields = ['id', 'username', 'email', 'first_name', 'last_name', 'role']
@@ -11,29 +198,34 @@ class UserSerializer(serializers.ModelSerializer):
         user = User.objects.create_user(**validated_data)
         return user
 
-class BeneficiarySerializer(serializers.ModelSerializer):
+class BeneficiarySerializer(DynamicFieldsMixin, serializers.ModelSerializer):
     class Meta:
         model = Beneficiary
         fields = '__all__'
 
-class CaseNoteSerializer(serializers.ModelSerializer):
+class CaseNoteSerializer(DynamicFieldsMixin, EagerLoadingMixin, ValuesSerializerMixin, serializers.ModelSerializer):
+    select_related_fields = ['created_by']
+
     created_by_username = serializers.ReadOnlyField(source='created_by.username')
 
     class Meta:
         model = CaseNote
         fields = ['id', 'case', 'created_by', 'created_by_username', 'content', 'created_at', 'updated_at']
 
-class AssessmentQuestionSerializer(serializers.ModelSerializer):
+class AssessmentQuestionSerializer(DynamicFieldsMixin, ValuesSerializerMixin, serializers.ModelSerializer):
     class Meta:
         model = AssessmentQuestion
         fields = '__all__'
 
-class AssessmentAnswerSerializer(serializers.ModelSerializer):
+class AssessmentAnswerSerializer(DynamicFieldsMixin, serializers.ModelSerializer):
     class Meta:
         model = AssessmentAnswer
         fields = '__all__'
 
-class AssessmentSerializer(serializers.ModelSerializer):
+class AssessmentSerializer(DynamicFieldsMixin, EagerLoadingMixin, ValuesSerializerMixin, serializers.ModelSerializer):
+    select_related_fields = ['created_by']
+    prefetch_fields = ['questions']
+
     questions = AssessmentQuestionSerializer(many=True, read_only=True)
     created_by_username = serializers.ReadOnlyField(source='created_by.username')
 
@@ -41,7 +233,10 @@ class AssessmentSerializer(serializers.ModelSerializer):
         model = Assessment
         fields = ['id', 'title', 'description', 'case', 'created_by', 'created_by_username', 'questions', 'created_at', 'updated_at']
 
-class CaseSerializer(serializers.ModelSerializer):
+class CaseSerializer(DynamicFieldsMixin, EagerLoadingMixin, serializers.ModelSerializer):
+    select_related_fields = ['beneficiary', 'case_manager']
+    prefetch_fields = ['notes', 'assessments']
+
     beneficiary_name = serializers.ReadOnlyField(source='beneficiary.name')
     case_manager_name = serializers.ReadOnlyField(source='case_manager.username')
     notes = CaseNoteSerializer(many=True, read_only=True)
@@ -52,17 +247,19 @@ class CaseSerializer(serializers.ModelSerializer):
         fields = ['id', 'title', 'beneficiary', 'beneficiary_name', 'case_manager', 'case_manager_name', 
                   'status', 'description', 'opened_date', 'closed_date', 'notes', 'assessments', 
                   'created_at', 'updated_at']
-class ProgramSerializer(serializers.ModelSerializer):
+class ProgramSerializer(DynamicFieldsMixin, serializers.ModelSerializer):
     class Meta:
         model = Program
         fields = '__all__'
 
-class BeneficiaryCategorySerializer(serializers.ModelSerializer):
+class BeneficiaryCategorySerializer(DynamicFieldsMixin, serializers.ModelSerializer):
     class Meta:
         model = BeneficiaryCategory
         fields = '__all__'
 
-class ReferralSerializer(serializers.ModelSerializer):
+class ReferralSerializer(DynamicFieldsMixin, EagerLoadingMixin, serializers.ModelSerializer):
+    select_related_fields = ['beneficiary', 'referred_by', 'referred_to_user', 'case']
+
     beneficiary_name = serializers.ReadOnlyField(source='beneficiary.name')
     referred_by_name = serializers.ReadOnlyField(source='referred_by.username')
     referred_to_user_name = serializers.ReadOnlyField(source='referred_to_user.username')
@@ -75,7 +272,9 @@ class ReferralSerializer(serializers.ModelSerializer):
                   'referred_to_user', 'referred_to_user_name', 'reason', 'status', 
                   'notes', 'created_at', 'updated_at']
 
-class AlertSerializer(serializers.ModelSerializer):
+class AlertSerializer(DynamicFieldsMixin, EagerLoadingMixin, serializers.ModelSerializer):
+    select_related_fields = ['user']
+
     user_name = serializers.ReadOnlyField(source='user.username')
 
     class Meta:
@@ -84,7 +283,9 @@ class AlertSerializer(serializers.ModelSerializer):
                   'related_to', 'related_id', 'is_read', 'created_at']
 
 
-class ActionPlanSerializer(serializers.ModelSerializer):
+class ActionPlanSerializer(DynamicFieldsMixin, EagerLoadingMixin, serializers.ModelSerializer):
+    select_related_fields = ['created_by', 'case__beneficiary']
+
     created_by_name = serializers.ReadOnlyField(source='created_by.username')
     case_title = serializers.ReadOnlyField(source='case.title')
     beneficiary_name = serializers.ReadOnlyField(source='case.beneficiary.name')
@@ -96,7 +297,9 @@ class ActionPlanSerializer(serializers.ModelSerializer):
                   'created_at', 'updated_at']
 
 
-class BeneficiaryProgressSerializer(serializers.ModelSerializer):
+class BeneficiaryProgressSerializer(DynamicFieldsMixin, EagerLoadingMixin, serializers.ModelSerializer):
+    select_related_fields = ['recorded_by', 'beneficiary', 'case', 'action_plan']
+
     recorded_by_name = serializers.ReadOnlyField(source='recorded_by.username')
     beneficiary_name = serializers.ReadOnlyField(source='beneficiary.name')
     case_title = serializers.SerializerMethodField()
@@ -118,3 +321,45 @@ class BeneficiaryProgressSerializer(serializers.ModelSerializer):
         if obj.action_plan:
             return obj.action_plan.title
         return None
+
+
+class PreloadedPrimaryKeyRelatedField(serializers.PrimaryKeyRelatedField):
+    """
+    Resolves ids against the objects a bulk upload loaded for all of its
+    items at once, `context[context_key]` keyed by pk, instead of one query
+    per item. Ids not loaded, including those the user may not write to,
+    are rejected as not existing.
+    """
+
+    def __init__(self, context_key, **kwargs):
+        self.context_key = context_key
+        super().__init__(**kwargs)
+
+    def to_internal_value(self, data):
+        if isinstance(data, bool):
+            self.fail('incorrect_type', data_type=type(data).__name__)
+        try:
+            pk = int(data)
+        except (TypeError, ValueError):
+            self.fail('incorrect_type', data_type=type(data).__name__)
+        obj = self.context[self.context_key].get(pk)
+        if obj is None:
+            self.fail('does_not_exist', pk_value=data)
+        return obj
+
+
+class CaseNoteBulkSerializer(serializers.ModelSerializer):
+    """One item of a bulk note upload; the author is the uploading user"""
+    case = PreloadedPrimaryKeyRelatedField('cases', queryset=Case.objects.all())
+
+    class Meta:
+        model = CaseNote
+        fields = ['case', 'content']
+
+class AssessmentBulkSerializer(serializers.ModelSerializer):
+    """One item of a bulk assessment upload; the author is the uploading user"""
+    case = PreloadedPrimaryKeyRelatedField('cases', queryset=Case.objects.all())
+
+    class Meta:
+        model = Assessment
+        fields = ['case', 'title', 'description', 'amount_received', 'income_amount', 'year']
@@ -0,0 +1,198 @@
+from django.db import transaction
+from django.db.models.signals import pre_save, post_save, post_delete
+
+from .contributors import COUNT_FIELDS, add_contribution, refresh_contributor, remove_contribution
+from .counters import (
+    adjust_counter, apply_counter_changes, counter_key, get_counted_models, get_counter_keys,
+    get_stored_counter_keys
+)
+from .funding import add_to_ledger, refresh_ledger, remove_from_ledger
+from .models import Case, Assessment, BeneficiaryCategory, BeneficiaryProgress
+from .promotions import invalidate_category_index
+from .report_cache import bump_data_version, get_cached_models
+from .search import (
+    get_indexed_models, get_search_backend, get_search_index, get_stale_documents, get_watched_attnames,
+    get_watched_models
+)
+from .sync import get_synced_models, record_deletion
+
+
+def invalidate_cached_reports(sender, **kwargs):
+    """Any change to a model's rows invalidates the cached reports that read it"""
+    bump_data_version(sender)
+
+
+def remember_stored_case(sender, instance, **kwargs):
+    """Record who managed the case and whose it was before this save"""
+    instance._stored_case = None if instance._state.adding else (
+        Case.objects.filter(pk=instance.pk).values('case_manager_id', 'beneficiary_id').first()
+    )
+
+
+def remember_counter_keys(sender, instance, **kwargs):
+    """Record which dashboard counters the instance counted towards before this save"""
+    instance._dashboard_counter_keys = get_stored_counter_keys(instance)
+
+
+def update_counters_on_save(sender, instance, created, **kwargs):
+    old_keys = set() if created else getattr(instance, '_dashboard_counter_keys', set())
+    apply_counter_changes(old_keys, get_counter_keys(instance))
+
+    # Progress records count towards the manager of their case, so they follow a reassigned case
+    stored_case = getattr(instance, '_stored_case', None) if isinstance(instance, Case) else None
+    old_manager_id = stored_case and stored_case['case_manager_id']
+    if stored_case and old_manager_id != instance.case_manager_id:
+        moved = BeneficiaryProgress.objects.filter(case=instance).count()
+        if moved:
+            if old_manager_id is not None:
+                adjust_counter(counter_key('managed_progress_records', old_manager_id), -moved)
+            if instance.case_manager_id is not None:
+                adjust_counter(counter_key('managed_progress_records', instance.case_manager_id), moved)
+
+
+def update_counters_on_delete(sender, instance, **kwargs):
+    apply_counter_changes(get_counter_keys(instance), set())
+
+
+def _get_funding_slice(assessment):
+    """The (beneficiary id, year) ledger row an assessment is rolled up into"""
+    if Assessment.case.is_cached(assessment) and assessment.case.pk == assessment.case_id:
+        return assessment.case.beneficiary_id, assessment.year
+    beneficiary_id = Case.objects.filter(pk=assessment.case_id).values_list('beneficiary_id', flat=True).first()
+    return beneficiary_id, assessment.year
+
+
+def remember_funding_slice(sender, instance, **kwargs):
+    """Record what the assessment contributed to the ledger before this save"""
+    instance._stored_funding = None if instance._state.adding else (
+        Assessment.objects.filter(pk=instance.pk)
+        .values_list('case__beneficiary_id', 'year', 'amount_received', 'income_amount').first()
+    )
+
+
+def update_funding_ledger_on_save(sender, instance, created, **kwargs):
+    beneficiary_id, year = _get_funding_slice(instance)
+    stored = None if created else getattr(instance, '_stored_funding', None)
+    if stored is None:
+        if beneficiary_id is not None:
+            add_to_ledger(beneficiary_id, instance)
+        return
+
+    if stored == (beneficiary_id, year, instance.amount_received, instance.income_amount):
+        return
+    # Edits are rare, so the affected rows are simply recomputed
+    for slice_beneficiary_id, slice_year in {(beneficiary_id, year), stored[:2]}:
+        if slice_beneficiary_id is not None:
+            refresh_ledger(slice_beneficiary_id, slice_year)
+
+
+def update_funding_ledger_on_delete(sender, instance, **kwargs):
+    beneficiary_id, _ = _get_funding_slice(instance)
+    if beneficiary_id is not None:
+        remove_from_ledger(beneficiary_id, instance)
+
+
+def move_case_funding(sender, instance, created, **kwargs):
+    """Assessments of a case moved to another beneficiary move to that beneficiary's ledger"""
+    stored_case = getattr(instance, '_stored_case', None)
+    if not created and stored_case and stored_case['beneficiary_id'] != instance.beneficiary_id:
+        refresh_ledger(stored_case['beneficiary_id'])
+        refresh_ledger(instance.beneficiary_id)
+
+
+def remember_contribution(sender, instance, **kwargs):
+    """Record which case and author a note or assessment counted towards before this save"""
+    instance._stored_contribution = None if instance._state.adding else (
+        sender.objects.filter(pk=instance.pk).values_list('created_by_id', 'case_id').first()
+    )
+
+
+def update_contributors_on_save(sender, instance, created, **kwargs):
+    stored = None if created else getattr(instance, '_stored_contribution', None)
+    if stored is None:
+        add_contribution(instance)
+        return
+    current = (instance.created_by_id, instance.case_id)
+    if stored != current:
+        # Records rarely move, so both rows are simply recomputed
+        refresh_contributor(*stored)
+        refresh_contributor(*current)
+
+
+def update_contributors_on_delete(sender, instance, **kwargs):
+    remove_contribution(instance)
+
+
+def categories_changed(sender, **kwargs):
+    """Rebuild the category threshold index here now, and everywhere once the change is committed"""
+    invalidate_category_index()
+    transaction.on_commit(invalidate_category_index)
+    bump_data_version(BeneficiaryCategory)
+
+
+def update_search_document(sender, instance, **kwargs):
+    get_search_backend().update(get_search_index(sender), sender._default_manager.filter(pk=instance.pk))
+
+
+def remove_search_document(sender, instance, **kwargs):
+    get_search_backend().remove(get_search_index(sender), [instance.pk])
+
+
+def remember_searched_values(sender, instance, **kwargs):
+    """Record the values other models' search documents copy before this save"""
+    attnames = sorted(get_watched_attnames(sender))
+    stored = None if instance._state.adding else (
+        sender._default_manager.filter(pk=instance.pk).values_list(*attnames).first()
+    )
+    instance._searched_values = dict(zip(attnames, stored)) if stored else None
+
+
+def update_dependent_search_documents(sender, instance, created, **kwargs):
+    """Documents copying text from the instance, such as cases of a renamed beneficiary, are rewritten"""
+    stored = None if created else getattr(instance, '_searched_values', None)
+    if not stored:
+        return
+    changed = {attname for attname, value in stored.items() if getattr(instance, attname) != value}
+    if changed:
+        backend = get_search_backend()
+        for index, queryset in get_stale_documents(instance, changed):
+            backend.update(index, queryset)
+
+
+def record_sync_tombstone(sender, instance, **kwargs):
+    """Offline clients are told about deleted rows by their tombstones"""
+    record_deletion(sender, instance.pk)
+
+
+def connect_signals():
+    for model in get_cached_models():
+        post_save.connect(invalidate_cached_reports, sender=model, dispatch_uid=f'report_cache_save_{model._meta.label_lower}')
+        post_delete.connect(invalidate_cached_reports, sender=model, dispatch_uid=f'report_cache_delete_{model._meta.label_lower}')
+
+    for model in get_counted_models():
+        pre_save.connect(remember_counter_keys, sender=model, dispatch_uid=f'counters_pre_save_{model._meta.label_lower}')
+        post_save.connect(update_counters_on_save, sender=model, dispatch_uid=f'counters_save_{model._meta.label_lower}')
+        post_delete.connect(update_counters_on_delete, sender=model, dispatch_uid=f'counters_delete_{model._meta.label_lower}')
+
+    pre_save.connect(remember_stored_case, sender=Case, dispatch_uid='stored_case_pre_save')
+    post_save.connect(move_case_funding, sender=Case, dispatch_uid='funding_ledger_case_save')
+    pre_save.connect(remember_funding_slice, sender=Assessment, dispatch_uid='funding_ledger_pre_save')
+    post_save.connect(update_funding_ledger_on_save, sender=Assessment, dispatch_uid='funding_ledger_save')
+    post_delete.connect(update_funding_ledger_on_delete, sender=Assessment, dispatch_uid='funding_ledger_delete')
+    post_save.connect(categories_changed, sender=BeneficiaryCategory, dispatch_uid='category_index_save')
+    post_delete.connect(categories_changed, sender=BeneficiaryCategory, dispatch_uid='category_index_delete')
+
+    for model in get_indexed_models():
+        post_save.connect(update_search_document, sender=model, dispatch_uid=f'search_save_{model._meta.label_lower}')
+        post_delete.connect(remove_search_document, sender=model, dispatch_uid=f'search_delete_{model._meta.label_lower}')
+    for model in get_watched_models():
+        pre_save.connect(remember_searched_values, sender=model, dispatch_uid=f'search_pre_save_{model._meta.label_lower}')
+        post_save.connect(update_dependent_search_documents, sender=model, dispatch_uid=f'search_dependents_{model._meta.label_lower}')
+
+    for model in COUNT_FIELDS:
+        pre_save.connect(remember_contribution, sender=model, dispatch_uid=f'contributors_pre_save_{model._meta.label_lower}')
+        post_save.connect(update_contributors_on_save, sender=model, dispatch_uid=f'contributors_save_{model._meta.label_lower}')
+        post_delete.connect(update_contributors_on_delete, sender=model, dispatch_uid=f'contributors_delete_{model._meta.label_lower}')
+
+    for model in get_synced_models():
+        post_delete.connect(record_sync_tombstone, sender=model, dispatch_uid=f'sync_tombstone_{model._meta.label_lower}')
@@ -0,0 +1,158 @@
+"""
+Delta sync for offline clients.
+
+Field apps keep a copy of the programs, categories, beneficiaries and the
+cases, notes and assessments their user may see. Rather than downloading
+everything again, a client sends the watermark of its last sync and gets
+back only the rows whose `updated_at` is at or after it, plus the rows
+that came into the user's scope since without changing themselves, such
+as the notes of a case reassigned to them.
+
+Rows also leave a user's scope, so for the entities their role restricts
+an incremental sync lists every id the user may still see under `visible`
+and the client drops the rest. For entities the user sees in full, ids of
+rows deleted since are listed under `deleted` instead, from SyncTombstone
+rows recorded when they are deleted. Tombstones are kept for
+SYNC_TOMBSTONE_RETENTION; a client whose watermark is older than that gets
+a full sync.
+
+The watermark handed out trails the time of the sync by a short overlap,
+so rows written by transactions still open at that moment are sent again
+next time rather than missed; clients apply rows by id, so repeats are
+harmless. Rows are encoded straight from `.values()` in chunks.
+"""
+import json
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Exists, OuterRef, Q
+from django.utils import timezone
+
+from .models import Assessment, CaseNote, SyncTombstone
+from .reports import ENTITY_MODELS
+from .scopes import RoleScope
+
+SYNC_CHUNK_SIZE = 2000
+
+# Parents before the rows referring to them, so clients can apply in order
+SYNC_ENTITIES = ['program', 'category', 'beneficiary', 'case', 'case_note', 'assessment']
+
+WATERMARK_OVERLAP = timedelta(seconds=60)
+
+_encoder = DjangoJSONEncoder(separators=(',', ':'))
+
+
+def get_synced_models():
+    return {ENTITY_MODELS[entity]: entity for entity in SYNC_ENTITIES}
+
+
+def record_deletion(model, pk):
+    """Record a deleted row, removing the entity's tombstones past their retention"""
+    entity = get_synced_models()[model]
+    SyncTombstone.objects.filter(entity=entity, deleted_at__lt=timezone.now() - settings.SYNC_TOMBSTONE_RETENTION).delete()
+    SyncTombstone.objects.create(entity=entity, object_id=pk)
+
+
+def get_sync_fields(model):
+    """Names of the columns sent for `model`, foreign keys as ids"""
+    return [field.name for field in model._meta.concrete_fields]
+
+
+def is_restricted(user, entity):
+    """Whether the user's role lets them see only some rows of `entity`"""
+    return RoleScope(user).condition(ENTITY_MODELS[entity]) is not None
+
+
+def _entered_scope(user, entity, since):
+    """
+    Rows that came into the user's scope since `since` without changing
+    themselves, following the rules of core/scopes.py: the notes and
+    assessments of cases reassigned to a case manager, which saves the case,
+    and the cases a field officer has written or moved a record to since.
+    """
+    if entity in ('case_note', 'assessment') and user.role == 'case_manager':
+        return Q(case__updated_at__gte=since)
+    if entity == 'case' and user.role == 'field_officer':
+        return Q(*[
+            Exists(model.objects.filter(case=OuterRef('pk'), created_by=user, updated_at__gte=since))
+            for model in (CaseNote, Assessment)
+        ], _connector=Q.OR)
+    return None
+
+
+def changed_rows(user, entity, since=None):
+    """Rows of `entity` the user may see, changed or come into view at or after `since`, or all of them"""
+    model = ENTITY_MODELS[entity]
+    queryset = RoleScope(user).queryset(model)
+    if since is not None:
+        condition = Q(updated_at__gte=since)
+        entered = _entered_scope(user, entity, since)
+        if entered is not None:
+            condition |= entered
+        queryset = queryset.filter(condition)
+    return queryset.order_by().values_list(*get_sync_fields(model))
+
+
+def visible_ids(user, entity):
+    return RoleScope(user).queryset(ENTITY_MODELS[entity]).order_by().values_list('pk', flat=True)
+
+
+def deleted_ids(entity, since):
+    return (
+        SyncTombstone.objects.filter(entity=entity, deleted_at__gte=since)
+        .order_by().values_list('object_id', flat=True)
+    )
+
+
+def _encode_rows(rows):
+    """JSON array of `rows`, in pieces of up to SYNC_CHUNK_SIZE rows"""
+    yield '['
+    separator = ''
+    batch = []
+    for row in rows.iterator(chunk_size=SYNC_CHUNK_SIZE):
+        batch.append(row)
+        if len(batch) >= SYNC_CHUNK_SIZE:
+            yield separator + _encoder.encode(batch)[1:-1]
+            separator = ','
+            batch = []
+    if batch:
+        yield separator + _encoder.encode(batch)[1:-1]
+    yield ']'
+
+
+def stream_changes(user, since=None):
+    """
+    JSON document of the changes since `since`, or of every row for a full
+    sync, in pieces:
+
+        {"watermark": ..., "full": ..., "fields": {entity: [column, ...]},
+         "changes": {entity: [[value, ...], ...]}, "deleted": {entity: [id, ...]},
+         "visible": {entity: [id, ...]}}
+
+    A watermark from before the oldest tombstones kept gets a full sync.
+    """
+    now = timezone.now()
+    watermark = now - WATERMARK_OVERLAP
+    if since is not None and since < now - settings.SYNC_TOMBSTONE_RETENTION:
+        since = None
+    fields = {entity: get_sync_fields(ENTITY_MODELS[entity]) for entity in SYNC_ENTITIES}
+    yield '{"watermark":%s,"full":%s,"fields":%s,"changes":{' % (
+        _encoder.encode(watermark), 'true' if since is None else 'false', _encoder.encode(fields)
+    )
+    for idx, entity in enumerate(SYNC_ENTITIES):
+        yield ('' if idx == 0 else ',') + _encoder.encode(entity) + ':'
+        yield from _encode_rows(changed_rows(user, entity, since))
+    restricted = [entity for entity in SYNC_ENTITIES if is_restricted(user, entity)]
+    yield '},"deleted":{'
+    if since is not None:
+        yield ','.join(
+            _encoder.encode(entity) + ':' + json.dumps(list(deleted_ids(entity, since)))
+            for entity in SYNC_ENTITIES if entity not in restricted
+        )
+    yield '},"visible":{'
+    if since is not None:
+        for idx, entity in enumerate(restricted):
+            yield ('' if idx == 0 else ',') + _encoder.encode(entity) + ':'
+            yield from _encode_rows(visible_ids(user, entity))
+    yield '}}'
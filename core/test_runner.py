@@ -0,0 +1,32 @@
+"""
+Test runner keeping the files tests write out of the checkout.
+
+Saving almost any model writes report data versions under
+REPORT_CACHE_ROOT, and report runs write artifacts under
+REPORT_ARTIFACT_ROOT. For the whole run both point into a temporary
+directory, removed afterwards, and METRICS_DIR is unset so the requests
+tests make are not added to a running service's metrics.
+"""
+import shutil
+import tempfile
+from pathlib import Path
+
+from django.test.runner import DiscoverRunner
+from django.test.utils import override_settings
+
+
+class TemporaryFilesRunner(DiscoverRunner):
+    def setup_test_environment(self, **kwargs):
+        super().setup_test_environment(**kwargs)
+        self.files_root = Path(tempfile.mkdtemp(prefix='aidconnect-tests-'))
+        self.files_settings = override_settings(
+            REPORT_CACHE_ROOT=self.files_root / 'report_cache',
+            REPORT_ARTIFACT_ROOT=self.files_root / 'report_artifacts',
+            METRICS_DIR=None,
+        )
+        self.files_settings.enable()
+
+    def teardown_test_environment(self, **kwargs):
+        self.files_settings.disable()
+        shutil.rmtree(self.files_root, ignore_errors=True)
+        super().teardown_test_environment(**kwargs)
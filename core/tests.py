@@ -1,3 +1,1495 @@
-from django.test import TestCase
+import gzip
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from io import BytesIO, StringIO
+from unittest import skipIf, skipUnless
+from unittest.mock import patch
+from datetime import date, timedelta
+from decimal import Decimal
 
-# Create your tests here.
+from django.core.management import call_command
+from django.db import connection, transaction
+from django.db.models import Count, Q
+from django.http import HttpResponse
+from django.test import TestCase, TransactionTestCase, RequestFactory, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from django.utils.translation import gettext_lazy
+from rest_framework.renderers import JSONRenderer
+from rest_framework.request import Request
+
+from .models import (
+    User, Beneficiary, Case, CaseNote, Assessment, AssessmentQuestion, Program, BeneficiaryCategory, ReportTemplate,
+    Report, ReportRun, Referral, Alert, ActionPlan, BeneficiaryProgress, DashboardCounter, BeneficiaryFundingLedger,
+    CaseContributor, SyncTombstone
+)
+from .contributors import rebuild_contributors
+from .counters import COUNTERS, compute_counters, counter_key, read_counters, rebuild_counters
+from .funding import get_total_received, get_yearly_totals, get_totals_by_beneficiary, rebuild_ledger
+from .reports import (
+    ReportQuery, ReportFieldError, _heartbeat, get_field_options, claim_report_run, execute_report_run,
+    fail_stale_report_runs,
+)
+from .pagination import KeysetPaginator, InvalidCursor
+from .metrics import REGISTRY, REQUESTS, _flush_on_exit
+from .profiling import QueryProfilingMiddleware, query_signature
+from .query_plans import check_query_plans, full_scans
+from .promotions import CategoryIndex, PromotionPlan, apply_promotions, get_category_index, plan_promotions
+from .renderers import FastJSONParser, FastJSONRenderer, MessagePackRenderer
+from .report_cache import ReportCache, report_cache_key
+from .scopes import RoleScope, SCOPE_RULES
+from .search import SubstringBackend, get_search_index, search
+from .serializers import AssessmentSerializer, CaseNoteSerializer
+from .benchmarks import seed_case_records
+from .views import get_report_data, generate_excel_report, generate_pdf_report
+
+
+def _exit_process(run_id):
+    """Stands in for a report run whose pool process is killed"""
+    os._exit(1)
+
+
+def create_case_data(case_manager, field_officer, count, prefix='Test'):
+    """Create `count` beneficiaries, each with a case, a note and an assessment"""
+    category = BeneficiaryCategory.objects.create(name=f'{prefix} Category', max_annual_amount=1000)
+    program = Program.objects.create(name=f'{prefix} Program', monthly_amount=100)
+    Program.objects.create(name=f'{prefix} Next Program', monthly_amount=200, next_program=program)
+    for idx in range(count):
+        beneficiary = Beneficiary.objects.create(
+            name=f'{prefix} Beneficiary {idx}', dob=date(1980, 1, 1), gender='female',
+            address='Kigali', category=category, program=program,
+        )
+        case = Case.objects.create(title=f'{prefix} Case {idx}', beneficiary=beneficiary, case_manager=case_manager)
+        CaseNote.objects.create(case=case, created_by=field_officer, content=f'Visit {idx}')
+        Assessment.objects.create(title=f'{prefix} Assessment {idx}', case=case, created_by=field_officer)
+
+
+class ReportQueryTests(TestCase):
+    def test_rejects_unknown_entity_and_fields(self):
+        with self.assertRaises(ReportFieldError):
+            ReportQuery('user', ['username'])
+        with self.assertRaises(ReportFieldError):
+            ReportQuery('case', ['case_manager__password'])
+        with self.assertRaises(ReportFieldError):
+            ReportQuery('case', [])
+
+    def test_projects_related_fields(self):
+        user = User.objects.create_user(username='manager', role='case_manager')
+        create_case_data(user, user, 1)
+        rows = list(ReportQuery('assessment', ['title', 'case__beneficiary__name']).project(Assessment.objects.all()))
+        self.assertEqual(rows, [('Test Assessment 0', 'Test Beneficiary 0')])
+
+
+class ReportQueryCountTests(TestCase):
+    """Every report runs a fixed number of queries, however many rows it has"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(username='me', role='monitoring_and_evaluation')
+        cls.field_officer = User.objects.create_user(username='officer', role='field_officer')
+
+    def setUp(self):
+        self.request = RequestFactory().get('/')
+        self.request.user = self.user
+
+    def render_report(self, generator, entity_type):
+        template = ReportTemplate(
+            name=f'{entity_type} report', entity_type=entity_type,
+            fields=json.dumps(get_field_options()[entity_type]),
+            created_by=self.user,
+        )
+        response = generator(self.request, None, get_report_data(self.request, entity_type), template)
+        if response.streaming:
+            b''.join(response.streaming_content)
+        self.assertEqual(response.status_code, 200)
+
+    def test_query_count_is_independent_of_row_count(self):
+        for generator in (generate_excel_report, generate_pdf_report):
+            for entity_type, _ in ReportTemplate.ENTITY_CHOICES:
+                with self.subTest(generator=generator.__name__, entity_type=entity_type):
+                    create_case_data(self.user, self.field_officer, 1, prefix='Small')
+                    with self.assertNumQueries(1):
+                        self.render_report(generator, entity_type)
+
+                    create_case_data(self.user, self.field_officer, 20, prefix='Large')
+                    with self.assertNumQueries(1):
+                        self.render_report(generator, entity_type)
+
+                    Beneficiary.objects.all().delete()
+                    Program.objects.all().delete()
+                    BeneficiaryCategory.objects.all().delete()
+
+
+@override_settings(REPORT_ARTIFACT_ROOT=tempfile.mkdtemp())
+class ReportRunTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='analyst', password='pass', role='monitoring_and_evaluation')
+        create_case_data(self.user, self.user, 3)
+        template = ReportTemplate.objects.create(
+            name='Cases', entity_type='case', fields='["id", "title", "beneficiary__name"]', created_by=self.user
+        )
+        self.report = Report.objects.create(name='All cases', template=template, created_by=self.user)
+        self.client.login(username='analyst', password='pass')
+
+    def test_enqueue_execute_and_download(self):
+        response = self.client.post(reverse('enqueue_report', kwargs={'pk': self.report.pk}))
+        run = ReportRun.objects.get()
+        self.assertRedirects(response, reverse('report_run_detail', kwargs={'pk': run.pk}))
+        self.assertEqual(self.client.get(reverse('report_run_status', kwargs={'pk': run.pk})).json()['status'], 'queued')
+
+        self.assertTrue(claim_report_run(run.pk))
+        self.assertFalse(claim_report_run(run.pk))
+        execute_report_run(run.pk)
+
+        status = self.client.get(reverse('report_run_status', kwargs={'pk': run.pk})).json()
+        self.assertEqual((status['status'], status['progress'], status['row_count']), ('completed', 100, 3))
+        response = self.client.get(status['download_url'])
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(b''.join(response.streaming_content).startswith(b'PK'))
+        self.assertContains(self.client.get(reverse('report_run_list')), 'All cases')
+
+    def test_invalid_fields_fail_the_run(self):
+        run = ReportRun.objects.create(name='Bad', entity_type='case', fields='["secret"]', created_by=self.user)
+        execute_report_run(run.pk)
+        run.refresh_from_db()
+        self.assertEqual(run.status, 'failed')
+        self.assertEqual(self.client.get(reverse('download_report_run', kwargs={'pk': run.pk})).status_code, 404)
+
+    def test_rejects_unknown_format(self):
+        response = self.client.post(reverse('enqueue_report', kwargs={'pk': self.report.pk}), {'format': 'csv'})
+        self.assertRedirects(response, reverse('report_detail', kwargs={'pk': self.report.pk}), fetch_redirect_response=False)
+        self.assertFalse(ReportRun.objects.exists())
+
+    def test_stale_running_runs_fail(self):
+        stale = ReportRun.objects.create(name='Stale', entity_type='case', fields='["title"]', created_by=self.user)
+        fresh = ReportRun.objects.create(name='Fresh', entity_type='case', fields='["title"]', created_by=self.user)
+        claim_report_run(stale.pk)
+        claim_report_run(fresh.pk)
+        ReportRun.objects.filter(pk=stale.pk).update(updated_at=timezone.now() - timedelta(hours=2))
+        self.assertEqual(fail_stale_report_runs(), 1)
+        self.assertEqual(ReportRun.objects.get(pk=stale.pk).status, 'failed')
+        self.assertEqual(ReportRun.objects.get(pk=fresh.pk).status, 'running')
+
+    def test_worker_survives_a_dying_process(self):
+        runs = [
+            ReportRun.objects.create(name=f'Run {idx}', entity_type='case', fields='["title"]', created_by=self.user)
+            for idx in range(2)
+        ]
+        output = StringIO()
+        with patch('core.management.commands.run_report_worker.execute_report_run', _exit_process):
+            call_command('run_report_worker', '--once', '--workers=1', '--poll-interval=0.1', stdout=output)
+        for run in runs:
+            run.refresh_from_db()
+            self.assertEqual(run.status, 'failed')
+            self.assertIn('terminated abruptly', run.error)
+        self.assertIn('starting new ones', output.getvalue())
+
+
+class ReportRunHeartbeatTests(TransactionTestCase):
+    def test_running_reports_are_kept_alive(self):
+        user = User.objects.create_user(username='analyst', role='monitoring_and_evaluation')
+        run = ReportRun.objects.create(name='Slow', entity_type='case', fields='["title"]', created_by=user)
+        claim_report_run(run.pk)
+        ReportRun.objects.filter(pk=run.pk).update(updated_at=timezone.now() - timedelta(hours=2))
+        # Rendering, with no progress recorded, while another worker looks for stale runs
+        with _heartbeat(run.pk, interval=0.05):
+            time.sleep(0.3)
+            self.assertEqual(fail_stale_report_runs(), 0)
+        self.assertEqual(ReportRun.objects.get(pk=run.pk).status, 'running')
+
+
+@override_settings(REPORT_CACHE_ROOT=tempfile.mkdtemp())
+class ReportCacheTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='analyst', password='pass', role='monitoring_and_evaluation')
+        # Data versions change once the data is committed
+        with self.captureOnCommitCallbacks(execute=True):
+            create_case_data(self.user, self.user, 3)
+        template = ReportTemplate.objects.create(
+            name='Cases', entity_type='case', fields='["id", "title", "beneficiary__name"]', created_by=self.user
+        )
+        self.report = Report.objects.create(name='All cases', template=template, created_by=self.user)
+        self.url = reverse('generate_report', kwargs={'pk': self.report.pk})
+        self.client.login(username='analyst', password='pass')
+
+    def download(self):
+        with CaptureQueriesContext(connection) as queries:
+            content = b''.join(self.client.get(self.url).streaming_content)
+        data_queries = [query['sql'] for query in queries if 'core_case' in query['sql']]
+        return content, data_queries
+
+    def test_repeat_download_is_served_from_cache(self):
+        first, data_queries = self.download()
+        self.assertTrue(data_queries)
+
+        second, data_queries = self.download()
+        self.assertEqual(second, first)
+        self.assertEqual(data_queries, [])
+
+    def test_saving_related_data_invalidates_cache(self):
+        self.download()
+        beneficiary = Beneficiary.objects.first()
+        with self.captureOnCommitCallbacks() as callbacks:
+            beneficiary.name = 'Renamed'
+            beneficiary.save()
+
+        # Not before the change is committed, or a report read meanwhile would be cached as current
+        content, data_queries = self.download()
+        self.assertEqual(data_queries, [])
+        for callback in callbacks:
+            callback()
+        content, data_queries = self.download()
+        self.assertTrue(data_queries)
+
+    def test_file_headings_are_part_of_the_key(self):
+        self.download()
+        template = self.report.template
+        template.name = 'Open cases'
+        template.save()
+        content, data_queries = self.download()
+        self.assertTrue(data_queries)
+
+        admin = User.objects.create_user(username='admin', role='admin')
+        other_admin = User.objects.create_user(username='other_admin', role='admin')
+        for format_type, differ in (('pdf', True), ('excel', False)):
+            keys = {report_cache_key(user, 'case', ['id'], {}, format_type) for user in (admin, other_admin)}
+            self.assertEqual(len(keys), 2 if differ else 1, format_type)
+        self.assertNotEqual(
+            report_cache_key(admin, 'case', ['id'], {}, 'excel', 'Cases', 'All of them'),
+            report_cache_key(admin, 'case', ['id'], {}, 'excel', 'Cases', 'Some of them'),
+        )
+
+    def test_ledger_writes_invalidate_funding_reports(self):
+        from openpyxl import load_workbook
+
+        template = ReportTemplate.objects.create(
+            name='Funding', entity_type='funding', fields='["beneficiary__name", "year", "total_received"]',
+            created_by=self.user,
+        )
+        report = Report.objects.create(name='Funding', template=template, created_by=self.user)
+        url = reverse('generate_report', kwargs={'pk': report.pk})
+        case = Case.objects.get(title='Test Case 0')
+        with self.captureOnCommitCallbacks(execute=True):
+            Assessment.objects.filter(case=case).update(amount_received=Decimal('10.00'))
+            rebuild_ledger()
+
+        def total():
+            content = b''.join(self.client.get(url).streaming_content)
+            rows = load_workbook(BytesIO(content)).active.iter_rows(values_only=True)
+            return {row[0]: row[2] for row in rows}['Test Beneficiary 0']
+
+        self.assertEqual(Decimal(str(total())), Decimal('10.00'))
+        # Ledger rows are updated in place, without model signals
+        with self.captureOnCommitCallbacks(execute=True):
+            Assessment.objects.create(
+                title='Follow-up', case=case, created_by=self.user, amount_received=Decimal('20.00'),
+                year=Assessment.objects.get(case=case).year,
+            )
+        self.assertEqual(Decimal(str(total())), Decimal('30.00'))
+
+    def test_role_restrictions_are_part_of_the_key(self):
+        manager = User.objects.create_user(username='manager', role='case_manager')
+        self.assertNotEqual(
+            report_cache_key(self.user, 'case', ['id'], {}, 'excel'),
+            report_cache_key(manager, 'case', ['id'], {}, 'excel'),
+        )
+
+    def test_evicts_least_recently_used_entries(self):
+        cache = ReportCache(root=tempfile.mkdtemp(), max_bytes=10)
+        cache.store('aa1', 'pdf', b'123456')
+        os.utime(cache.path('aa1', 'pdf'), (1, 1))
+        cache.store('bb2', 'pdf', b'123456')
+        self.assertIsNone(cache.get('aa1', 'pdf'))
+        self.assertIsNotNone(cache.get('bb2', 'pdf'))
+
+
+class DashboardQueryBudgetTests(TestCase):
+    """Each dashboard issues a fixed number of queries, however much data there is"""
+
+    # Session and user lookups, the counter lookup and one per recent list shown
+    BUDGETS = {
+        'admin': ('admin_dashboard', 4),
+        'case_manager': ('case_manager_dashboard', 7),
+        'field_officer': ('field_officer_dashboard', 5),
+        'partner_organisation': ('partner_organisation_dashboard', 5),
+        'monitoring_and_evaluation': ('monitoring_and_evaluation_dashboard', 5),
+        'program_director': ('program_director_dashboard', 5),
+    }
+
+    def create_activity(self, user, manager, prefix):
+        create_case_data(manager, user, 12, prefix=prefix)
+        for case in Case.objects.filter(title__startswith=prefix):
+            Referral.objects.create(
+                beneficiary=case.beneficiary, case=case, referred_by=user, referred_to_user=user,
+                referred_to_organization='Partner', reason='Support',
+            )
+            ActionPlan.objects.create(title='Plan', case=case, created_by=user, description='-', goals='-', timeline='-')
+            BeneficiaryProgress.objects.create(beneficiary=case.beneficiary, case=case, recorded_by=user)
+            Alert.objects.create(title='Alert', message='-', user=user)
+        template = ReportTemplate.objects.create(name='T', entity_type='case', fields='["id"]', created_by=user)
+        Report.objects.create(name=f'{prefix} report', template=template, created_by=user)
+
+    def test_dashboards_stay_within_query_budget(self):
+        for role, (url_name, budget) in self.BUDGETS.items():
+            with self.subTest(role=role):
+                user = User.objects.create_user(username=role, password='pass', role=role)
+                manager = user if role == 'case_manager' else User.objects.create_user(username=f'{role}_cm', role='case_manager')
+                self.client.login(username=role, password='pass')
+                # The first load materializes the user's counters
+                self.client.get(reverse(url_name))
+
+                for prefix in (f'{role} small', f'{role} large'):
+                    self.create_activity(user, manager, prefix)
+                    with self.assertNumQueries(budget):
+                        response = self.client.get(reverse(url_name))
+                    self.assertEqual(response.status_code, 200)
+                    self.assertEqual(response['X-Query-Count'], str(budget - 2))
+
+
+class ApiQueryCountTests(TestCase):
+    """API lists fetch related rows up front, so their query count does not grow with the rows listed"""
+
+    ENDPOINTS = ['cases', 'case-notes', 'assessments', 'referrals', 'alerts', 'action-plans', 'beneficiary-progress']
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='admin', password='pass', role='admin')
+        self.client.login(username='admin', password='pass')
+
+    def create_activity(self, prefix, count):
+        create_case_data(self.user, self.user, count, prefix=prefix)
+        for case in Case.objects.filter(title__startswith=prefix):
+            CaseNote.objects.create(case=case, created_by=self.user, content='Follow-up')
+            for assessment in case.assessments.all():
+                assessment.questions.create(text='Income?', question_type='text')
+            Referral.objects.create(
+                beneficiary=case.beneficiary, case=case, referred_by=self.user, referred_to_user=self.user,
+                referred_to_organization='Partner', reason='Support',
+            )
+            plan = ActionPlan.objects.create(title='Plan', case=case, created_by=self.user, description='-', goals='-', timeline='-')
+            BeneficiaryProgress.objects.create(beneficiary=case.beneficiary, case=case, action_plan=plan, recorded_by=self.user)
+            Alert.objects.create(title='Alert', message='-', user=self.user)
+
+    def count_queries(self, url):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return len(queries), len(response.json()['results'])
+
+    def assertConstantQueries(self, url, grow):
+        """Assert `url` issues as many queries after `grow()` adds rows to it as before"""
+        before, listed = self.count_queries(url)
+        grow()
+        after, more = self.count_queries(url)
+        self.assertGreater(more, listed)
+        self.assertEqual(after, before)
+
+    def test_list_query_count_is_independent_of_row_count(self):
+        self.create_activity('Small', 1)
+        for idx, endpoint in enumerate(self.ENDPOINTS):
+            with self.subTest(endpoint=endpoint):
+                self.assertConstantQueries(f'/api/{endpoint}/', lambda: self.create_activity(f'Large {idx}', 5))
+
+
+class ApiPaginationTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='admin', password='pass', role='admin')
+        self.client.login(username='admin', password='pass')
+        create_case_data(self.user, self.user, 7)
+
+    def walk(self, url):
+        ids = []
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            data = response.json()
+            ids.extend(row['id'] for row in data['results'])
+            url = data['next']
+        return ids, data
+
+    def test_next_links_visit_every_row_once(self):
+        ids, last = self.walk('/api/case-notes/?page_size=2&fields=id')
+        self.assertEqual(ids, list(CaseNote.objects.order_by('-created_at', '-pk').values_list('pk', flat=True)))
+        previous = self.client.get(last['previous']).json()
+        self.assertEqual([row['id'] for row in previous['results']], ids[-3:-1])
+
+        # Models without created_at are listed by id
+        ids, _ = self.walk('/api/programs/?page_size=1')
+        self.assertEqual(ids, list(Program.objects.order_by('-pk').values_list('pk', flat=True)))
+
+    @override_settings(API_MAX_PAGE_SIZE=3)
+    def test_page_size_is_capped(self):
+        response = self.client.get('/api/cases/?page_size=1000')
+        self.assertEqual(len(response.json()['results']), 3)
+        self.assertEqual(len(self.client.get('/api/cases/').json()['results']), 3)
+
+    def test_invalid_cursor_is_not_found(self):
+        self.assertEqual(self.client.get('/api/cases/?cursor=bogus').status_code, 404)
+
+
+class SyncTests(TestCase):
+    def setUp(self):
+        self.manager = User.objects.create_user(username='manager', role='case_manager')
+        self.officer = User.objects.create_user(username='officer', password='pass', role='field_officer')
+        create_case_data(self.manager, self.officer, 2)
+        create_case_data(self.manager, self.manager, 1, prefix='Other')
+        self.client.login(username='officer', password='pass')
+
+    def sync(self, since=None, **headers):
+        response = self.client.get('/api/sync/', {'since': since.isoformat()} if since else {}, **headers)
+        self.assertEqual(response.status_code, 200)
+        content = b''.join(response.streaming_content)
+        if response.get('Content-Encoding') == 'gzip':
+            content = gzip.decompress(content)
+        return json.loads(content)
+
+    def ids(self, data, entity):
+        column = data['fields'][entity].index('id')
+        return sorted(row[column] for row in data['changes'][entity])
+
+    def test_full_sync_is_scoped_by_role(self):
+        data = self.sync()
+        self.assertTrue(data['full'])
+        self.assertEqual(len(data['changes']['program']), Program.objects.count())
+        self.assertEqual(len(data['changes']['beneficiary']), 3)
+        self.assertEqual(self.ids(data, 'case'), sorted(Case.objects.filter(title__startswith='Test').values_list('pk', flat=True)))
+        self.assertEqual(self.ids(data, 'case_note'), sorted(CaseNote.objects.filter(created_by=self.officer).values_list('pk', flat=True)))
+        self.assertEqual(data['deleted'], {})
+        self.assertEqual(data['visible'], {})
+
+    def test_incremental_sync_sends_changes_and_deletions(self):
+        long_ago = timezone.now() - timedelta(days=1)
+        for model in (Program, BeneficiaryCategory, Beneficiary, Case, CaseNote, Assessment):
+            model.objects.update(updated_at=long_ago)
+        since = timezone.now() - timedelta(hours=1)
+
+        edited, deleted = CaseNote.objects.filter(created_by=self.officer)
+        edited.content = 'Edited'
+        edited.save()
+        deleted_pk = deleted.pk
+        deleted.delete()
+
+        data = self.sync(since, HTTP_ACCEPT_ENCODING='gzip')
+        self.assertFalse(data['full'])
+        self.assertEqual(self.ids(data, 'case_note'), [edited.pk])
+        self.assertEqual(data['changes']['beneficiary'], [])
+        # Rows of restricted entities are listed by what remains in scope, not by tombstones
+        self.assertNotIn('case_note', data['deleted'])
+        self.assertEqual(data['visible']['case_note'], [edited.pk])
+        self.assertEqual(data['deleted']['beneficiary'], [])
+        self.assertLess(parse_datetime(data['watermark']), timezone.now())
+
+    def make_old(self):
+        long_ago = timezone.now() - timedelta(days=1)
+        for model in (Program, BeneficiaryCategory, Beneficiary, Case, CaseNote, Assessment):
+            model.objects.update(updated_at=long_ago)
+        return timezone.now() - timedelta(hours=1)
+
+    def test_rows_entering_scope_are_sent(self):
+        since = self.make_old()
+        other = Case.objects.get(title='Other Case 0')
+        CaseNote.objects.create(case=other, created_by=self.officer, content='First visit')
+        data = self.sync(since)
+        self.assertEqual(self.ids(data, 'case'), [other.pk])
+        self.assertIn(other.pk, data['visible']['case'])
+
+        # A case manager given a case receives its older notes and assessments
+        newcomer = User.objects.create_user(username='newcomer', password='pass', role='case_manager')
+        self.client.login(username='newcomer', password='pass')
+        since = self.make_old()
+        other.case_manager = newcomer
+        other.save()
+        data = self.sync(since)
+        self.assertEqual(self.ids(data, 'case'), [other.pk])
+        self.assertEqual(self.ids(data, 'case_note'), sorted(other.notes.values_list('pk', flat=True)))
+        self.assertEqual(len(data['changes']['assessment']), 1)
+
+    def test_rows_leaving_scope_are_dropped_from_visible(self):
+        manager = User.objects.create_user(username='lead', password='pass', role='case_manager')
+        self.client.login(username='lead', password='pass')
+        case = Case.objects.filter(title__startswith='Test').first()
+        case.case_manager = manager
+        case.save()
+        since = self.make_old()
+        self.assertEqual(self.sync(since)['visible']['case'], [case.pk])
+        case.case_manager = self.manager
+        case.save()
+        data = self.sync(since)
+        self.assertEqual(data['visible']['case'], [])
+        self.assertEqual(data['visible']['case_note'], [])
+        self.assertEqual(data['changes']['case'], [])
+
+    @override_settings(SYNC_TOMBSTONE_RETENTION=timedelta(days=7))
+    def test_tombstones_expire(self):
+        Program.objects.filter(name='Other Next Program').delete()
+        SyncTombstone.objects.update(deleted_at=timezone.now() - timedelta(days=8))
+        Program.objects.filter(name='Test Next Program').delete()
+        self.assertEqual(SyncTombstone.objects.count(), 1)
+
+        # Older watermarks may have missed expired deletions, so get everything
+        data = self.sync(timezone.now() - timedelta(days=8))
+        self.assertTrue(data['full'])
+        self.assertEqual(len(data['changes']['program']), Program.objects.count())
+
+    def test_cascaded_deletes_leave_tombstones(self):
+        Beneficiary.objects.filter(name='Test Beneficiary 0').delete()
+        self.assertEqual(
+            sorted(SyncTombstone.objects.values_list('entity', flat=True)),
+            ['assessment', 'beneficiary', 'case', 'case_note'],
+        )
+
+    def test_rejects_invalid_watermark(self):
+        self.assertEqual(self.client.get('/api/sync/', {'since': 'yesterday'}).status_code, 400)
+
+
+class ExportTests(TestCase):
+    def setUp(self):
+        self.manager = User.objects.create_user(username='manager', role='case_manager')
+        self.officer = User.objects.create_user(username='officer', password='pass', role='field_officer')
+        create_case_data(self.manager, self.officer, 3)
+        create_case_data(self.manager, self.manager, 1, prefix='Other')
+        self.client.login(username='officer', password='pass')
+
+    def export(self, entity_type, params=None, **headers):
+        response = self.client.get(f'/api/export/{entity_type}.ndjson', params or {}, **headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        content = b''.join(response.streaming_content)
+        if response.get('Content-Encoding') == 'gzip':
+            content = gzip.decompress(content)
+        return [json.loads(line) for line in content.decode().splitlines()]
+
+    def test_streams_the_rows_the_user_may_see(self):
+        with patch('core.export.EXPORT_CHUNK_SIZE', 2):
+            rows = self.export('case_note')
+        notes = CaseNote.objects.filter(created_by=self.officer).order_by('pk')
+        self.assertEqual([row['id'] for row in rows], [note.pk for note in notes])
+        self.assertEqual(list(rows[0]), get_field_options()['case_note'])
+        self.assertEqual(rows[0]['case__title'], 'Test Case 0')
+        self.assertEqual(len(self.export('beneficiary', HTTP_ACCEPT_ENCODING='gzip')), 4)
+
+    def test_resumes_after_an_id(self):
+        ids = [row['id'] for row in self.export('assessment')]
+        self.assertEqual([row['id'] for row in self.export('assessment', {'after_id': ids[0]})], ids[1:])
+        User.objects.create_user(username='admin', password='pass', role='admin')
+        self.client.login(username='admin', password='pass')
+        rows = self.export('funding')
+        self.assertTrue(rows)
+        # Decimals are written as strings, as the API and sync write them
+        ledger = BeneficiaryFundingLedger.objects.get(pk=rows[0]['id'])
+        self.assertEqual(rows[0]['total_received'], str(ledger.total_received))
+        self.assertEqual([row['id'] for row in rows], sorted(row['id'] for row in rows))
+
+    def test_rejects_unknown_entities_and_ids(self):
+        self.assertEqual(self.client.get('/api/export/user.ndjson').status_code, 404)
+        response = self.client.get('/api/export/case.ndjson', {'after_id': 'last'})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(json.loads(response.content), {'after_id': 'Not a valid id.'})
+
+
+class BulkCreateTests(TestCase):
+    def setUp(self):
+        self.manager = User.objects.create_user(username='manager', password='pass', role='case_manager')
+        self.officer = User.objects.create_user(username='officer', password='pass', role='field_officer')
+        create_case_data(self.manager, self.officer, 2)
+        self.case, self.other = Case.objects.order_by('pk')
+        rebuild_counters()
+
+    def bulk(self, url, items, user='officer'):
+        self.client.login(username=user, password='pass')
+        return self.client.post(url, items, content_type='application/json')
+
+    def test_notes_get_per_item_results(self):
+        response = self.bulk('/api/case-notes/bulk/', [
+            {'case': self.case.pk, 'content': 'Home visit'},
+            {'case': 999999, 'content': 'Lost'},
+            {'case': self.other.pk, 'content': 'Clinic visit'},
+        ])
+        self.assertEqual(response.status_code, 207)
+        body = response.json()
+        self.assertEqual((body['created'], body['failed']), (2, 1))
+        self.assertEqual([item['status'] for item in body['results']], [201, 400, 201])
+        self.assertIn('case', body['results'][1]['errors'])
+        self.assertEqual(body['results'][2]['data']['created_by_username'], 'officer')
+
+        self.assertEqual(CaseNote.objects.filter(created_by=self.officer).count(), 4)
+        notes = search(CaseNote.objects.all(), 'clinic')
+        self.assertEqual([note.content for note in notes], ['Clinic visit'])
+        maintained = dict(DashboardCounter.objects.values_list('key', 'value'))
+        self.assertEqual(maintained[counter_key('created_case_notes', self.officer)], 4)
+        contributors = sorted(CaseContributor.objects.values_list('user_id', 'case_id', 'note_count'))
+        rebuild_contributors()
+        self.assertEqual(contributors, sorted(CaseContributor.objects.values_list('user_id', 'case_id', 'note_count')))
+
+    def test_queries_do_not_grow_with_the_upload(self):
+        self.client.login(username='officer', password='pass')
+
+        def upload(count):
+            items = [{'case': self.case.pk, 'content': f'Visit {idx}'} for idx in range(count)]
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.post('/api/case-notes/bulk/', items, content_type='application/json')
+            self.assertEqual(response.status_code, 201)
+            return len(queries)
+
+        self.assertEqual(upload(2), upload(20))
+
+    def test_assessments_promote_each_beneficiary_once(self):
+        start = Program.objects.get(name='Test Program')
+        middle = Program.objects.create(name='Middle', monthly_amount=150)
+        Program.objects.create(name='Final', monthly_amount=200)
+        start.next_program = middle
+        start.save()
+        middle.next_program = Program.objects.get(name='Final')
+        middle.save()
+        higher = BeneficiaryCategory.objects.create(name='Higher', max_annual_amount=5000)
+
+        items = [
+            {'case': self.case.pk, 'title': 'Visit', 'amount_received': '600.00', 'income_amount': '100.00'},
+            {'case': self.case.pk, 'title': 'Follow-up', 'amount_received': '600.00', 'income_amount': '200.00'},
+        ]
+        response = self.bulk('/api/assessments/bulk/', items, user='manager')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.json()['promoted'], 1)
+
+        beneficiary = Beneficiary.objects.get(pk=self.case.beneficiary_id)
+        self.assertEqual((beneficiary.category, beneficiary.program), (higher, middle))
+        self.assertEqual(get_total_received(beneficiary), Decimal('1200.00'))
+        ledger = BeneficiaryFundingLedger.objects.get(beneficiary=beneficiary)
+        self.assertEqual((ledger.assessment_count, ledger.last_income), (3, Decimal('200.00')))
+
+    def test_rejects_cases_the_user_may_not_write_to(self):
+        other_manager = User.objects.create_user(username='other', password='pass', role='case_manager')
+        self.case.case_manager = other_manager
+        self.case.save()
+        response = self.bulk('/api/assessments/bulk/', [{'case': self.case.pk, 'title': 'Visit'}], user='manager')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(Assessment.objects.filter(title='Visit').count(), 0)
+
+    def test_rejects_anything_but_a_bounded_list(self):
+        self.assertEqual(self.bulk('/api/case-notes/bulk/', {'case': self.case.pk}).status_code, 400)
+        with override_settings(API_BULK_MAX_ITEMS=1):
+            items = [{'case': self.case.pk, 'content': 'Visit'}] * 2
+            self.assertEqual(self.bulk('/api/case-notes/bulk/', items).status_code, 400)
+
+
+class ConditionalGetTests(TestCase):
+    def setUp(self):
+        self.manager = User.objects.create_user(username='manager', password='pass', role='case_manager')
+        self.officer = User.objects.create_user(username='officer', password='pass', role='field_officer')
+        create_case_data(self.manager, self.officer, 2)
+        self.case = Case.objects.order_by('pk').first()
+        self.client.login(username='manager', password='pass')
+
+    def assertRevalidates(self, url, change):
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        etag = response['ETag']
+        self.assertIn('no-cache', response['Cache-Control'])
+
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, b'')
+
+        change()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        return response
+
+    def test_case_page_follows_new_and_deleted_notes(self):
+        url = reverse('case_detail', args=[self.case.pk])
+        self.assertRevalidates(url, lambda: CaseNote.objects.create(case=self.case, created_by=self.officer, content='New'))
+        self.assertRevalidates(url, lambda: CaseNote.objects.filter(case=self.case).first().delete())
+
+    def test_beneficiary_and_program_pages(self):
+        beneficiary = self.case.beneficiary
+        self.assertRevalidates(
+            reverse('beneficiary_detail', args=[beneficiary.pk]),
+            lambda: Assessment.objects.create(title='New', case=self.case, created_by=self.officer),
+        )
+        program = beneficiary.program
+        self.assertRevalidates(
+            reverse('program_detail', args=[program.pk]),
+            lambda: Program.objects.exclude(pk=program.pk).update(name='Renamed', updated_at=timezone.now()),
+        )
+
+    def test_if_modified_since(self):
+        url = reverse('case_detail', args=[self.case.pk])
+        last_modified = self.client.get(url)['Last-Modified']
+        self.assertEqual(self.client.get(url, HTTP_IF_MODIFIED_SINCE=last_modified).status_code, 304)
+
+    def test_validators_identify_the_user(self):
+        url = reverse('beneficiary_detail', args=[self.case.beneficiary_id])
+        etag = self.client.get(url)['ETag']
+        self.client.login(username='officer', password='pass')
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_pages_follow_named_users_and_form_tokens(self):
+        url = reverse('case_detail', args=[self.case.pk])
+
+        def rename_officer():
+            self.officer.first_name = 'Renamed'
+            self.officer.save()
+        self.assertRevalidates(url, rename_officer)
+
+        # A new login rotates the CSRF secret, so the old page's forms would not validate
+        etag = self.client.get(url)['ETag']
+        self.client.logout()
+        self.client.login(username='manager', password='pass')
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_api_retrieve_answers_304_before_serializing(self):
+        url = f'/api/cases/{self.case.pk}/'
+        response = self.assertRevalidates(
+            url, lambda: Assessment.objects.filter(case=self.case).update(title='Renamed', updated_at=timezone.now())
+        )
+        etag = response['ETag']
+        # Session, user and the validator query
+        with self.assertNumQueries(3):
+            self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+    def test_invisible_objects_are_not_found(self):
+        other_manager = User.objects.create_user(username='other', password='pass', role='case_manager')
+        Case.objects.filter(pk=self.case.pk).update(case_manager=other_manager)
+        self.assertEqual(self.client.get(f'/api/cases/{self.case.pk}/', HTTP_IF_NONE_MATCH='*').status_code, 404)
+        self.assertEqual(self.client.get('/api/cases/x/').status_code, 404)
+
+
+class ApiFormatTests(TestCase):
+    def setUp(self):
+        self.manager = User.objects.create_user(username='manager', password='pass', role='case_manager')
+        create_case_data(self.manager, self.manager, 3)
+        for assessment in Assessment.objects.all():
+            for order in range(2):
+                AssessmentQuestion.objects.create(
+                    assessment=assessment, text=f'Question {order} \u2028', question_type='text', order=order
+                )
+        self.client.login(username='manager', password='pass')
+
+    def test_value_rows_match_the_serializer(self):
+        factory = RequestFactory()
+        for url, serializer_class, model in [
+            ('/api/case-notes/', CaseNoteSerializer, CaseNote),
+            ('/api/assessments/', AssessmentSerializer, Assessment),
+            ('/api/assessments/?fields=id,title,questions', AssessmentSerializer, Assessment),
+            ('/api/assessments/?fields=id,created_at&expand=', AssessmentSerializer, Assessment),
+        ]:
+            request = factory.get(url)
+            request.user = self.manager
+            objects = model.objects.order_by('-created_at', '-pk')
+            serializer = serializer_class(objects, many=True, context={'request': Request(request)})
+            expected = json.loads(JSONRenderer().render(serializer.data))
+            self.assertEqual(self.client.get(url).json()['results'], expected, url)
+
+    def test_value_rows_take_a_query_per_level(self):
+        self.client.get('/api/assessments/')
+        # Session, user, the assessments and their questions
+        with self.assertNumQueries(4):
+            self.assertEqual(len(self.client.get('/api/assessments/').json()['results']), 3)
+
+    def test_fast_renderer_matches_drf(self):
+        data = {
+            'amount': Decimal('1.50'), 'when': timezone.now(), 'text': 'line\u2028break', 1: [None, True],
+            'label': gettext_lazy('Active'),
+        }
+        self.assertEqual(FastJSONRenderer().render(data), JSONRenderer().render(data))
+        indented = FastJSONRenderer().render(data, 'application/json; indent=2')
+        self.assertEqual(indented, JSONRenderer().render(data, 'application/json; indent=2'))
+        parsed = FastJSONParser().parse(BytesIO(b'{"a": [1, 2.5, "\\u00e9"]}'))
+        self.assertEqual(parsed, {'a': [1, 2.5, '\u00e9']})
+
+    @skipUnless(MessagePackRenderer.available, 'msgpack is not installed')
+    def test_message_pack(self):
+        import msgpack
+        response = self.client.get('/api/case-notes/', HTTP_ACCEPT='application/msgpack')
+        self.assertEqual(response['Content-Type'], 'application/msgpack')
+        self.assertEqual(msgpack.unpackb(response.content)['results'], self.client.get('/api/case-notes/').json()['results'])
+
+    @skipIf(MessagePackRenderer.available, 'msgpack is installed')
+    def test_message_pack_is_not_offered_without_msgpack(self):
+        self.assertEqual(self.client.get('/api/case-notes/', HTTP_ACCEPT='application/msgpack').status_code, 406)
+
+
+class SparseFieldsetTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='admin', password='pass', role='admin')
+        self.client.login(username='admin', password='pass')
+        create_case_data(self.user, self.user, 3)
+        for assessment in Assessment.objects.all():
+            assessment.questions.create(text='Income?', question_type='text')
+
+    def get(self, url):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return response.json()['results'], [query['sql'] for query in queries]
+
+    def test_fields_limits_keys_and_skips_nested_rows(self):
+        cases, queries = self.get('/api/cases/?fields=id,title')
+        self.assertEqual(set(cases[0]), {'id', 'title'})
+        self.assertFalse(any('core_casenote' in sql or 'core_assessment' in sql for sql in queries))
+
+        beneficiaries, _ = self.get('/api/beneficiaries/?fields=id,name')
+        self.assertEqual(set(beneficiaries[0]), {'id', 'name'})
+
+    def test_expand_embeds_only_named_nested_serializers(self):
+        _, all_queries = self.get('/api/cases/')
+        cases, queries = self.get('/api/cases/?expand=notes')
+        self.assertIn('notes', cases[0])
+        self.assertNotIn('assessments', cases[0])
+        self.assertIn('title', cases[0])
+        self.assertEqual(len(queries), len(all_queries) - 2)
+
+        cases, _ = self.get('/api/cases/?fields=id&expand=assessments')
+        self.assertEqual(set(cases[0]), {'id', 'assessments'})
+        self.assertNotIn('questions', cases[0]['assessments'][0])
+
+        cases, _ = self.get('/api/cases/?fields=id&expand=assessments.questions')
+        self.assertEqual(len(cases[0]['assessments'][0]['questions']), 1)
+
+    def test_writes_ignore_selection(self):
+        response = self.client.post('/api/case-notes/?fields=id', {
+            'case': Case.objects.first().pk, 'created_by': self.user.pk, 'content': 'Visit',
+        })
+        self.assertEqual(response.status_code, 201)
+        self.assertIn('content', response.json())
+
+
+class DashboardCounterTests(TestCase):
+    def setUp(self):
+        self.manager = User.objects.create_user(username='manager', role='case_manager')
+        self.officer = User.objects.create_user(username='officer', role='field_officer')
+        create_case_data(self.manager, self.officer, 3)
+        # Materialize every counter so the changes below are applied incrementally
+        rebuild_counters()
+
+    def assertCountersMatchSource(self):
+        maintained = dict(DashboardCounter.objects.values_list('key', 'value'))
+        rebuild_counters()
+        rebuilt = dict(DashboardCounter.objects.values_list('key', 'value'))
+        # Per-user rows that did not exist yet are computed when first read instead
+        self.assertEqual(maintained, {key: rebuilt.get(key, 0) for key in maintained})
+
+    def test_incremental_updates_match_rebuild(self):
+        other_manager = User.objects.create_user(username='other', role='case_manager')
+        case = Case.objects.first()
+        BeneficiaryProgress.objects.create(beneficiary=case.beneficiary, case=case, recorded_by=self.manager)
+        Referral.objects.create(
+            beneficiary=case.beneficiary, case=case, referred_by=self.officer, referred_to_user=self.manager,
+            referred_to_organization='Partner', reason='Support',
+        )
+        Alert.objects.create(title='Alert', message='-', user=self.manager)
+        self.assertEqual(read_counters(open=counter_key('managed_open_cases', self.manager))['open'], 3)
+
+        case.status = 'closed'
+        case.case_manager = other_manager
+        case.save()
+        self.assertEqual(
+            read_counters(progress=counter_key('managed_progress_records', other_manager))['progress'], 1
+        )
+        Assessment.objects.first().delete()
+        Beneficiary.objects.last().delete()
+        self.assertCountersMatchSource()
+
+    def test_changes_while_a_counter_is_initialized_are_kept(self):
+        key = counter_key('created_case_notes', self.manager)
+        self.assertFalse(DashboardCounter.objects.filter(key=key).exists())
+        case = Case.objects.first()
+        compute = compute_counters
+
+        def compute_after_a_change(keys):
+            # The row exists before counting, so this change is applied to it
+            self.assertTrue(DashboardCounter.objects.filter(key=key).exists())
+            CaseNote.objects.create(case=case, created_by=self.manager, content='Meanwhile')
+            return compute(keys)
+
+        with patch('core.counters.compute_counters', compute_after_a_change):
+            self.assertEqual(read_counters(notes=key)['notes'], 1)
+        CaseNote.objects.create(case=case, created_by=self.manager, content='Later')
+        self.assertEqual(read_counters(notes=key)['notes'], 2)
+        self.assertCountersMatchSource()
+
+    def test_mark_all_alerts_read_resets_unread_counter(self):
+        self.manager.set_password('pass')
+        self.manager.save()
+        Alert.objects.create(title='Alert', message='-', user=self.manager)
+        self.client.login(username='manager', password='pass')
+        self.client.post(reverse('mark_all_alerts_read'))
+        self.assertEqual(read_counters(unread=counter_key('unread_alerts', self.manager))['unread'], 0)
+
+    def test_missing_counters_are_computed_on_read(self):
+        DashboardCounter.objects.all().delete()
+        keys = {counter.name: counter_key(counter.name, self.officer) for counter in COUNTERS}
+        # Lookup, the insert at zero, then inside a savepoint locking the rows,
+        # one counting query and writing the counts
+        with self.assertNumQueries(7):
+            values = read_counters(**keys)
+        self.assertEqual(values['created_assessments'], 3)
+        self.assertEqual(values['cases'], 3)
+        with self.assertNumQueries(1):
+            self.assertEqual(read_counters(**keys), values)
+
+
+class FundingLedgerTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='manager', role='case_manager')
+        create_case_data(self.user, self.user, 2)
+        self.beneficiary = Beneficiary.objects.first()
+        second_case = Case.objects.create(title='Second', beneficiary=self.beneficiary, case_manager=self.user)
+        for year, amount in ((2023, '10.10'), (2024, '20.20'), (2024, '0.30')):
+            Assessment.objects.create(
+                title=f'{year}', case=second_case, created_by=self.user, amount_received=amount, year=year
+            )
+
+    def test_totals_are_single_aggregates(self):
+        with self.assertNumQueries(1):
+            self.assertEqual(get_total_received(self.beneficiary), Decimal('30.60'))
+        with self.assertNumQueries(1):
+            self.assertEqual(get_total_received(self.beneficiary.pk, year=2024), Decimal('20.50'))
+        with self.assertNumQueries(1):
+            yearly = get_yearly_totals(self.beneficiary)
+        self.assertEqual(yearly[2023], Decimal('10.10'))
+        self.assertEqual(yearly[2024], Decimal('20.50'))
+        self.assertEqual(get_totals_by_beneficiary()[self.beneficiary.pk], Decimal('30.60'))
+
+    def test_assessment_total_covers_every_case_of_the_beneficiary(self):
+        assessment = Assessment.objects.filter(case__beneficiary=self.beneficiary).first()
+        self.assertEqual(assessment.get_total_amount_received(), Decimal('30.60'))
+        self.assertEqual(assessment.get_total_amount_received(year=2023), Decimal('10.10'))
+
+    def ledger_rows(self):
+        return list(BeneficiaryFundingLedger.objects.values_list(
+            'beneficiary_id', 'year', 'total_received', 'assessment_count', 'last_income'
+        ))
+
+    def test_ledger_follows_assessment_changes(self):
+        ledger = BeneficiaryFundingLedger.objects.get(beneficiary=self.beneficiary, year=2024)
+        self.assertEqual((ledger.total_received, ledger.assessment_count), (Decimal('20.50'), 2))
+
+        assessment = Assessment.objects.get(year=2023)
+        assessment.year = 2024
+        assessment.save()
+        self.assertFalse(BeneficiaryFundingLedger.objects.filter(beneficiary=self.beneficiary, year=2023).exists())
+        Assessment.objects.create(title='Latest', case=assessment.case, created_by=self.user, income_amount=500, year=2024)
+        ledger = BeneficiaryFundingLedger.objects.get(beneficiary=self.beneficiary, year=2024)
+        self.assertEqual((ledger.total_received, ledger.assessment_count), (Decimal('30.60'), 4))
+        self.assertEqual(ledger.last_income, Decimal('500.00'))
+
+        other = Beneficiary.objects.exclude(pk=self.beneficiary.pk).first()
+        case = assessment.case
+        case.beneficiary = other
+        case.save()
+        self.assertEqual(get_total_received(other), Decimal('30.60'))
+        self.assertEqual(get_total_received(self.beneficiary), Decimal('0.00'))
+
+        Assessment.objects.filter(year=2024).first().delete()
+        maintained = self.ledger_rows()
+        rebuild_ledger()
+        self.assertEqual(maintained, self.ledger_rows())
+
+        other.delete()
+        self.assertFalse(BeneficiaryFundingLedger.objects.filter(beneficiary_id=other.pk).exists())
+
+
+class PromotionTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='manager', role='case_manager')
+        self.low = BeneficiaryCategory.objects.create(name='Low', max_annual_amount=100)
+        self.mid = BeneficiaryCategory.objects.create(name='Mid', max_annual_amount=500)
+        self.high = BeneficiaryCategory.objects.create(name='High', max_annual_amount=1000)
+        self.assessments = []
+        for idx, (category, income, received) in enumerate([
+            (self.low, 50, 20),     # stays
+            (self.low, 300, 20),    # income outgrew Low
+            (self.low, 50, 700),    # received outgrew Low and Mid
+            (None, 400, 0),         # gets a first category
+            (self.high, 5000, 0),   # nothing above High
+        ]):
+            beneficiary = Beneficiary.objects.create(
+                name=f'B{idx}', dob=date(1990, 1, 1), gender='male', address='Kigali', category=category
+            )
+            case = Case.objects.create(title=f'C{idx}', beneficiary=beneficiary, case_manager=self.user)
+            self.assessments.append(Assessment.objects.create(
+                title=f'A{idx}', case=case, created_by=self.user, income_amount=income, amount_received=received
+            ))
+
+    def test_index_lookups(self):
+        index = CategoryIndex.load()
+        self.assertEqual(index.smallest_at_least(100), self.low)
+        self.assertEqual(index.smallest_at_least(100, above=100), self.mid)
+        self.assertIsNone(index.smallest_at_least(1001))
+
+    def test_plan_matches_per_assessment_checks(self):
+        plan = plan_promotions()
+        self.assertEqual(plan.evaluated, 5)
+        for assessment in self.assessments:
+            can_promote, category = assessment.check_category_promotion()
+            beneficiary = assessment.case.beneficiary
+            expected = category.pk if can_promote else None
+            self.assertEqual(plan.categories.get(beneficiary.pk), expected, beneficiary.name)
+
+    def test_dry_run_then_apply(self):
+        call_command('run_promotions', '--dry-run', stdout=StringIO())
+        self.assertEqual(Beneficiary.objects.filter(category=self.low).count(), 3)
+
+        out = StringIO()
+        call_command('run_promotions', stdout=out)
+        self.assertIn('Low -> Mid: 1', out.getvalue())
+        self.assertEqual(
+            dict(Beneficiary.objects.values_list('name', 'category__name')),
+            {'B0': 'Low', 'B1': 'Mid', 'B2': 'High', 'B3': 'Mid', 'B4': 'High'},
+        )
+
+
+@override_settings(REPORT_CACHE_ROOT=tempfile.mkdtemp())
+class KeysetPaginationTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='admin', role='admin')
+        categories = [None] + [
+            BeneficiaryCategory.objects.create(name=name, max_annual_amount=100 * idx)
+            for idx, name in enumerate(['Low', 'Mid', 'High'], start=1)
+        ]
+        for idx in range(23):
+            Beneficiary.objects.create(
+                name=f'B{idx % 7}', dob=date(1990, 1, 1), gender='male', address='Kigali',
+                category=categories[idx % len(categories)],
+            )
+
+    def walk(self, queryset, per_page=4):
+        """Every page forward from the first, then every page back from the last"""
+        paginator = KeysetPaginator(queryset, per_page)
+        pages = [paginator.page()]
+        while pages[-1].has_next():
+            pages.append(paginator.page(pages[-1].next_cursor))
+        backward = [pages[-1]]
+        while backward[-1].has_previous():
+            backward.append(paginator.page(backward[-1].previous_cursor))
+        return pages, backward[::-1]
+
+    def test_pages_follow_offset_order(self):
+        for sort in ('name', '-name', 'pk', '-pk', 'category__name', '-category__name'):
+            queryset = Beneficiary.objects.order_by(sort, 'pk' if not sort.startswith('-') else '-pk')
+            expected = list(queryset.values_list('pk', flat=True))
+            forward, backward = self.walk(Beneficiary.objects.order_by(sort))
+            self.assertEqual([obj.pk for page in forward for obj in page], expected, sort)
+            self.assertEqual(
+                [[obj.pk for obj in page] for page in backward],
+                [[obj.pk for obj in page] for page in forward], sort
+            )
+            self.assertEqual(len(forward[-1]), 3)
+
+    def test_count_is_capped(self):
+        paginator = KeysetPaginator(Beneficiary.objects.order_by('name'), 4, count_cap=10)
+        self.assertEqual(paginator.count, 10)
+        self.assertTrue(paginator.count_capped)
+        self.assertEqual(KeysetPaginator(Beneficiary.objects.order_by('name'), 4).count, 23)
+
+    def test_invalid_cursor(self):
+        paginator = KeysetPaginator(Beneficiary.objects.order_by('name'), 4)
+        with self.assertRaises(InvalidCursor):
+            paginator.page('not-a-cursor')
+        self.client.force_login(self.user)
+        response = self.client.get(reverse('beneficiary_list'), {'cursor': 'not-a-cursor'})
+        self.assertEqual(response.status_code, 404)
+
+    def test_list_view_keyset_mode(self):
+        self.client.force_login(self.user)
+        url = reverse('beneficiary_list')
+        response = self.client.get(url, {'paginate': 'keyset', 'sort': '-name', 'gender': 'male'})
+        page = response.context['page_obj']
+        self.assertTrue(page.is_keyset)
+        self.assertEqual(response.context['pagination_query'], 'paginate=keyset&sort=-name&gender=male')
+        self.assertContains(response, f'cursor={page.next_cursor}')
+
+        response = self.client.get(url, {'paginate': 'keyset', 'sort': '-name', 'cursor': page.next_cursor})
+        self.assertTrue(response.context['page_obj'].has_previous())
+        # Page numbers are kept for unsupported sort orders
+        response = self.client.get(url, {'paginate': 'keyset', 'sort': '?'})
+        self.assertFalse(getattr(response.context['page_obj'], 'is_keyset', False))
+
+
+class SearchTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='admin', role='admin')
+        self.manager = User.objects.create_user(username='manager', role='case_manager')
+        self.jeanne = Beneficiary.objects.create(
+            name='Jeanne Uwase', dob=date(1990, 1, 1), gender='female', address='Kicukiro, Kigali'
+        )
+        self.eric = Beneficiary.objects.create(
+            name='Eric Habimana', dob=date(1985, 1, 1), gender='male', address='Musanze'
+        )
+        self.case = Case.objects.create(
+            title='Housing support', beneficiary=self.jeanne, case_manager=self.manager,
+            description='Roof repair after the floods'
+        )
+        self.note = CaseNote.objects.create(case=self.case, created_by=self.manager, content='Visited the household')
+
+    def found(self, model, query):
+        return set(search(model.objects.all(), query).values_list('pk', flat=True))
+
+    def test_prefix_and_every_word(self):
+        self.assertEqual(self.found(Beneficiary, 'jea'), {self.jeanne.pk})
+        self.assertEqual(self.found(Beneficiary, 'kigali jeanne'), {self.jeanne.pk})
+        self.assertEqual(self.found(Beneficiary, 'kigali eric'), set())
+        self.assertEqual(self.found(Case, 'flood'), {self.case.pk})
+        self.assertEqual(self.found(Beneficiary, '%%'), set())
+
+    def test_best_matches_rank_first(self):
+        Beneficiary.objects.create(
+            name='Eric Mugisha', dob=date(1990, 1, 1), gender='male', address='Near Eric Habimana, Musanze'
+        )
+        ranked = search(Beneficiary.objects.all(), 'habimana').order_by('search_rank')
+        self.assertEqual(ranked.count(), 2)
+        self.assertEqual(ranked[0], self.eric)
+
+    def test_results_compose_with_other_queries(self):
+        found = search(Beneficiary.objects.all(), 'eric')
+        self.assertEqual(list(found.values_list('name', 'search_rank')[:1])[0][0], 'Eric Habimana')
+        self.assertEqual(list(found.annotate(case_count=Count('cases')).values_list('case_count', flat=True)), [0])
+        # Used as a subquery, where the outer query aliases the table
+        self.assertEqual(
+            list(Case.objects.filter(beneficiary__in=search(Beneficiary.objects.all(), 'jeanne').order_by('search_rank').values('pk'))),
+            [self.case],
+        )
+
+    def test_documents_follow_related_changes(self):
+        self.jeanne.name = 'Jeanne Mukamana'
+        self.jeanne.save()
+        self.assertEqual(self.found(Case, 'mukamana'), {self.case.pk})
+        self.assertEqual(self.found(CaseNote, 'mukamana'), {self.note.pk})
+        self.assertEqual(self.found(CaseNote, 'uwase'), set())
+
+        self.case.beneficiary = self.eric
+        self.case.save()
+        self.assertEqual(self.found(CaseNote, 'habimana'), {self.note.pk})
+
+        self.note.delete()
+        self.assertEqual(self.found(CaseNote, 'visited'), set())
+
+    def test_rebuild_command(self):
+        with connection.cursor() as cursor:
+            cursor.execute('DELETE FROM core_search_beneficiary')
+        self.assertEqual(self.found(Beneficiary, 'eric'), set())
+        call_command('rebuild_search_index', stdout=StringIO())
+        self.assertEqual(self.found(Beneficiary, 'eric'), {self.eric.pk})
+
+    def test_substring_backend(self):
+        backend = SubstringBackend()
+        queryset = backend.filter(Case.objects.all(), get_search_index(Case), 'uwase')
+        self.assertEqual(list(queryset), [self.case])
+
+    def test_list_views_search(self):
+        self.client.force_login(self.user)
+        response = self.client.get(reverse('beneficiary_list'), {'search': 'musan'})
+        self.assertEqual(list(response.context['beneficiaries']), [self.eric])
+        response = self.client.get(reverse('case_list'), {'search': 'jeanne roof'})
+        self.assertEqual(list(response.context['cases']), [self.case])
+
+
+class RoleScopeTests(TestCase):
+    ROLES = ['admin', 'case_manager', 'field_officer', 'partner_organisation', 'monitoring_and_evaluation', 'program_director']
+
+    def setUp(self):
+        self.manager = User.objects.create_user(username='manager', password='pass', role='case_manager')
+        self.officer = User.objects.create_user(username='officer', password='pass', role='field_officer')
+        create_case_data(self.manager, self.officer, 3, prefix='Scope')
+        self.cases = list(Case.objects.order_by('pk'))
+        # A second note on the same case must not list it twice
+        CaseNote.objects.create(case=self.cases[0], created_by=self.officer, content='Follow-up')
+        self.other_case = Case.objects.create(
+            title='Other', beneficiary=self.cases[0].beneficiary,
+            case_manager=User.objects.create_user(username='other', role='case_manager'),
+        )
+
+    def query_plan(self, queryset):
+        sql, params = queryset.query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute(f'EXPLAIN QUERY PLAN {sql}', params)
+            return [row[-1] for row in cursor.fetchall()]
+
+    def test_visible_cases(self):
+        officer_cases = RoleScope(self.officer).queryset(Case)
+        self.assertEqual(list(officer_cases.order_by('pk')), self.cases)
+        self.assertNotIn('DISTINCT', str(officer_cases.query))
+        self.assertEqual(list(RoleScope(self.manager).queryset(Case).order_by('pk')), self.cases)
+        self.assertEqual(RoleScope(User(role='admin')).queryset(Case).count(), 4)
+
+        self.client.login(username='officer', password='pass')
+        response = self.client.get(reverse('case_list'))
+        self.assertEqual(sorted(case.pk for case in response.context['cases']), [case.pk for case in self.cases])
+        self.assertEqual(self.client.get(reverse('case_detail', args=[self.other_case.pk])).status_code, 404)
+
+    def test_visible_funding_totals(self):
+        # The other manager's case shares the first beneficiary
+        every = sorted(case.beneficiary_id for case in self.cases)
+        expected = {
+            'admin': every, 'case_manager': every, 'field_officer': [],
+            'partner_organisation': every, 'monitoring_and_evaluation': every, 'program_director': every,
+        }
+        other_manager = User.objects.get(username='other')
+        for role in self.ROLES:
+            user = self.manager if role == 'case_manager' else (
+                self.officer if role == 'field_officer' else User.objects.create_user(username=f'funding_{role}', password='pass', role=role)
+            )
+            request = RequestFactory().get('/')
+            request.user = user
+            rows = get_report_data(request, 'funding').values_list('beneficiary_id', flat=True)
+            self.assertEqual(sorted(rows), expected[role], role)
+
+            user.set_password('pass')
+            user.save()
+            self.client.login(username=user.username, password='pass')
+            response = self.client.get('/api/export/funding.ndjson')
+            exported = [json.loads(line)['beneficiary__name'] for line in b''.join(response.streaming_content).decode().splitlines()]
+            self.assertEqual(len(exported), len(expected[role]), role)
+
+        other = RoleScope(other_manager).queryset(BeneficiaryFundingLedger)
+        self.assertEqual(list(other.values_list('beneficiary_id', flat=True)), [self.other_case.beneficiary_id])
+
+    def test_scopes_are_built_without_queries(self):
+        for role in self.ROLES:
+            user = User.objects.create_user(username=f'scope_{role}', role=role)
+            scope = RoleScope(user)
+            with self.assertNumQueries(0):
+                for model in SCOPE_RULES:
+                    if isinstance(scope.condition(model), Q):
+                        scope.queryset(model).query.sql_with_params()
+
+    def test_scoped_queries_use_indexes(self):
+        """Restricted rows are found through an index rather than by scanning a table"""
+        for role in self.ROLES:
+            user = User.objects.get_or_create(username=f'plan_{role}', defaults={'role': role})[0]
+            scope = RoleScope(user)
+            for model in SCOPE_RULES:
+                condition = scope.condition(model)
+                if condition is None or not isinstance(condition, Q):
+                    continue
+                plan = self.query_plan(scope.queryset(model))
+                scans = [line for line in plan if line.startswith('SCAN')]
+                self.assertEqual(scans, [], f'{role} {model.__name__}: {plan}')
+                self.assertFalse(any('DISTINCT' in line for line in plan), f'{role} {model.__name__}: {plan}')
+
+
+class CaseContributorTests(TestCase):
+    def setUp(self):
+        self.manager = User.objects.create_user(username='manager', role='case_manager')
+        self.officer = User.objects.create_user(username='officer', role='field_officer')
+        create_case_data(self.manager, self.officer, 2, prefix='Contrib')
+        self.case, self.other = Case.objects.order_by('pk')
+
+    def snapshot(self):
+        return sorted(CaseContributor.objects.values_list(
+            'user_id', 'case_id', 'note_count', 'assessment_count', 'first_contribution', 'last_contribution'
+        ))
+
+    def assertMatchesRebuild(self):
+        maintained = self.snapshot()
+        rebuild_contributors()
+        self.assertEqual(maintained, self.snapshot())
+        return maintained
+
+    def test_maintained_on_create_move_and_delete(self):
+        rows = self.assertMatchesRebuild()
+        self.assertEqual([(row[2], row[3]) for row in rows], [(1, 1), (1, 1)])
+
+        note = CaseNote.objects.create(case=self.case, created_by=self.manager, content='Manager note')
+        self.assertMatchesRebuild()
+        note.case = self.other
+        note.save()
+        self.assertMatchesRebuild()
+        note.delete()
+        self.assertMatchesRebuild()
+
+        CaseNote.objects.filter(case=self.case).delete()
+        Assessment.objects.get(case=self.case).delete()
+        self.assertFalse(CaseContributor.objects.filter(case=self.case).exists())
+        self.assertMatchesRebuild()
+
+    def test_case_delete_cascades(self):
+        self.case.delete()
+        rows = self.assertMatchesRebuild()
+        self.assertEqual([row[1] for row in rows], [self.other.pk])
+
+    def test_field_officer_case_list_is_one_join(self):
+        cases = RoleScope(self.officer).queryset(Case)
+        self.assertEqual(str(cases.query).count('JOIN'), 1)
+        self.assertEqual(sorted(case.pk for case in cases), [self.case.pk, self.other.pk])
+        call_command('rebuild_case_contributors', stdout=StringIO())
+        self.assertEqual(cases.count(), 2)
+
+
+class QueryPlanTests(TestCase):
+    def test_full_scans_are_told_from_index_walks(self):
+        plan = [
+            'SCAN core_case USING INDEX case_created_idx',
+            'SCAN core_search_case VIRTUAL TABLE INDEX 0:M3',
+            'SEARCH core_beneficiary USING INTEGER PRIMARY KEY (rowid=?)',
+            'SCAN core_program',
+            'SCAN core_referral',
+            'USE TEMP B-TREE FOR ORDER BY',
+        ]
+        self.assertEqual(full_scans(plan), ['SCAN core_referral'])
+
+    def test_hot_queries_use_indexes(self):
+        users = list(seed_case_records(200).values())
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE')
+        problems = check_query_plans(users)
+        self.assertEqual([(label, scans) for label, scans, _ in problems], [])
+
+
+class QueryProfilingTests(TestCase):
+    def setUp(self):
+        self.manager = User.objects.create_user(username='manager', password='pass', role='case_manager')
+        create_case_data(self.manager, self.manager, 12)
+        self.client.login(username='manager', password='pass')
+
+    @override_settings(PROFILING_SAMPLE_RATE=1)
+    def test_sampled_requests_get_server_timing(self):
+        response = self.client.get(reverse('case_list'))
+        timings = dict(entry.split(';', 1) for entry in response['Server-Timing'].split(', '))
+        self.assertEqual(set(timings), {'sql', 'tpl', 'app', 'total'})
+        self.assertRegex(timings['sql'], r'desc="[1-9]\d* queries"')
+        self.assertNotEqual(timings['tpl'], 'dur=0.0')
+
+    @override_settings(PROFILING_SAMPLE_RATE=0)
+    def test_unsampled_requests_are_left_alone(self):
+        self.assertNotIn('Server-Timing', self.client.get(reverse('case_list')))
+
+    @override_settings(PROFILING_SAMPLE_RATE=1, PROFILING_REPEATED_QUERIES=10)
+    def test_repeated_queries_are_logged(self):
+        def view(request):
+            titles = [Case.objects.get(pk=pk).title for pk in Case.objects.values_list('pk', flat=True)]
+            titles += [case.title for case in Case.objects.filter(pk__in=[1, 2, 3])]
+            return HttpResponse(', '.join(titles))
+
+        with self.assertLogs('core.profiling', 'WARNING') as logs:
+            response = QueryProfilingMiddleware(view)(RequestFactory().get('/cases/'))
+        self.assertIn('14 queries', response['Server-Timing'])
+        self.assertIn('12x SELECT', logs.output[0])
+        self.assertEqual(query_signature('WHERE "id" IN (%s, %s)'), query_signature('WHERE "id" IN (%s)'))
+
+        with override_settings(PROFILING_REPEATED_QUERIES=20), self.assertNoLogs('core.profiling'):
+            QueryProfilingMiddleware(view)(RequestFactory().get('/cases/'))
+
+
+class MetricsTests(TestCase):
+    def setUp(self):
+        self.manager = User.objects.create_user(username='manager', password='pass', role='case_manager')
+        create_case_data(self.manager, self.manager, 2)
+        self.metrics_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.metrics_dir)
+        override = override_settings(METRICS_DIR=self.metrics_dir, METRICS_TOKEN='secret')
+        override.enable()
+        self.addCleanup(override.disable)
+        REGISTRY.reset()
+        self.client.login(username='manager', password='pass')
+
+    def scrape(self):
+        response = self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer secret')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'text/plain; version=0.0.4; charset=utf-8')
+        return response.content.decode().splitlines()
+
+    def test_requests_are_recorded_by_url_name(self):
+        self.client.get(reverse('case_list'))
+        self.client.get('/api/cases/')
+        lines = self.scrape()
+        self.assertIn('aidconnect_requests_total{view="case_list",method="GET",status="200"} 1', lines)
+        self.assertIn('aidconnect_request_duration_seconds_count{view="case-list",method="GET"} 1', lines)
+        self.assertIn('aidconnect_request_duration_seconds_bucket{view="case_list",method="GET",le="+Inf"} 1', lines)
+        self.assertIn('aidconnect_request_queries_bucket{view="case_list",le="0.0"} 0', lines)
+        self.assertIn('# TYPE aidconnect_request_duration_seconds histogram', lines)
+        self.assertIn('aidconnect_requests_in_progress 1', lines)
+
+    def test_values_of_other_processes_are_added_up(self):
+        finished = subprocess.run([sys.executable, '-c', 'import os; print(os.getpid())'], capture_output=True, text=True)
+        REQUESTS.inc(view='case_list', method='GET', status=200)
+        for pid in (os.getppid(), int(finished.stdout)):
+            with open(os.path.join(self.metrics_dir, f'{pid}.json'), 'w') as output:
+                json.dump({
+                    'aidconnect_requests_total': [[['case_list', 'GET', '200'], 2]],
+                    'aidconnect_requests_in_progress': [[[], 3]],
+                }, output)
+        lines = self.scrape()
+        self.assertIn('aidconnect_requests_total{view="case_list",method="GET",status="200"} 5', lines)
+        # Gauges only count processes still running, the scraping request itself included
+        self.assertIn('aidconnect_requests_in_progress 4', lines)
+
+        REGISTRY.flush()
+        with open(os.path.join(self.metrics_dir, f'{os.getpid()}.json')) as source:
+            self.assertIn(['metrics', 'GET', '200'], [key for key, _ in json.load(source)['aidconnect_requests_total']])
+        # The first flush folds the files of exited processes into one, keeping their counts
+        self.assertNotIn(f'{int(finished.stdout)}.json', os.listdir(self.metrics_dir))
+        self.assertIn('retired.json', os.listdir(self.metrics_dir))
+        lines = self.scrape()
+        self.assertIn('aidconnect_requests_total{view="case_list",method="GET",status="200"} 5', lines)
+        self.assertIn('aidconnect_requests_in_progress 4', lines)
+
+    def test_reused_process_id_keeps_earlier_totals(self):
+        # Left by an earlier process that had this process's id
+        with open(os.path.join(self.metrics_dir, f'{os.getpid()}.json'), 'w') as output:
+            json.dump({'aidconnect_requests_total': [[['case_list', 'GET', '200'], 7]]}, output)
+        REQUESTS.inc(view='case_list', method='GET', status=200)
+        REGISTRY.flush()
+        self.assertIn('aidconnect_requests_total{view="case_list",method="GET",status="200"} 8', self.scrape())
+
+    def test_processes_that_never_served_write_nothing(self):
+        REQUESTS.inc(view='case_list', method='GET', status=200)
+        _flush_on_exit()
+        self.assertEqual(os.listdir(self.metrics_dir), [])
+
+    def test_reports_and_promotions_are_recorded(self):
+        ReportRun.objects.create(name='Queued', entity_type='case', fields='["title"]', created_by=self.manager)
+        response = self.client.post(reverse('generate_custom_report'), {
+            'entity_type': 'case', 'fields': ['title'], 'format': 'excel',
+        })
+        b''.join(response.streaming_content)
+        higher = BeneficiaryCategory.objects.create(name='Higher', max_annual_amount=5000)
+        plan = PromotionPlan()
+        plan.categories[Beneficiary.objects.first().pk] = higher.pk
+        apply_promotions(plan)
+
+        lines = self.scrape()
+        self.assertIn('aidconnect_reports_generated_total{format="excel",mode="download",status="completed"} 1', lines)
+        self.assertIn('aidconnect_report_generation_seconds_count{format="excel",entity="case",mode="download"} 1', lines)
+        self.assertIn('aidconnect_promotions_total{kind="category"} 1', lines)
+        self.assertIn('aidconnect_report_runs{status="queued"} 1', lines)
+
+    def test_directory_is_ignored_without_file_locks(self):
+        REQUESTS.inc(view='case_list', method='GET', status=200)
+        with patch('core.metrics.fcntl', None), patch('core.metrics._warned', False), self.assertLogs('core.metrics', 'WARNING'):
+            REGISTRY.flush()
+            self.assertIn('aidconnect_requests_total{view="case_list",method="GET",status="200"} 1', self.scrape())
+        self.assertEqual(os.listdir(self.metrics_dir), [])
+
+    def test_token_is_required(self):
+        self.assertEqual(self.client.get('/metrics').status_code, 401)
+        self.assertEqual(self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer other').status_code, 401)
+        with override_settings(METRICS_TOKEN=None):
+            self.assertEqual(self.client.get('/metrics').status_code, 404)
+
+
+class CategoryIndexCacheTests(TransactionTestCase):
+    def test_index_is_cached_until_categories_change(self):
+        category = BeneficiaryCategory.objects.create(name='Low', max_annual_amount=100)
+        self.assertEqual(get_category_index().smallest_at_least(50), category)
+        with self.assertNumQueries(0):
+            get_category_index().smallest_at_least(50)
+
+        category.max_annual_amount = 10
+        category.save()
+        self.assertIsNone(get_category_index().smallest_at_least(50))
+
+    def test_index_built_in_a_transaction_is_not_kept(self):
+        with transaction.atomic():
+            BeneficiaryCategory.objects.create(name='Pending', max_annual_amount=100)
+            self.assertIsNotNone(get_category_index().smallest_at_least(50))
+            transaction.set_rollback(True)
+        self.assertIsNone(get_category_index().smallest_at_least(50))
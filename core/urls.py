@@ -4,7 +4,7 @@ from rest_framework.routers import DefaultRouter
 from .views import (
     UserViewSet, BeneficiaryViewSet, CaseViewSet, CaseNoteViewSet,
     AssessmentViewSet, AssessmentQuestionViewSet, AssessmentAnswerViewSet,
-    ReferralViewSet, AlertViewSet, ActionPlanViewSet, BeneficiaryProgressViewSet,
+    ReferralViewSet, AlertViewSet, ActionPlanViewSet, BeneficiaryProgressViewSet, SyncView, ExportView, metrics_view,
     dashboard_redirect, admin_dashboard, case_manager_dashboard, field_officer_dashboard,
     partner_organisation_dashboard, monitoring_and_evaluation_dashboard, program_director_dashboard,
     login_view, BeneficiaryListView, BeneficiaryDetailView, BeneficiaryCreateView,
@@ -24,6 +24,7 @@ from .views import (
     ReportTemplateUpdateView, ReportTemplateDeleteView, ReportListView, 
     ReportDetailView, ReportCreateView, ReportUpdateView, ReportDeleteView,
     generate_report, generate_custom_report,
+    ReportRunListView, ReportRunDetailView, enqueue_report, report_run_status, download_report_run,
     # Action Plan views
     ActionPlanListView, ActionPlanDetailView, ActionPlanCreateView, ActionPlanUpdateView, ActionPlanDeleteView,
     # Beneficiary Progress views
@@ -51,7 +52,10 @@ router.register(r'beneficiary-progress', BeneficiaryProgressViewSet)
 # URL patterns
 urlpatterns = [
     # API endpoints - these will be included under /api/ in the main urls.py
+    path('api/sync/', SyncView.as_view(), name='api_sync'),
+    path('api/export/<str:entity_type>.ndjson', ExportView.as_view(), name='api_export'),
     path('api/', include(router.urls)),
+    path('metrics', metrics_view, name='metrics'),
 
     # Authentication
     path('', login_view, name='home'),  # Root URL serves the landing page
@@ -125,6 +129,13 @@ urlpatterns = [
     path('reports/<int:pk>/edit/', ReportUpdateView.as_view(), name='report_update'),
     path('reports/<int:pk>/delete/', ReportDeleteView.as_view(), name='report_delete'),
     path('reports/<int:pk>/generate/', generate_report, name='generate_report'),
+    path('reports/<int:pk>/enqueue/', enqueue_report, name='enqueue_report'),
+
+    # Background Report Runs
+    path('report-runs/', ReportRunListView.as_view(), name='report_run_list'),
+    path('report-runs/<int:pk>/', ReportRunDetailView.as_view(), name='report_run_detail'),
+    path('report-runs/<int:pk>/status/', report_run_status, name='report_run_status'),
+    path('report-runs/<int:pk>/download/', download_report_run, name='download_report_run'),
 
     # Custom Reports
     path('custom-report/', generate_custom_report, name='generate_custom_report'),
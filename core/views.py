@@ -2,31 +2,56 @@ from django.shortcuts import render, redirect, get_object_or_404
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.mixins import LoginRequiredMixin, UserPassesTestMixin
 from django.contrib.auth import authenticate, login
-from django.db.models import Count, Q
+from django.db.models import Count, Exists, OuterRef, Q, prefetch_related_objects
 from django.contrib import messages
 from django.urls import reverse, reverse_lazy
 from django.views.generic import ListView, DetailView, CreateView, UpdateView, DeleteView
-from django.http import HttpResponse, JsonResponse
-from rest_framework import viewsets
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse, FileResponse, Http404
+from django.utils import timezone
+from django.utils.cache import patch_vary_headers
+from django.utils.crypto import constant_time_compare
+from django.utils.dateparse import parse_datetime
+from django.utils.text import compress_sequence
+from django.conf import settings
+from rest_framework import status, viewsets
+from rest_framework.decorators import action
 from rest_framework.permissions import IsAuthenticated
+from rest_framework.response import Response
+from rest_framework.views import APIView
 import json
-import openpyxl
-from openpyxl.styles import Font, Alignment, PatternFill
-from openpyxl.utils import get_column_letter
-from xhtml2pdf import pisa
-from io import BytesIO
-from django.template.loader import get_template
+import time
 from .models import (
     User, Beneficiary, Case, CaseNote, Assessment, AssessmentQuestion, 
-    AssessmentAnswer, Program, BeneficiaryCategory, ReportTemplate, Report,
+    AssessmentAnswer, Program, BeneficiaryCategory, ReportTemplate, Report, ReportRun,
     Referral, Alert, ActionPlan, BeneficiaryProgress
 )
 from .serializers import (
     UserSerializer, BeneficiarySerializer, CaseSerializer, CaseNoteSerializer,
     AssessmentSerializer, AssessmentQuestionSerializer, AssessmentAnswerSerializer,
     ProgramSerializer, BeneficiaryCategorySerializer, ReferralSerializer, AlertSerializer,
-    ActionPlanSerializer, BeneficiaryProgressSerializer
+    ActionPlanSerializer, BeneficiaryProgressSerializer, FieldSelection, ValuesSerializerMixin,
+    CaseNoteBulkSerializer, AssessmentBulkSerializer
 )
+from .bulk import bulk_create_records
+from .conditional import ConditionalGetMixin, ConditionalRetrieveMixin
+from .reports import (
+    ENTITY_MODELS, EXPORT_CHUNK_SIZE, ReportQuery, ReportFieldError, get_field_options, build_report_queryset,
+    stream_excel_report, render_pdf_report
+)
+from .dashboards import (
+    track_queries, get_admin_dashboard, get_case_manager_dashboard, get_field_officer_dashboard,
+    get_partner_organisation_dashboard, get_monitoring_and_evaluation_dashboard, get_program_director_dashboard
+)
+from .report_cache import report_cache, report_cache_key
+from .counters import counter_key, set_counter
+from .funding import get_category_totals
+from .pagination import KeysetPaginationMixin
+from .scopes import RoleScope
+from .search import search
+from .export import export_rows, stream_ndjson
+from .metrics import CONTENT_TYPE, PROMOTIONS, REGISTRY, record_report, record_report_stream
+from .renderers import FastJSONRenderer, NDJSONRenderer
+from .sync import stream_changes
 
 # Authentication Views
 def login_view(request):
@@ -60,27 +85,108 @@ class UserViewSet(viewsets.ModelViewSet):
     queryset = User.objects.all()
     serializer_class = UserSerializer
 
-class BeneficiaryViewSet(viewsets.ModelViewSet):
+class RoleScopedViewSetMixin:
+    """Restricts a viewset to the rows the requesting user's role may see"""
+
+    def get_queryset(self):
+        return RoleScope(self.request.user).filter(super().get_queryset())
+
+class EagerLoadingViewSetMixin:
+    """Fetches the related rows the serializer reads along with the queryset"""
+
+    def get_queryset(self):
+        # Nested rows left out with ?fields= or ?expand= are not fetched
+        selection = FieldSelection.from_request(self.request)
+        return self.get_serializer_class().setup_eager_loading(super().get_queryset(), selection)
+
+class ValuesListViewSetMixin:
+    """
+    Lists from `.values()` rows when the serializer can represent every
+    field selected for the request from them, skipping model instances.
+    """
+
+    def list(self, request, *args, **kwargs):
+        serializer = self.get_serializer()
+        if not isinstance(serializer, ValuesSerializerMixin) or serializer.get_values_plan() is None:
+            return super().list(request, *args, **kwargs)
+        queryset = serializer.values_queryset(self.filter_queryset(self.get_queryset()))
+        page = self.paginate_queryset(queryset)
+        if page is not None:
+            return self.get_paginated_response(serializer.represent_rows(page))
+        return Response(serializer.represent_rows(list(queryset)))
+
+class BulkCreateViewSetMixin:
+    """
+    Adds `POST <list url>bulk/`, creating one object, authored by the
+    requesting user, from each valid item of a JSON list in one transaction.
+    Each item gets a result in the position it was sent: the created object,
+    or the errors it was rejected for.
+    """
+    bulk_serializer_class = None
+
+    @action(detail=False, methods=['post'])
+    def bulk(self, request):
+        items = request.data
+        if not isinstance(items, list):
+            return Response({'detail': 'Expected a list of items.'}, status=status.HTTP_400_BAD_REQUEST)
+        if len(items) > settings.API_BULK_MAX_ITEMS:
+            return Response(
+                {'detail': f'At most {settings.API_BULK_MAX_ITEMS} items can be created at once.'},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        result = bulk_create_records(self.bulk_serializer_class, items, request.user)
+        created = list(result.created.values())
+        serializer_class = self.get_serializer_class()
+        prefetch_related_objects(created, *getattr(serializer_class, 'prefetch_fields', []))
+        data = dict(zip(result.created, self.get_serializer(created, many=True).data))
+
+        results = []
+        for position in range(len(items)):
+            if position in data:
+                results.append({'status': status.HTTP_201_CREATED, 'data': data[position]})
+            else:
+                results.append({'status': status.HTTP_400_BAD_REQUEST, 'errors': result.errors[position]})
+        if not result.errors:
+            response_status = status.HTTP_201_CREATED
+        elif created:
+            response_status = status.HTTP_207_MULTI_STATUS
+        else:
+            response_status = status.HTTP_400_BAD_REQUEST
+        return Response({
+            'created': len(created),
+            'failed': len(result.errors),
+            'promoted': result.promoted,
+            'results': results,
+        }, status=response_status)
+
+class BeneficiaryViewSet(ConditionalRetrieveMixin, viewsets.ModelViewSet):
     queryset = Beneficiary.objects.all()
     serializer_class = BeneficiarySerializer
     permission_classes = [IsAuthenticated]
 
-class CaseViewSet(viewsets.ModelViewSet):
+class CaseViewSet(ConditionalRetrieveMixin, EagerLoadingViewSetMixin, RoleScopedViewSetMixin, viewsets.ModelViewSet):
     queryset = Case.objects.all()
     serializer_class = CaseSerializer
     permission_classes = [IsAuthenticated]
+    conditional_related = {
+        Beneficiary: 'cases', CaseNote: 'case', Assessment: 'case', AssessmentQuestion: 'assessment__case',
+    }
 
-class CaseNoteViewSet(viewsets.ModelViewSet):
+class CaseNoteViewSet(BulkCreateViewSetMixin, ValuesListViewSetMixin, ConditionalRetrieveMixin, EagerLoadingViewSetMixin, RoleScopedViewSetMixin, viewsets.ModelViewSet):
     queryset = CaseNote.objects.all()
     serializer_class = CaseNoteSerializer
+    bulk_serializer_class = CaseNoteBulkSerializer
     permission_classes = [IsAuthenticated]
 
-class AssessmentViewSet(viewsets.ModelViewSet):
+class AssessmentViewSet(BulkCreateViewSetMixin, ValuesListViewSetMixin, ConditionalRetrieveMixin, EagerLoadingViewSetMixin, RoleScopedViewSetMixin, viewsets.ModelViewSet):
     queryset = Assessment.objects.all()
     serializer_class = AssessmentSerializer
+    bulk_serializer_class = AssessmentBulkSerializer
     permission_classes = [IsAuthenticated]
+    conditional_related = {AssessmentQuestion: 'assessment'}
 
-class AssessmentQuestionViewSet(viewsets.ModelViewSet):
+class AssessmentQuestionViewSet(ConditionalRetrieveMixin, viewsets.ModelViewSet):
     queryset = AssessmentQuestion.objects.all()
     serializer_class = AssessmentQuestionSerializer
     permission_classes = [IsAuthenticated]
@@ -89,97 +195,129 @@ class AssessmentAnswerViewSet(viewsets.ModelViewSet):
     queryset = AssessmentAnswer.objects.all()
     serializer_class = AssessmentAnswerSerializer
     permission_classes = [IsAuthenticated]
-class ProgramViewSet(viewsets.ModelViewSet):
+class ProgramViewSet(ConditionalRetrieveMixin, viewsets.ModelViewSet):
     queryset = Program.objects.all()
     serializer_class = ProgramSerializer
     permission_classes = [IsAuthenticated]
 
-class BeneficiaryCategoryViewSet(viewsets.ModelViewSet):
+class BeneficiaryCategoryViewSet(ConditionalRetrieveMixin, viewsets.ModelViewSet):
     queryset = BeneficiaryCategory.objects.all()
     serializer_class = BeneficiaryCategorySerializer
     permission_classes = [IsAuthenticated]
 
-class ReferralViewSet(viewsets.ModelViewSet):
+class ReferralViewSet(ConditionalRetrieveMixin, EagerLoadingViewSetMixin, RoleScopedViewSetMixin, viewsets.ModelViewSet):
     queryset = Referral.objects.all()
     serializer_class = ReferralSerializer
     permission_classes = [IsAuthenticated]
-
-    def get_queryset(self):
-        queryset = super().get_queryset()
-        # Filter based on user role
-        if self.request.user.role in ['field_officer', 'case_manager', 'partner_organisation']:
-            queryset = queryset.filter(
-                Q(referred_by=self.request.user) | Q(referred_to_user=self.request.user)
-            )
-        return queryset
+    conditional_related = {Beneficiary: 'referrals', Case: 'referrals'}
 
     def perform_create(self, serializer):
         serializer.save(referred_by=self.request.user)
 
-class AlertViewSet(viewsets.ModelViewSet):
-    queryset = Alert.objects.all()
+class AlertViewSet(EagerLoadingViewSetMixin, RoleScopedViewSetMixin, viewsets.ModelViewSet):
+    queryset = Alert.objects.order_by('-created_at')
     serializer_class = AlertSerializer
     permission_classes = [IsAuthenticated]
 
-    def get_queryset(self):
-        # Show only alerts for the current user
-        return Alert.objects.filter(user=self.request.user).order_by('-created_at')
-
     def perform_create(self, serializer):
         serializer.save(user=self.request.user)
 
 
-class ActionPlanViewSet(viewsets.ModelViewSet):
+class ActionPlanViewSet(ConditionalRetrieveMixin, EagerLoadingViewSetMixin, RoleScopedViewSetMixin, viewsets.ModelViewSet):
     """
     API endpoint that allows action plans to be viewed or edited.
     """
-    queryset = ActionPlan.objects.all()
+    queryset = ActionPlan.objects.order_by('-created_at')
     serializer_class = ActionPlanSerializer
     permission_classes = [IsAuthenticated]
-
-    def get_queryset(self):
-        # Filter action plans based on user role
-        if self.request.user.role == 'case_manager':
-            # Case managers can see action plans they created
-            return ActionPlan.objects.filter(created_by=self.request.user).order_by('-created_at')
-        elif self.request.user.role == 'admin':
-            # Admins can see all action plans
-            return ActionPlan.objects.all().order_by('-created_at')
-        else:
-            # Other roles can't see action plans
-            return ActionPlan.objects.none()
+    conditional_related = {Case: 'action_plans', Beneficiary: 'cases__action_plans'}
 
     def perform_create(self, serializer):
         serializer.save(created_by=self.request.user)
 
 
-class BeneficiaryProgressViewSet(viewsets.ModelViewSet):
+class BeneficiaryProgressViewSet(ConditionalRetrieveMixin, EagerLoadingViewSetMixin, RoleScopedViewSetMixin, viewsets.ModelViewSet):
     """
     API endpoint that allows beneficiary progress to be viewed or edited.
     """
-    queryset = BeneficiaryProgress.objects.all()
+    queryset = BeneficiaryProgress.objects.order_by('-date')
     serializer_class = BeneficiaryProgressSerializer
     permission_classes = [IsAuthenticated]
-
-    def get_queryset(self):
-        # Filter progress records based on user role
-        if self.request.user.role == 'case_manager':
-            # Case managers can see progress for their cases
-            case_ids = Case.objects.filter(case_manager=self.request.user).values_list('id', flat=True)
-            return BeneficiaryProgress.objects.filter(case__id__in=case_ids).order_by('-date')
-        elif self.request.user.role == 'monitoring_and_evaluation':
-            # M&E can see all progress records
-            return BeneficiaryProgress.objects.all().order_by('-date')
-        elif self.request.user.role == 'admin':
-            # Admins can see all progress records
-            return BeneficiaryProgress.objects.all().order_by('-date')
-        else:
-            # Other roles can't see progress records
-            return BeneficiaryProgress.objects.none()
+    conditional_related = {Beneficiary: 'progress_records', Case: 'progress_records', ActionPlan: 'progress_records'}
 
     def perform_create(self, serializer):
         serializer.save(recorded_by=self.request.user)
 
+
+def streaming_response(request, content, content_type):
+    """StreamingHttpResponse of the byte chunks of `content`, gzipped when the client accepts it"""
+    if 'gzip' in request.META.get('HTTP_ACCEPT_ENCODING', ''):
+        response = StreamingHttpResponse(compress_sequence(content), content_type=content_type)
+        response['Content-Encoding'] = 'gzip'
+    else:
+        response = StreamingHttpResponse(content, content_type=content_type)
+    patch_vary_headers(response, ('Accept-Encoding',))
+    return response
+
+
+class SyncView(APIView):
+    """
+    API endpoint for offline clients: the records changed or come into the
+    user's scope since the `?since=` watermark of their last sync, with the
+    ids of those deleted or still in scope, or every record when no
+    watermark is given. Gzipped when accepted.
+    """
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request):
+        since = request.query_params.get('since')
+        if since:
+            try:
+                since = parse_datetime(since)
+            except ValueError:
+                since = None
+            if since is None:
+                return Response({'since': 'Not a valid timestamp.'}, status=400)
+            if timezone.is_naive(since):
+                since = timezone.make_aware(since)
+
+        content = (piece.encode('utf-8') for piece in stream_changes(request.user, since or None))
+        return streaming_response(request, content, 'application/json')
+
+
+class ExportView(APIView):
+    """
+    API endpoint streaming every row of an entity the user may see as
+    NDJSON, in id order from after `?after_id=` when given. Gzipped when
+    accepted.
+    """
+    permission_classes = [IsAuthenticated]
+    renderer_classes = [NDJSONRenderer, FastJSONRenderer]
+
+    def get(self, request, entity_type):
+        if entity_type not in ENTITY_MODELS:
+            raise Http404
+        after_id = request.query_params.get('after_id')
+        if after_id:
+            try:
+                after_id = int(after_id)
+            except ValueError:
+                return Response({'after_id': 'Not a valid id.'}, status=400)
+
+        rows = export_rows(request.user, entity_type, after_id or None)
+        response = streaming_response(request, stream_ndjson(rows), NDJSONRenderer.media_type)
+        response['Content-Disposition'] = f'attachment; filename="{entity_type}.ndjson"'
+        return response
+
+def metrics_view(request):
+    """Prometheus metrics of every process, for scrapers holding METRICS_TOKEN"""
+    token = settings.METRICS_TOKEN
+    if not token:
+        raise Http404
+    if not constant_time_compare(request.headers.get('Authorization', ''), f'Bearer {token}'):
+        return HttpResponse('Unauthorized', status=401)
+    return HttpResponse(REGISTRY.render(), content_type=CONTENT_TYPE)
+
 # Custom Mixins
 class RoleRequiredMixin(UserPassesTestMixin):
     """Mixin that checks if the user has the required role(s)"""
@@ -229,7 +367,7 @@ class AnyRoleRequiredMixin(RoleRequiredMixin):
     allowed_roles = ['admin', 'case_manager', 'field_officer', 'partner_organisation', 'monitoring_and_evaluation', 'program_director']
 
 # Beneficiary Views
-class BeneficiaryListView(LoginRequiredMixin, AnyRoleRequiredMixin, ListView):
+class BeneficiaryListView(LoginRequiredMixin, AnyRoleRequiredMixin, KeysetPaginationMixin, ListView):
     model = Beneficiary
     template_name = 'beneficiaries/beneficiary_list.html'
     context_object_name = 'beneficiaries'
@@ -241,10 +379,7 @@ class BeneficiaryListView(LoginRequiredMixin, AnyRoleRequiredMixin, ListView):
         # Apply search filter
         search_query = self.request.GET.get('search', '')
         if search_query:
-            queryset = queryset.filter(
-                Q(name__icontains=search_query) | 
-                Q(address__icontains=search_query)
-            )
+            queryset = search(queryset, search_query)
 
         # Apply gender filter
         gender = self.request.GET.get('gender', '')
@@ -253,37 +388,32 @@ class BeneficiaryListView(LoginRequiredMixin, AnyRoleRequiredMixin, ListView):
 
         # Apply sorting
         sort = self.request.GET.get('sort', 'name')
-        queryset = queryset.order_by(sort)
+        if search_query and 'sort' not in self.request.GET:
+            # Best matches first unless another order was asked for
+            queryset = queryset.order_by('search_rank', sort)
+        else:
+            queryset = queryset.order_by(sort)
 
         return queryset
 
 # Case Views
-class CaseListView(LoginRequiredMixin, AnyRoleRequiredMixin, ListView):
+class CaseListView(LoginRequiredMixin, AnyRoleRequiredMixin, KeysetPaginationMixin, ListView):
     model = Case
     template_name = 'cases/case_list.html'
     context_object_name = 'cases'
     paginate_by = 10
 
     def get_queryset(self):
-        queryset = super().get_queryset()
+        # The beneficiary and case manager are shown on every row
+        queryset = super().get_queryset().select_related('beneficiary', 'case_manager')
 
-        # Filter cases based on user role
-        if self.request.user.role == 'case_manager':
-            queryset = queryset.filter(case_manager=self.request.user)
-        elif self.request.user.role == 'field_officer':
-            # Field officers can only see cases they've contributed to
-            case_notes = CaseNote.objects.filter(created_by=self.request.user).values_list('case_id', flat=True)
-            assessments = Assessment.objects.filter(created_by=self.request.user).values_list('case_id', flat=True)
-            queryset = queryset.filter(Q(id__in=case_notes) | Q(id__in=assessments)).distinct()
+        # Restrict to what the user's role may see
+        queryset = RoleScope(self.request.user).filter(queryset)
 
         # Apply search filter
         search_query = self.request.GET.get('search', '')
         if search_query:
-            queryset = queryset.filter(
-                Q(title__icontains=search_query) | 
-                Q(description__icontains=search_query) |
-                Q(beneficiary__name__icontains=search_query)
-            )
+            queryset = search(queryset, search_query)
 
         # Apply status filter
         status = self.request.GET.get('status', '')
@@ -292,14 +422,22 @@ class CaseListView(LoginRequiredMixin, AnyRoleRequiredMixin, ListView):
 
         # Apply sorting
         sort = self.request.GET.get('sort', '-created_at')
-        queryset = queryset.order_by(sort)
+        if search_query and 'sort' not in self.request.GET:
+            # Best matches first unless another order was asked for
+            queryset = queryset.order_by('search_rank', sort)
+        else:
+            queryset = queryset.order_by(sort)
 
         return queryset
 
-class BeneficiaryDetailView(LoginRequiredMixin, AnyRoleRequiredMixin, DetailView):
+class BeneficiaryDetailView(LoginRequiredMixin, AnyRoleRequiredMixin, ConditionalGetMixin, DetailView):
     model = Beneficiary
     template_name = 'beneficiaries/beneficiary_detail.html'
     context_object_name = 'beneficiary'
+    conditional_related = {
+        Case: 'beneficiary', CaseNote: 'case__beneficiary', Assessment: 'case__beneficiary',
+        User: 'created_assessments__case__beneficiary',
+    }
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
@@ -310,18 +448,25 @@ class BeneficiaryDetailView(LoginRequiredMixin, AnyRoleRequiredMixin, DetailView
         context['active_cases'] = context['cases'].filter(status='open')
 
         # Get assessments from all cases
-        case_ids = context['cases'].values_list('id', flat=True)
-        context['assessments'] = Assessment.objects.filter(case__id__in=case_ids)
+        context['assessments'] = Assessment.objects.filter(case__beneficiary=beneficiary)
 
         # Get case notes from all cases
-        context['case_notes'] = CaseNote.objects.filter(case__id__in=case_ids)
+        context['case_notes'] = CaseNote.objects.filter(case__beneficiary=beneficiary)
 
         return context
 
-class CaseDetailView(LoginRequiredMixin, AnyRoleRequiredMixin, DetailView):
+class CaseDetailView(LoginRequiredMixin, AnyRoleRequiredMixin, ConditionalGetMixin, DetailView):
     model = Case
     template_name = 'cases/case_detail.html'
     context_object_name = 'case'
+    conditional_related = {
+        Beneficiary: 'cases', CaseNote: 'case', Assessment: 'case',
+        User: ('managed_cases', 'case_notes__case', 'created_assessments__case'),
+    }
+
+    def get_queryset(self):
+        # Restrict to what the user's role may see
+        return RoleScope(self.request.user).filter(super().get_queryset())
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
@@ -364,8 +509,7 @@ class CaseUpdateView(LoginRequiredMixin, AdminOrCaseManagerRequiredMixin, Update
     def get_queryset(self):
         queryset = super().get_queryset()
         # Case managers can only update their own cases
-        if self.request.user.role == 'case_manager':
-            queryset = queryset.filter(case_manager=self.request.user)
+        queryset = RoleScope(self.request.user).filter(queryset)
         return queryset
 
     def form_valid(self, form):
@@ -387,7 +531,7 @@ class CaseDeleteView(LoginRequiredMixin, AdminRequiredMixin, DeleteView):
         return super().delete(request, *args, **kwargs)
 
 # Assessment Views
-class AssessmentListView(LoginRequiredMixin, AnyRoleRequiredMixin, ListView):
+class AssessmentListView(LoginRequiredMixin, AnyRoleRequiredMixin, KeysetPaginationMixin, ListView):
     model = Assessment
     template_name = 'assessments/assessment_list.html'
     context_object_name = 'assessments'
@@ -396,14 +540,8 @@ class AssessmentListView(LoginRequiredMixin, AnyRoleRequiredMixin, ListView):
     def get_queryset(self):
         queryset = super().get_queryset()
 
-        # Filter assessments based on user role
-        if self.request.user.role == 'case_manager':
-            # Case managers can see assessments for their cases
-            case_ids = Case.objects.filter(case_manager=self.request.user).values_list('id', flat=True)
-            queryset = queryset.filter(case__id__in=case_ids)
-        elif self.request.user.role == 'field_officer':
-            # Field officers can only see assessments they created
-            queryset = queryset.filter(created_by=self.request.user)
+        # Restrict to what the user's role may see
+        queryset = RoleScope(self.request.user).filter(queryset)
 
         # Apply search filter
         search_query = self.request.GET.get('search', '')
@@ -438,14 +576,8 @@ class AssessmentDetailView(LoginRequiredMixin, AnyRoleRequiredMixin, DetailView)
 
     def get_queryset(self):
         queryset = super().get_queryset()
-        # Filter based on user role
-        if self.request.user.role == 'case_manager':
-            # Case managers can see assessments for their cases
-            case_ids = Case.objects.filter(case_manager=self.request.user).values_list('id', flat=True)
-            queryset = queryset.filter(case__id__in=case_ids)
-        elif self.request.user.role == 'field_officer':
-            # Field officers can only see assessments they created
-            queryset = queryset.filter(created_by=self.request.user)
+        # Restrict to what the user's role may see
+        queryset = RoleScope(self.request.user).filter(queryset)
         return queryset
 
 class AssessmentCreateView(LoginRequiredMixin, AnyRoleRequiredMixin, CreateView):
@@ -478,12 +610,13 @@ class AssessmentCreateView(LoginRequiredMixin, AnyRoleRequiredMixin, CreateView)
         total_amount_received = self.object.get_total_amount_received()
 
         # Check if the beneficiary can be promoted to another category
-        can_promote_category, new_category = self.object.check_category_promotion()
+        can_promote_category, new_category = self.object.check_category_promotion(total_amount_received)
 
         if can_promote_category and new_category:
             old_category = beneficiary.category
             beneficiary.category = new_category
             updated = True
+            PROMOTIONS.inc(kind='category')
 
             # Add a success message about the category promotion
             if old_category:
@@ -500,6 +633,7 @@ class AssessmentCreateView(LoginRequiredMixin, AnyRoleRequiredMixin, CreateView)
             old_program = beneficiary.program
             beneficiary.program = new_program
             updated = True
+            PROMOTIONS.inc(kind='program')
 
             # Add a success message about the program promotion
             messages.success(self.request, 
@@ -523,9 +657,7 @@ class AssessmentUpdateView(LoginRequiredMixin, AdminOrCaseManagerRequiredMixin,
     def get_queryset(self):
         queryset = super().get_queryset()
         # Case managers can only update assessments for their cases
-        if self.request.user.role == 'case_manager':
-            case_ids = Case.objects.filter(case_manager=self.request.user).values_list('id', flat=True)
-            queryset = queryset.filter(case__id__in=case_ids)
+        queryset = RoleScope(self.request.user).filter(queryset)
         return queryset
 
     def get_form(self, form_class=None):
@@ -546,12 +678,13 @@ class AssessmentUpdateView(LoginRequiredMixin, AdminOrCaseManagerRequiredMixin,
         total_amount_received = self.object.get_total_amount_received()
 
         # Check if the beneficiary can be promoted to another category
-        can_promote_category, new_category = self.object.check_category_promotion()
+        can_promote_category, new_category = self.object.check_category_promotion(total_amount_received)
 
         if can_promote_category and new_category:
             old_category = beneficiary.category
             beneficiary.category = new_category
             updated = True
+            PROMOTIONS.inc(kind='category')
 
             # Add a success message about the category promotion
             if old_category:
@@ -568,6 +701,7 @@ class AssessmentUpdateView(LoginRequiredMixin, AdminOrCaseManagerRequiredMixin,
             old_program = beneficiary.program
             beneficiary.program = new_program
             updated = True
+            PROMOTIONS.inc(kind='program')
 
             # Add a success message about the program promotion
             messages.success(self.request, 
@@ -595,7 +729,7 @@ class AssessmentDeleteView(LoginRequiredMixin, AdminRequiredMixin, DeleteView):
         return super().delete(request, *args, **kwargs)
 
 # Case Note Views
-class CaseNoteListView(LoginRequiredMixin, AnyRoleRequiredMixin, ListView):
+class CaseNoteListView(LoginRequiredMixin, AnyRoleRequiredMixin, KeysetPaginationMixin, ListView):
     model = CaseNote
     template_name = 'case_notes/case_note_list.html'
     context_object_name = 'case_notes'
@@ -604,27 +738,21 @@ class CaseNoteListView(LoginRequiredMixin, AnyRoleRequiredMixin, ListView):
     def get_queryset(self):
         queryset = super().get_queryset()
 
-        # Filter case notes based on user role
-        if self.request.user.role == 'case_manager':
-            # Case managers can see notes for their cases
-            case_ids = Case.objects.filter(case_manager=self.request.user).values_list('id', flat=True)
-            queryset = queryset.filter(case__id__in=case_ids)
-        elif self.request.user.role == 'field_officer':
-            # Field officers can only see notes they created
-            queryset = queryset.filter(created_by=self.request.user)
+        # Restrict to what the user's role may see
+        queryset = RoleScope(self.request.user).filter(queryset)
 
         # Apply search filter
         search_query = self.request.GET.get('search', '')
         if search_query:
-            queryset = queryset.filter(
-                Q(content__icontains=search_query) | 
-                Q(case__title__icontains=search_query) |
-                Q(case__beneficiary__name__icontains=search_query)
-            )
+            queryset = search(queryset, search_query)
 
         # Apply sorting
         sort = self.request.GET.get('sort', '-created_at')
-        queryset = queryset.order_by(sort)
+        if search_query and 'sort' not in self.request.GET:
+            # Best matches first unless another order was asked for
+            queryset = queryset.order_by('search_rank', sort)
+        else:
+            queryset = queryset.order_by(sort)
 
         return queryset
 
@@ -635,14 +763,8 @@ class CaseNoteDetailView(LoginRequiredMixin, AnyRoleRequiredMixin, DetailView):
 
     def get_queryset(self):
         queryset = super().get_queryset()
-        # Filter based on user role
-        if self.request.user.role == 'case_manager':
-            # Case managers can see notes for their cases
-            case_ids = Case.objects.filter(case_manager=self.request.user).values_list('id', flat=True)
-            queryset = queryset.filter(case__id__in=case_ids)
-        elif self.request.user.role == 'field_officer':
-            # Field officers can only see notes they created
-            queryset = queryset.filter(created_by=self.request.user)
+        # Restrict to what the user's role may see
+        queryset = RoleScope(self.request.user).filter(queryset)
         return queryset
 
 class CaseNoteCreateView(LoginRequiredMixin, AnyRoleRequiredMixin, CreateView):
@@ -765,11 +887,10 @@ class BeneficiaryDeleteView(LoginRequiredMixin, AdminRequiredMixin, DeleteView):
         context['cases'] = Case.objects.filter(beneficiary=beneficiary)
 
         # Get assessments from all cases
-        case_ids = context['cases'].values_list('id', flat=True)
-        context['assessments'] = Assessment.objects.filter(case__id__in=case_ids)
+        context['assessments'] = Assessment.objects.filter(case__beneficiary=beneficiary)
 
         # Get case notes from all cases
-        context['case_notes'] = CaseNote.objects.filter(case__id__in=case_ids)
+        context['case_notes'] = CaseNote.objects.filter(case__beneficiary=beneficiary)
 
         return context
 
@@ -799,251 +920,82 @@ def dashboard_redirect(request):
         return redirect('login')
 
 @login_required
+@track_queries
 def admin_dashboard(request):
     """Admin dashboard view"""
     if request.user.role != 'admin':
         messages.error(request, "You don't have permission to access the admin dashboard.")
         return redirect('dashboard_redirect')
 
-    # Get counts for dashboard cards
-    user_count = User.objects.count()
-    beneficiary_count = Beneficiary.objects.count()
-    active_case_count = Case.objects.filter(status='open').count()
-    assessment_count = Assessment.objects.count()
-    program_count = Program.objects.count()
-    category_count = BeneficiaryCategory.objects.count()
-
-    # Get recent cases
-    recent_cases = Case.objects.all().order_by('-created_at')[:10]
-
-    # Get recent programs and categories
-    recent_programs = Program.objects.all().order_by('-id')[:5]
-    recent_categories = BeneficiaryCategory.objects.all().order_by('-id')[:5]
-
-    context = {
-        'user_count': user_count,
-        'beneficiary_count': beneficiary_count,
-        'active_case_count': active_case_count,
-        'assessment_count': assessment_count,
-        'program_count': program_count,
-        'category_count': category_count,
-        'recent_cases': recent_cases,
-        'recent_programs': recent_programs,
-        'recent_categories': recent_categories,
-    }
+    context = get_admin_dashboard(request.user)
 
     return render(request, 'dashboard/admin_dashboard.html', context)
 
 @login_required
+@track_queries
 def case_manager_dashboard(request):
     """Case manager dashboard view"""
     if request.user.role != 'case_manager':
         messages.error(request, "You don't have permission to access the case manager dashboard.")
         return redirect('dashboard_redirect')
 
-    # Get counts for dashboard cards
-    active_case_count = Case.objects.filter(case_manager=request.user, status='open').count()
-    beneficiary_count = Beneficiary.objects.count()
-    assessment_count = Assessment.objects.filter(created_by=request.user).count()
-    program_count = Program.objects.count()
-    category_count = BeneficiaryCategory.objects.count()
-    action_plan_count = ActionPlan.objects.filter(created_by=request.user).count()
-
-    # Get case IDs for this case manager
-    case_ids = Case.objects.filter(case_manager=request.user).values_list('id', flat=True)
-
-    # Get progress records count for this case manager's cases
-    progress_count = BeneficiaryProgress.objects.filter(case__id__in=case_ids).count()
-
-    # Get cases assigned to this case manager
-    my_cases = Case.objects.filter(case_manager=request.user).order_by('-created_at')[:10]
-
-    # Get recent case notes by this user
-    recent_notes = CaseNote.objects.filter(created_by=request.user).order_by('-created_at')[:10]
-
-    # Get recent action plans by this user
-    recent_action_plans = ActionPlan.objects.filter(created_by=request.user).order_by('-created_at')[:10]
-
-    # Get recent progress records for this case manager's cases
-    recent_progress = BeneficiaryProgress.objects.filter(case__id__in=case_ids).order_by('-date')[:10]
-
-    # Get recent programs and categories
-    recent_programs = Program.objects.all().order_by('-id')[:5]
-    recent_categories = BeneficiaryCategory.objects.all().order_by('-id')[:5]
-
-    context = {
-        'active_case_count': active_case_count,
-        'beneficiary_count': beneficiary_count,
-        'assessment_count': assessment_count,
-        'program_count': program_count,
-        'category_count': category_count,
-        'action_plan_count': action_plan_count,
-        'progress_count': progress_count,
-        'my_cases': my_cases,
-        'recent_notes': recent_notes,
-        'recent_action_plans': recent_action_plans,
-        'recent_progress': recent_progress,
-        'recent_programs': recent_programs,
-        'recent_categories': recent_categories,
-    }
+    context = get_case_manager_dashboard(request.user)
 
     return render(request, 'dashboard/case_manager_dashboard.html', context)
 
 @login_required
+@track_queries
 def field_officer_dashboard(request):
     """Field officer dashboard view"""
     if request.user.role != 'field_officer':
         messages.error(request, "You don't have permission to access the field officer dashboard.")
         return redirect('dashboard_redirect')
 
-    # Get counts for dashboard cards
-    assessment_count = Assessment.objects.filter(created_by=request.user).count()
-    case_note_count = CaseNote.objects.filter(created_by=request.user).count()
-    beneficiary_count = Beneficiary.objects.count()
-    referral_count = Referral.objects.filter(referred_by=request.user).count()
-
-    # Get recent assessments by this user
-    recent_assessments = Assessment.objects.filter(created_by=request.user).order_by('-created_at')[:10]
-
-    # Get recent case notes by this user
-    recent_notes = CaseNote.objects.filter(created_by=request.user).order_by('-created_at')[:10]
-
-    # Get recent referrals by this user
-    recent_referrals = Referral.objects.filter(referred_by=request.user).order_by('-created_at')[:10]
-
-    context = {
-        'assessment_count': assessment_count,
-        'case_note_count': case_note_count,
-        'beneficiary_count': beneficiary_count,
-        'referral_count': referral_count,
-        'recent_assessments': recent_assessments,
-        'recent_notes': recent_notes,
-        'recent_referrals': recent_referrals,
-    }
+    context = get_field_officer_dashboard(request.user)
 
     return render(request, 'dashboard/field_officer_dashboard.html', context)
 
 
 @login_required
+@track_queries
 def partner_organisation_dashboard(request):
     """Partner organisation dashboard view"""
     if request.user.role != 'partner_organisation':
         messages.error(request, "You don't have permission to access the partner organisation dashboard.")
         return redirect('dashboard_redirect')
 
-    # Get counts for dashboard cards
-    referral_count = Referral.objects.filter(referred_by=request.user).count()
-    received_referral_count = Referral.objects.filter(referred_to_user=request.user).count()
-    report_count = Report.objects.filter(created_by=request.user).count()
-    beneficiary_count = Beneficiary.objects.count()
-
-    # Get recent referrals by this user
-    recent_referrals = Referral.objects.filter(referred_by=request.user).order_by('-created_at')[:10]
-
-    # Get recent referrals to this user
-    recent_received_referrals = Referral.objects.filter(referred_to_user=request.user).order_by('-created_at')[:10]
-
-    # Get recent reports by this user
-    recent_reports = Report.objects.filter(created_by=request.user).order_by('-created_at')[:10]
-
-    context = {
-        'referral_count': referral_count,
-        'received_referral_count': received_referral_count,
-        'report_count': report_count,
-        'beneficiary_count': beneficiary_count,
-        'recent_referrals': recent_referrals,
-        'recent_received_referrals': recent_received_referrals,
-        'recent_reports': recent_reports,
-    }
+    context = get_partner_organisation_dashboard(request.user)
 
     return render(request, 'dashboard/partner_organisation_dashboard.html', context)
 
 
 @login_required
+@track_queries
 def monitoring_and_evaluation_dashboard(request):
     """Monitoring and evaluation dashboard view"""
     if request.user.role != 'monitoring_and_evaluation':
         messages.error(request, "You don't have permission to access the monitoring and evaluation dashboard.")
         return redirect('dashboard_redirect')
 
-    # Get counts for dashboard cards
-    beneficiary_count = Beneficiary.objects.count()
-    case_count = Case.objects.count()
-    assessment_count = Assessment.objects.count()
-    report_count = Report.objects.filter(created_by=request.user).count()
-    action_plan_count = ActionPlan.objects.count()
-    progress_count = BeneficiaryProgress.objects.count()
-
-    # Get recent cases
-    recent_cases = Case.objects.all().order_by('-created_at')[:10]
-
-    # Get recent assessments
-    recent_assessments = Assessment.objects.all().order_by('-created_at')[:10]
-
-    # Get recent reports by this user
-    recent_reports = Report.objects.filter(created_by=request.user).order_by('-created_at')[:10]
-
-    # Get recent action plans
-    recent_action_plans = ActionPlan.objects.all().order_by('-created_at')[:10]
-
-    # Get recent progress records
-    recent_progress = BeneficiaryProgress.objects.all().order_by('-date')[:10]
-
-    context = {
-        'beneficiary_count': beneficiary_count,
-        'case_count': case_count,
-        'assessment_count': assessment_count,
-        'report_count': report_count,
-        'action_plan_count': action_plan_count,
-        'progress_count': progress_count,
-        'recent_cases': recent_cases,
-        'recent_assessments': recent_assessments,
-        'recent_reports': recent_reports,
-        'recent_action_plans': recent_action_plans,
-        'recent_progress': recent_progress,
-    }
+    context = get_monitoring_and_evaluation_dashboard(request.user)
 
     return render(request, 'dashboard/monitoring_and_evaluation_dashboard.html', context)
 
 
 @login_required
+@track_queries
 def program_director_dashboard(request):
     """Program director dashboard view"""
     if request.user.role != 'program_director':
         messages.error(request, "You don't have permission to access the program director dashboard.")
         return redirect('dashboard_redirect')
 
-    # Get counts for dashboard cards
-    beneficiary_count = Beneficiary.objects.count()
-    program_count = Program.objects.count()
-    case_count = Case.objects.count()
-    report_count = Report.objects.filter(created_by=request.user).count()
-    alert_count = Alert.objects.filter(user=request.user, is_read=False).count()
-
-    # Get recent programs
-    recent_programs = Program.objects.all().order_by('-id')[:10]
-
-    # Get recent reports by this user
-    recent_reports = Report.objects.filter(created_by=request.user).order_by('-created_at')[:10]
-
-    # Get unread alerts for this user
-    unread_alerts = Alert.objects.filter(user=request.user, is_read=False).order_by('-created_at')[:10]
-
-    context = {
-        'beneficiary_count': beneficiary_count,
-        'program_count': program_count,
-        'case_count': case_count,
-        'report_count': report_count,
-        'alert_count': alert_count,
-        'recent_programs': recent_programs,
-        'recent_reports': recent_reports,
-        'unread_alerts': unread_alerts,
-    }
+    context = get_program_director_dashboard(request.user)
 
     return render(request, 'dashboard/program_director_dashboard.html', context)
 
 # Referral Views
-class ReferralListView(LoginRequiredMixin, AnyRoleRequiredMixin, ListView):
+class ReferralListView(LoginRequiredMixin, AnyRoleRequiredMixin, KeysetPaginationMixin, ListView):
     model = Referral
     template_name = 'referrals/referral_list.html'
     context_object_name = 'referrals'
@@ -1052,27 +1004,13 @@ class ReferralListView(LoginRequiredMixin, AnyRoleRequiredMixin, ListView):
     def get_queryset(self):
         queryset = super().get_queryset()
 
-        # Filter referrals based on user role
-        if self.request.user.role in ['field_officer', 'case_manager', 'partner_organisation']:
-            # These roles can see referrals they made
-            queryset = queryset.filter(
-                Q(referred_by=self.request.user) | Q(referred_to_user=self.request.user)
-            )
-        elif self.request.user.role == 'monitoring_and_evaluation':
-            # M&E can see all referrals for tracking
-            pass
-        elif self.request.user.role == 'program_director':
-            # Program directors can see all referrals
-            pass
+        # Restrict to what the user's role may see
+        queryset = RoleScope(self.request.user).filter(queryset)
 
         # Apply search filter
         search_query = self.request.GET.get('search', '')
         if search_query:
-            queryset = queryset.filter(
-                Q(beneficiary__name__icontains=search_query) | 
-                Q(referred_to_organization__icontains=search_query) |
-                Q(reason__icontains=search_query)
-            )
+            queryset = search(queryset, search_query)
 
         # Apply status filter
         status = self.request.GET.get('status', '')
@@ -1081,7 +1019,11 @@ class ReferralListView(LoginRequiredMixin, AnyRoleRequiredMixin, ListView):
 
         # Apply sorting
         sort = self.request.GET.get('sort', '-created_at')
-        queryset = queryset.order_by(sort)
+        if search_query and 'sort' not in self.request.GET:
+            # Best matches first unless another order was asked for
+            queryset = queryset.order_by('search_rank', sort)
+        else:
+            queryset = queryset.order_by(sort)
 
         return queryset
 
@@ -1092,11 +1034,8 @@ class ReferralDetailView(LoginRequiredMixin, AnyRoleRequiredMixin, DetailView):
 
     def get_queryset(self):
         queryset = super().get_queryset()
-        # Filter based on user role
-        if self.request.user.role in ['field_officer', 'case_manager', 'partner_organisation']:
-            queryset = queryset.filter(
-                Q(referred_by=self.request.user) | Q(referred_to_user=self.request.user)
-            )
+        # Restrict to what the user's role may see
+        queryset = RoleScope(self.request.user).filter(queryset)
         return queryset
 
 class ReferralCreateView(LoginRequiredMixin, CanMakeReferralMixin, CreateView):
@@ -1168,7 +1107,7 @@ class AlertListView(LoginRequiredMixin, CanReceiveAlertsMixin, ListView):
 
     def get_queryset(self):
         # Show only alerts for the current user
-        return Alert.objects.filter(user=self.request.user).order_by('-created_at')
+        return RoleScope(self.request.user).queryset(Alert).order_by('-created_at')
 
 class AlertDetailView(LoginRequiredMixin, CanReceiveAlertsMixin, DetailView):
     model = Alert
@@ -1177,7 +1116,7 @@ class AlertDetailView(LoginRequiredMixin, CanReceiveAlertsMixin, DetailView):
 
     def get_queryset(self):
         # Show only alerts for the current user
-        return Alert.objects.filter(user=self.request.user)
+        return RoleScope(self.request.user).queryset(Alert)
 
     def get(self, request, *args, **kwargs):
         # Mark the alert as read when viewed
@@ -1207,6 +1146,8 @@ def mark_all_alerts_read(request):
     """Mark all alerts for the current user as read"""
     if request.method == 'POST':
         Alert.objects.filter(user=request.user, is_read=False).update(is_read=True)
+        # Bulk updates bypass the signals that maintain the dashboard counters
+        set_counter(counter_key('unread_alerts', request.user), 0)
         messages.success(request, "All alerts marked as read.")
     return redirect('alert_list')
 
@@ -1217,10 +1158,12 @@ class ProgramListView(LoginRequiredMixin, AnyRoleRequiredMixin, ListView):
     context_object_name = 'programs'
     paginate_by = 10
 
-class ProgramDetailView(LoginRequiredMixin, AnyRoleRequiredMixin, DetailView):
+class ProgramDetailView(LoginRequiredMixin, AnyRoleRequiredMixin, ConditionalGetMixin, DetailView):
     model = Program
     template_name = 'programs/program_detail.html'
     context_object_name = 'program'
+    # Other programs are listed as related ones, and beneficiaries with their category
+    conditional_related = {Beneficiary: 'program', Program: None, BeneficiaryCategory: None}
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
@@ -1290,7 +1233,17 @@ class BeneficiaryCategoryDetailView(LoginRequiredMixin, AnyRoleRequiredMixin, De
         category = self.get_object()
 
         # Get beneficiaries in this category
-        beneficiaries = category.beneficiaries.all()
+        beneficiaries = list(category.beneficiaries.select_related('program'))
+
+        # Amounts received this year, read from the funding ledger
+        funding_year = timezone.now().year
+        received = get_category_totals(category, funding_year)
+        for beneficiary in beneficiaries:
+            beneficiary.received_this_year = received.get(beneficiary.pk, 0)
+        context['beneficiaries'] = beneficiaries
+        context['funding_year'] = funding_year
+        context['received_this_year'] = sum(received.values())
+        context['over_limit_count'] = sum(1 for total in received.values() if total > category.max_annual_amount)
 
         # Calculate total annual disbursement based on beneficiaries' programs
         total_annual_disbursement = 0
@@ -1456,15 +1409,34 @@ def generate_report(request, pk):
     """Generate a report based on the saved configuration"""
     report = get_object_or_404(Report, pk=pk, created_by=request.user)
     template = report.template
+    filters = report.get_filters_dict()
+
+    # Serve an identical earlier report from the cache without querying its data
+    cache_key = report_cache_key(
+        request.user, template.entity_type, template.get_fields_list(), filters, report.format,
+        template.name, template.description,
+    )
+    cached_path = report_cache.get(cache_key, report.format)
+    if cached_path:
+        extension = 'xlsx' if report.format == 'excel' else 'pdf'
+        return FileResponse(open(cached_path, 'rb'), as_attachment=True, filename=f"{template.name}.{extension}")
 
     # Get the data based on the entity type
-    data = get_report_data(request, template.entity_type, report.get_filters_dict())
+    data = get_report_data(request, template.entity_type, filters)
 
     # Generate the report in the requested format
     if report.format == 'excel':
-        return generate_excel_report(request, report, data)
+        response = generate_excel_report(request, report, data)
     else:
-        return generate_pdf_report(request, report, data)
+        response = generate_pdf_report(request, report, data)
+
+    # Keep a copy of the report while it is being sent
+    if response.status_code == 200:
+        if response.streaming:
+            response.streaming_content = report_cache.store_stream(cache_key, report.format, response.streaming_content)
+        else:
+            report_cache.store(cache_key, report.format, response.content)
+    return response
 
 @login_required
 def generate_custom_report(request):
@@ -1483,6 +1455,19 @@ def generate_custom_report(request):
             created_by=request.user
         )
 
+        # Large reports can be handed to the background report worker
+        if request.POST.get('background'):
+            run = ReportRun.objects.create(
+                name=temp_template.name,
+                entity_type=entity_type,
+                fields=temp_template.fields,
+                filters=json.dumps(filters),
+                format=format_type,
+                created_by=request.user,
+            )
+            messages.success(request, f"Report '{run.name}' has been queued for generation.")
+            return redirect('report_run_detail', pk=run.pk)
+
         # Get the data based on the entity type
         data = get_report_data(request, entity_type, filters)
 
@@ -1504,136 +1489,27 @@ def generate_custom_report(request):
 
 def get_report_data(request, entity_type, filters=None):
     """Get the data for a report based on the entity type and filters"""
-    if filters is None:
-        filters = {}
-
-    # Apply role-based restrictions
-    if request.user.role == 'case_manager':
-        if entity_type == 'case':
-            filters['case_manager'] = request.user.id
-        elif entity_type == 'assessment':
-            filters['created_by'] = request.user.id
-        elif entity_type == 'case_note':
-            filters['created_by'] = request.user.id
-    elif request.user.role == 'field_officer':
-        if entity_type == 'assessment':
-            filters['created_by'] = request.user.id
-        elif entity_type == 'case_note':
-            filters['created_by'] = request.user.id
-
-    # Get the data based on the entity type
-    if entity_type == 'beneficiary':
-        queryset = Beneficiary.objects.all()
-    elif entity_type == 'case':
-        queryset = Case.objects.all()
-    elif entity_type == 'assessment':
-        queryset = Assessment.objects.all()
-    elif entity_type == 'case_note':
-        queryset = CaseNote.objects.all()
-    elif entity_type == 'program':
-        queryset = Program.objects.all()
-    elif entity_type == 'category':
-        queryset = BeneficiaryCategory.objects.all()
-    else:
-        queryset = []
-
-    # Apply filters
-    for key, value in filters.items():
-        if value:  # Only apply non-empty filters
-            queryset = queryset.filter(**{key: value})
-
-    return queryset
-
-def get_field_options():
-    """Get available fields for each entity type"""
-    return {
-        'beneficiary': [
-            'id', 'name', 'dob', 'gender', 'address', 'category__name', 
-            'program__name', 'created_at', 'updated_at'
-        ],
-        'case': [
-            'id', 'title', 'beneficiary__name', 'case_manager__username', 
-            'status', 'description', 'opened_date', 'closed_date', 
-            'created_at', 'updated_at'
-        ],
-        'assessment': [
-            'id', 'title', 'case__title', 'case__beneficiary__name', 
-            'created_by__username', 'amount_received', 'year', 
-            'created_at', 'updated_at'
-        ],
-        'case_note': [
-            'id', 'case__title', 'case__beneficiary__name', 
-            'created_by__username', 'content', 'created_at', 'updated_at'
-        ],
-        'program': [
-            'id', 'name', 'description', 'monthly_amount', 
-            'next_program__name'
-        ],
-        'category': [
-            'id', 'name', 'description', 'max_annual_amount'
-        ]
-    }
+    return build_report_queryset(request.user, entity_type, filters)
 
 def generate_excel_report(request, report=None, data=None, template=None):
-    """Generate an Excel report"""
+    """Generate an Excel report, streamed to the client as it is written"""
     if report:
         template = report.template
 
-    # Create a new workbook and select the active worksheet
-    wb = openpyxl.Workbook()
-    ws = wb.active
-    ws.title = template.name[:31]  # Excel worksheet names are limited to 31 chars
-
-    # Get the fields to include
-    fields = template.get_fields_list()
-
-    # Add header row
-    header_font = Font(bold=True, color="FFFFFF")
-    header_fill = PatternFill(start_color="4F81BD", end_color="4F81BD", fill_type="solid")
-    header_alignment = Alignment(horizontal="center", vertical="center")
-
-    for col_idx, field in enumerate(fields, 1):
-        cell = ws.cell(row=1, column=col_idx, value=field.replace('__', ' ').replace('_', ' ').title())
-        cell.font = header_font
-        cell.fill = header_fill
-        cell.alignment = header_alignment
-
-    # Add data rows
-    for row_idx, item in enumerate(data, 2):
-        for col_idx, field in enumerate(fields, 1):
-            # Handle nested fields (e.g., beneficiary__name)
-            if '__' in field:
-                parts = field.split('__')
-                value = item
-                for part in parts:
-                    if hasattr(value, part):
-                        value = getattr(value, part)
-                    else:
-                        value = None
-                        break
-            else:
-                value = getattr(item, field, None)
-
-            ws.cell(row=row_idx, column=col_idx, value=value)
-
-    # Add summary row
-    summary_row = len(data) + 3
-    ws.cell(row=summary_row, column=1, value="Summary").font = Font(bold=True)
-    ws.cell(row=summary_row, column=2, value=f"Total Records: {len(data)}")
+    try:
+        query = ReportQuery.for_template(template)
+    except ReportFieldError as e:
+        return HttpResponse(str(e), status=400)
 
-    # Auto-adjust column widths
-    for col_idx, _ in enumerate(fields, 1):
-        col_letter = get_column_letter(col_idx)
-        ws.column_dimensions[col_letter].width = 20
+    # Project the requested fields in SQL and read them in chunks so that the
+    # export never holds more than one chunk of rows in memory
+    rows = query.iter_rows(data, chunk_size=EXPORT_CHUNK_SIZE)
 
-    # Create response
-    response = HttpResponse(
+    response = StreamingHttpResponse(
+        record_report_stream(stream_excel_report(template.name, query, rows), 'excel', template.entity_type, 'download'),
         content_type='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
     )
     response['Content-Disposition'] = f'attachment; filename="{template.name}.xlsx"'
-
-    # Save the workbook to the response
-    wb.save(response)
     return response
 
 def generate_pdf_report(request, report=None, data=None, template=None):
@@ -1641,60 +1517,97 @@ def generate_pdf_report(request, report=None, data=None, template=None):
     if report:
         template = report.template
 
-    # Get the fields to include
-    fields = template.get_fields_list()
-
-    # Prepare data for the template
-    headers = [field.replace('__', ' ').replace('_', ' ').title() for field in fields]
-    rows = []
-
-    for item in data:
-        row = []
-        for field in fields:
-            # Handle nested fields (e.g., beneficiary__name)
-            if '__' in field:
-                parts = field.split('__')
-                value = item
-                for part in parts:
-                    if hasattr(value, part):
-                        value = getattr(value, part)
-                    else:
-                        value = None
-                        break
-            else:
-                value = getattr(item, field, None)
-
-            row.append(value)
-        rows.append(row)
+    try:
+        query = ReportQuery.for_template(template)
+    except ReportFieldError as e:
+        return HttpResponse(str(e), status=400)
 
-    # Prepare context for the template
-    context = {
-        'title': template.name,
-        'description': template.description,
-        'headers': headers,
-        'rows': rows,
-        'total_records': len(data),
-        'generated_by': request.user.username,
-        'generated_at': timezone.now(),
-    }
-
-    # Render the template
-    html_string = get_template('reports/pdf_report_template.html').render(context)
-
-    # Create PDF
-    result = BytesIO()
-    pdf = pisa.pisaDocument(BytesIO(html_string.encode("UTF-8")), result)
+    # All fields, related ones included, come back from a single query
+    started = time.perf_counter()
+    content = render_pdf_report(
+        template.name, template.description, query, query.project(data), request.user.username
+    )
+    record_report('pdf', template.entity_type, 'download', time.perf_counter() - started, content is not None)
 
-    if not pdf.err:
-        response = HttpResponse(result.getvalue(), content_type='application/pdf')
+    if content is not None:
+        response = HttpResponse(content, content_type='application/pdf')
         response['Content-Disposition'] = f'attachment; filename="{template.name}.pdf"'
         return response
 
     return HttpResponse('Error generating PDF', status=400)
 
+# Background Report Runs
+class ReportRunListView(LoginRequiredMixin, ListView):
+    model = ReportRun
+    template_name = 'reports/report_run_list.html'
+    context_object_name = 'report_runs'
+    paginate_by = 10
+
+    def get_queryset(self):
+        # Show only runs requested by the user
+        return RoleScope(self.request.user).queryset(ReportRun)
+
+class ReportRunDetailView(LoginRequiredMixin, DetailView):
+    model = ReportRun
+    template_name = 'reports/report_run_detail.html'
+    context_object_name = 'report_run'
+
+    def get_queryset(self):
+        # Show only runs requested by the user
+        return RoleScope(self.request.user).queryset(ReportRun)
+
+@login_required
+def enqueue_report(request, pk):
+    """Queue a saved report for generation by the background report worker"""
+    report = get_object_or_404(Report, pk=pk, created_by=request.user)
+    if request.method != 'POST':
+        return redirect('report_detail', pk=report.pk)
+
+    format_type = request.POST.get('format', report.format)
+    if format_type not in dict(Report.FORMAT_CHOICES):
+        messages.error(request, f"Unknown report format '{format_type}'.")
+        return redirect('report_detail', pk=report.pk)
+
+    run = ReportRun.objects.create(
+        name=report.name,
+        report=report,
+        entity_type=report.template.entity_type,
+        fields=report.template.fields,
+        filters=report.filters,
+        format=format_type,
+        created_by=request.user,
+    )
+    messages.success(request, f"Report '{report.name}' has been queued for generation.")
+    return redirect('report_run_detail', pk=run.pk)
+
+@login_required
+def report_run_status(request, pk):
+    """Poll the status of a background report run"""
+    run = get_object_or_404(ReportRun, pk=pk, created_by=request.user)
+    return JsonResponse({
+        'id': run.pk,
+        'status': run.status,
+        'progress': run.progress,
+        'row_count': run.row_count,
+        'error': run.error,
+        'created_at': run.created_at,
+        'started_at': run.started_at,
+        'finished_at': run.finished_at,
+        'download_url': reverse('download_report_run', kwargs={'pk': run.pk}) if run.status == 'completed' else None,
+    })
+
+@login_required
+def download_report_run(request, pk):
+    """Download the file produced by a completed background report run"""
+    run = get_object_or_404(ReportRun, pk=pk, created_by=request.user, status='completed')
+    path = run.artifact_path
+    if path is None or not path.exists():
+        raise Http404("The generated report file is no longer available.")
+    return FileResponse(open(path, 'rb'), as_attachment=True, filename=path.name)
+
 
 # Action Plan Views
-class ActionPlanListView(LoginRequiredMixin, AdminOrCaseManagerRequiredMixin, ListView):
+class ActionPlanListView(LoginRequiredMixin, AdminOrCaseManagerRequiredMixin, KeysetPaginationMixin, ListView):
     model = ActionPlan
     template_name = 'action_plans/action_plan_list.html'
     context_object_name = 'action_plans'
@@ -1703,21 +1616,13 @@ class ActionPlanListView(LoginRequiredMixin, AdminOrCaseManagerRequiredMixin, Li
     def get_queryset(self):
         queryset = super().get_queryset()
 
-        # Filter action plans based on user role
-        if self.request.user.role == 'case_manager':
-            # Case managers can see action plans they created
-            queryset = queryset.filter(created_by=self.request.user)
+        # Restrict to what the user's role may see
+        queryset = RoleScope(self.request.user).filter(queryset)
 
         # Apply search filter
         search_query = self.request.GET.get('search', '')
         if search_query:
-            queryset = queryset.filter(
-                Q(title__icontains=search_query) | 
-                Q(description__icontains=search_query) |
-                Q(goals__icontains=search_query) |
-                Q(case__title__icontains=search_query) |
-                Q(case__beneficiary__name__icontains=search_query)
-            )
+            queryset = search(queryset, search_query)
 
         # Apply status filter
         status = self.request.GET.get('status', '')
@@ -1726,7 +1631,11 @@ class ActionPlanListView(LoginRequiredMixin, AdminOrCaseManagerRequiredMixin, Li
 
         # Apply sorting
         sort = self.request.GET.get('sort', '-created_at')
-        queryset = queryset.order_by(sort)
+        if search_query and 'sort' not in self.request.GET:
+            # Best matches first unless another order was asked for
+            queryset = queryset.order_by('search_rank', sort)
+        else:
+            queryset = queryset.order_by(sort)
 
         return queryset
 
@@ -1738,9 +1647,8 @@ class ActionPlanDetailView(LoginRequiredMixin, AdminOrCaseManagerRequiredMixin,
 
     def get_queryset(self):
         queryset = super().get_queryset()
-        # Case managers can only view their own action plans
-        if self.request.user.role == 'case_manager':
-            queryset = queryset.filter(created_by=self.request.user)
+        # Restrict to what the user's role may see
+        queryset = RoleScope(self.request.user).filter(queryset)
         return queryset
 
     def get_context_data(self, **kwargs):
@@ -1785,8 +1693,7 @@ class ActionPlanUpdateView(LoginRequiredMixin, AdminOrCaseManagerRequiredMixin,
     def get_queryset(self):
         queryset = super().get_queryset()
         # Case managers can only update their own action plans
-        if self.request.user.role == 'case_manager':
-            queryset = queryset.filter(created_by=self.request.user)
+        queryset = RoleScope(self.request.user).filter(queryset)
         return queryset
 
     def get_form(self, form_class=None):
@@ -1817,7 +1724,7 @@ class ActionPlanDeleteView(LoginRequiredMixin, AdminRequiredMixin, DeleteView):
 
 
 # Beneficiary Progress Views
-class BeneficiaryProgressListView(LoginRequiredMixin, CanTrackBeneficiaryProgressMixin, ListView):
+class BeneficiaryProgressListView(LoginRequiredMixin, CanTrackBeneficiaryProgressMixin, KeysetPaginationMixin, ListView):
     model = BeneficiaryProgress
     template_name = 'progress/progress_list.html'
     context_object_name = 'progress_records'
@@ -1826,11 +1733,8 @@ class BeneficiaryProgressListView(LoginRequiredMixin, CanTrackBeneficiaryProgres
     def get_queryset(self):
         queryset = super().get_queryset()
 
-        # Filter progress records based on user role
-        if self.request.user.role == 'case_manager':
-            # Case managers can see progress for their cases
-            case_ids = Case.objects.filter(case_manager=self.request.user).values_list('id', flat=True)
-            queryset = queryset.filter(case__id__in=case_ids)
+        # Restrict to what the user's role may see
+        queryset = RoleScope(self.request.user).filter(queryset)
 
         # Apply beneficiary filter
         beneficiary_id = self.request.GET.get('beneficiary', '')
@@ -1876,11 +1780,8 @@ class BeneficiaryProgressDetailView(LoginRequiredMixin, CanTrackBeneficiaryProgr
 
     def get_queryset(self):
         queryset = super().get_queryset()
-        # Filter based on user role
-        if self.request.user.role == 'case_manager':
-            # Case managers can see progress for their cases
-            case_ids = Case.objects.filter(case_manager=self.request.user).values_list('id', flat=True)
-            queryset = queryset.filter(case__id__in=case_ids)
+        # Restrict to what the user's role may see
+        queryset = RoleScope(self.request.user).filter(queryset)
         return queryset
 
 
@@ -1894,12 +1795,11 @@ class BeneficiaryProgressCreateView(LoginRequiredMixin, CanTrackBeneficiaryProgr
         # Limit choices based on user role
         if self.request.user.role == 'case_manager':
             # Case managers can only select their cases
-            case_ids = Case.objects.filter(case_manager=self.request.user).values_list('id', flat=True)
-            form.fields['case'].queryset = Case.objects.filter(id__in=case_ids)
+            form.fields['case'].queryset = RoleScope(self.request.user).queryset(Case)
 
             # Limit beneficiaries to those in their cases
-            beneficiary_ids = Case.objects.filter(case_manager=self.request.user).values_list('beneficiary_id', flat=True)
-            form.fields['beneficiary'].queryset = Beneficiary.objects.filter(id__in=beneficiary_ids)
+            managed_cases = Case.objects.filter(beneficiary=OuterRef('pk'), case_manager=self.request.user)
+            form.fields['beneficiary'].queryset = Beneficiary.objects.filter(Exists(managed_cases))
 
             # Limit action plans to those they created
             form.fields['action_plan'].queryset = ActionPlan.objects.filter(created_by=self.request.user)
@@ -1922,11 +1822,8 @@ class BeneficiaryProgressUpdateView(LoginRequiredMixin, CanTrackBeneficiaryProgr
 
     def get_queryset(self):
         queryset = super().get_queryset()
-        # Filter based on user role
-        if self.request.user.role == 'case_manager':
-            # Case managers can only update progress for their cases
-            case_ids = Case.objects.filter(case_manager=self.request.user).values_list('id', flat=True)
-            queryset = queryset.filter(case__id__in=case_ids)
+        # Case managers can only update progress for their cases
+        queryset = RoleScope(self.request.user).filter(queryset)
         return queryset
 
     def get_form(self, form_class=None):
@@ -1934,12 +1831,11 @@ class BeneficiaryProgressUpdateView(LoginRequiredMixin, CanTrackBeneficiaryProgr
         # Limit choices based on user role
         if self.request.user.role == 'case_manager':
             # Case managers can only select their cases
-            case_ids = Case.objects.filter(case_manager=self.request.user).values_list('id', flat=True)
-            form.fields['case'].queryset = Case.objects.filter(id__in=case_ids)
+            form.fields['case'].queryset = RoleScope(self.request.user).queryset(Case)
 
             # Limit beneficiaries to those in their cases
-            beneficiary_ids = Case.objects.filter(case_manager=self.request.user).values_list('beneficiary_id', flat=True)
-            form.fields['beneficiary'].queryset = Beneficiary.objects.filter(id__in=beneficiary_ids)
+            managed_cases = Case.objects.filter(beneficiary=OuterRef('pk'), case_manager=self.request.user)
+            form.fields['beneficiary'].queryset = Beneficiary.objects.filter(Exists(managed_cases))
 
             # Limit action plans to those they created
             form.fields['action_plan'].queryset = ActionPlan.objects.filter(created_by=self.request.user)